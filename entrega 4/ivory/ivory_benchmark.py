@@ -0,0 +1,540 @@
+# ivory_benchmark.py
+"""
+⏱️ IVORY BENCHMARK ⏱️
+Mediciones de rendimiento del motor de seguridad Ivory
+Versión: 2.0 Pro Edition - Herramientas de Rendimiento
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import asyncio
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+# Peticiones de ejemplo (normales y maliciosas)
+SAMPLE_REQUESTS = [
+    ('GET /index.php HTTP/1.1', 200, 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'),
+    ('GET /css/style.css HTTP/1.1', 200, 'Mozilla/5.0 (X11; Linux x86_64)'),
+    ('POST /wp-login.php HTTP/1.1', 200, 'curl/7.68.0'),
+    ('GET /admin/login.php HTTP/1.1', 403, 'sqlmap/1.5.2'),
+    ('GET /../../../etc/passwd HTTP/1.1', 404, 'nikto/2.1.6'),
+    ("GET /index.php?id=1' union select 1-- HTTP/1.1", 200, 'Mozilla/5.0'),
+    ('GET /images/logo.png HTTP/1.1', 304, 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7)'),
+]
+
+def generate_log_lines(count: int, distinct_ips: int = 2000, seed: int = 42):
+    """📝 Generar líneas sintéticas en formato Apache Combined"""
+    rng = random.Random(seed)
+    ips = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+           for _ in range(distinct_ips)]
+
+    lines = []
+    for _ in range(count):
+        request, status, user_agent = rng.choice(SAMPLE_REQUESTS)
+        lines.append(
+            f'{rng.choice(ips)} - - [23/Jun/2025:14:32:15 +0200] "{request}" {status} '
+            f'{rng.randint(0, 5000)} "-" "{user_agent}"'
+        )
+    return lines
+
+def create_engine(workdir: Path, optimization: dict = None):
+    """🛡️ Crear un motor aislado en un directorio temporal"""
+    config = {
+        'paths': {
+            'apache_log': str(workdir / 'access.log'),
+            'htaccess': str(workdir / '.htaccess'),
+            'geoip_db': str(workdir / 'GeoLite2-Country.mmdb'),
+            'city_db': str(workdir / 'GeoLite2-City.mmdb')
+        },
+        'monitoring': {'real_time_alerts': False},
+        'optimization': optimization or {}
+    }
+    config_path = workdir / 'ivory_config.json'
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=4)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from ivory_core_engine import IvorySecurityEngine
+
+    os.chdir(workdir)
+    return IvorySecurityEngine(str(config_path))
+
+async def _run_line_mode(engine, lines):
+    # El mismo camino que el motor en modo línea a línea (incluida la cola de escritura)
+    for line in lines:
+        record = engine.parse_log_line(line)
+        if record:
+            await engine.process_single_record(record)
+
+async def _run_batch_mode(engine, lines):
+    batch_size = engine.config['optimization']['batch_size']
+    for i in range(0, len(lines), batch_size):
+        await engine.process_log_batch(lines[i:i + batch_size])
+
+def benchmark_ingestion(line_count: int = 2000):
+    """⚡ Comparar líneas/segundo: modo línea a línea vs. modo por lotes"""
+    lines = generate_log_lines(line_count)
+    results = {}
+    original_cwd = os.getcwd()
+
+    try:
+        for mode, runner in [('line', _run_line_mode), ('batch', _run_batch_mode)]:
+            with tempfile.TemporaryDirectory() as tmp:
+                engine = create_engine(Path(tmp))
+                try:
+                    started = time.perf_counter()
+                    asyncio.run(runner(engine, lines))
+                    elapsed = time.perf_counter() - started
+
+                    results[mode] = {
+                        'lines': line_count,
+                        'seconds': round(elapsed, 3),
+                        'lines_per_second': round(line_count / elapsed, 1),
+                        'engine_rate': round(engine.get_ingestion_rate(), 1)
+                    }
+                finally:
+                    # Hilo escritor y conexiones cerrados antes de borrar el directorio
+                    engine.close()
+                    os.chdir(original_cwd)
+    finally:
+        os.chdir(original_cwd)
+
+    return results
+
+def generate_blocked_ips(count: int, seed: int = 7):
+    """🎯 IPs bloqueadas sintéticas: barridos desde redes /24 más IPs sueltas"""
+    rng = random.Random(seed)
+    ips = set()
+
+    # La mitad proviene de escaneos concentrados en unas pocas redes
+    while len(ips) < count // 2:
+        network = f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}"
+        for host in rng.sample(range(1, 255), rng.randint(20, 254)):
+            ips.add(f"{network}.{host}")
+
+    while len(ips) < count:
+        ips.add(f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}")
+
+    return set(list(ips)[:count])
+
+def benchmark_cidr_aggregation(ip_count: int = 50000):
+    """🧮 Reglas Apache y tamaño del .htaccess con y sin agregación CIDR"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from ivory_core_engine import HtaccessBlockWriter
+
+    blocked_ips = generate_blocked_ips(ip_count)
+    variants = {
+        'one_rule_per_ip': {'aggregate': False},
+        'cidr_collapsed': {'aggregate': True},
+        'cidr_with_prefix_block': {
+            'aggregate': True,
+            'prefix_block': {'enabled': True, 'ipv4_prefix': 24, 'ipv6_prefix': 64, 'min_hosts': 16}
+        }
+    }
+    results = {}
+
+    for name, options in variants.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = HtaccessBlockWriter(os.path.join(tmp, '.htaccess'), **options)
+            writer.add(blocked_ips)
+
+            started = time.perf_counter()
+            writer.flush(force=True)
+            elapsed = time.perf_counter() - started
+
+            results[name] = {
+                'blocked_ips': ip_count,
+                'apache_rules': len(writer.rules),
+                'file_bytes': os.path.getsize(writer.htaccess_path),
+                'flush_seconds': round(elapsed, 3)
+            }
+
+    return results
+
+async def _read_with_aiofiles_lines(engine, path):
+    import aiofiles
+    records = 0
+    async with aiofiles.open(path, 'r') as f:
+        while True:
+            line = await f.readline()
+            if not line:
+                break
+            if engine.parse_log_line(line.strip()):
+                records += 1
+    return records
+
+async def _read_with_aiofiles_chunks(engine, path):
+    import aiofiles
+    chunk_size = engine.config['optimization']['read_chunk_size']
+    records = 0
+    pending = ''
+    async with aiofiles.open(path, 'r') as f:
+        while True:
+            chunk = await f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            records += sum(1 for line in lines if engine.parse_log_line(line.strip()))
+    return records
+
+def _read_with_mmap(engine, path):
+    from ivory_core_engine import read_log_region
+    region_size = engine.config['optimization']['read_chunk_size']
+    records = 0
+    offset = 0
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while offset < size:
+            parsed, offset = read_log_region(f, offset, min(size, offset + region_size))
+            records += len(parsed)
+    return records
+
+def benchmark_log_reading(line_count: int = 300000):
+    """🗺️ Lectura + parseo del log: aiofiles (línea a línea y por bloques) vs. mmap"""
+    lines = generate_log_lines(line_count)
+    results = {}
+    original_cwd = os.getcwd()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(Path(tmp))
+            log_path = os.path.join(tmp, 'access.log')
+            with open(log_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+            readers = {
+                'aiofiles_readline': lambda: asyncio.run(_read_with_aiofiles_lines(engine, log_path)),
+                'aiofiles_chunks': lambda: asyncio.run(_read_with_aiofiles_chunks(engine, log_path)),
+                'mmap_bytes_regex': lambda: _read_with_mmap(engine, log_path)
+            }
+
+            for name, reader in readers.items():
+                started = time.perf_counter()
+                records = reader()
+                elapsed = time.perf_counter() - started
+                results[name] = {
+                    'records': records,
+                    'seconds': round(elapsed, 3),
+                    'lines_per_second': round(line_count / elapsed, 1),
+                    'mb_per_second': round(os.path.getsize(log_path) / elapsed / 1e6, 1)
+                }
+            engine.close()
+    finally:
+        os.chdir(original_cwd)
+
+    return results
+
+def benchmark_pipeline(line_count: int = 20000, worker_counts=(0, 1, 2, 4)):
+    """🧵 Líneas/segundo del análisis por lotes según el número de workers por IP"""
+    lines = generate_log_lines(line_count)
+    warmup = lines[:1000]
+    results = {}
+    original_cwd = os.getcwd()
+
+    try:
+        for workers in worker_counts:
+            with tempfile.TemporaryDirectory() as tmp:
+                engine = create_engine(Path(tmp), {'pipeline_workers': workers})
+                engine.start_pipeline()
+
+                async def run():
+                    await engine.process_log_batch(warmup)  # Arrancar los workers fuera de la medición
+                    started = time.perf_counter()
+                    await engine.process_log_batch(lines)
+                    return time.perf_counter() - started
+
+                elapsed = asyncio.run(run())
+                results[f'workers_{workers}'] = {
+                    'lines': line_count,
+                    'seconds': round(elapsed, 3),
+                    'lines_per_second': round(line_count / elapsed, 1)
+                }
+                engine.close()
+                os.chdir(original_cwd)
+    finally:
+        os.chdir(original_cwd)
+
+    results['cpu_count'] = os.cpu_count()
+    return results
+
+@dataclass
+class LegacySecurityEvent:
+    """📋 Representación anterior de SecurityEvent (dataclass con __dict__), para comparar"""
+    timestamp: datetime
+    ip: str
+    country: str
+    user_agent: str
+    threat_type: str
+    threat_level: object
+    request_path: str
+    response_code: int
+    blocked: bool = False
+    ml_score: float = 0.0
+
+def _current_rss_mb() -> float:
+    """📏 RSS actual del proceso en MB (Linux: /proc; otros: pico vía resource)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _event_memory_worker(compact: bool, line_count: int, distinct_ips: int, retained: int) -> dict:
+    """🧪 Crear line_count eventos como lo hace el motor y medir la memoria (proceso aislado)"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from ivory_core_engine import SecurityEvent, ThreatLevel, HyperLogLog
+
+    event_class = SecurityEvent if compact else LegacySecurityEvent
+    unique_ips = HyperLogLog() if compact else set()
+    in_flight = deque(maxlen=retained)  # Eventos vivos: lote en curso + cola del escritor
+    countries = [b'Spain', b'United States', b'China', b'Russia', b'Germany']
+    levels = list(ThreatLevel)
+    user_agents = [user_agent.encode() for _, _, user_agent in SAMPLE_REQUESTS]
+    rng = random.Random(5)
+    baseline = _current_rss_mb()
+    started = time.perf_counter()
+
+    for i in range(line_count):
+        # Cada línea decodifica cadenas nuevas, como el parser real
+        ip_number = (rng.randrange(distinct_ips) * 2654435761) & 0xFFFFFFFF
+        event = event_class(
+            timestamp=datetime.now(),
+            ip=f"{ip_number >> 24}.{(ip_number >> 16) & 255}.{(ip_number >> 8) & 255}.{ip_number & 255}",
+            country=countries[i % 5].decode(),
+            user_agent=user_agents[i % len(user_agents)].decode(),
+            threat_type=b'Normal'.decode(),
+            threat_level=levels[i % 4],
+            request_path=f'/index.php?id={i % 1000}',
+            response_code=200
+        )
+        if compact:
+            unique_ips.add_hash(HyperLogLog.hash_int(event.packed_ip))  # Igual que update_aggregate_stats
+        else:
+            unique_ips.add(event.ip)
+        in_flight.append(event)
+
+    return {
+        'lines': line_count,
+        'seconds': round(time.perf_counter() - started, 1),
+        'rss_growth_mb': round(_current_rss_mb() - baseline, 1),
+        'unique_ips_tracked': len(unique_ips)
+    }
+
+def benchmark_event_memory(line_count: int = 10_000_000, distinct_ips: int = 1_000_000,
+                           retained: int = 100_000):
+    """🧠 Crecimiento de RSS al procesar line_count líneas: dataclass + set vs. eventos compactos + HLL"""
+    results = {}
+    for name, compact in [('dataclass_and_set', False), ('slots_interned_and_hll', True)]:
+        # Un proceso nuevo por variante para que el RSS de una no contamine a la otra
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results[name] = pool.submit(_event_memory_worker, compact, line_count,
+                                        distinct_ips, retained).result()
+    return results
+
+def benchmark_reputation_index(entry_count: int = 500000, cidr_count: int = 20000, lookups: int = 100000):
+    """🌳 Feed de reputación: construcción, memoria y búsquedas del árbol radix vs. un set de cadenas"""
+    import tracemalloc
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from ivory_core_engine import ReputationIndex, build_reputation_index
+
+    rng = random.Random(11)
+    entries = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}"
+               for _ in range(entry_count)]
+    entries += [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.0/24" for _ in range(cidr_count)]
+    queries = [entry.split('/')[0] for entry in rng.sample(entries, lookups // 2)]
+    queries += [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}"
+                for _ in range(lookups - len(queries))]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        feed_path = os.path.join(tmp, 'malicious_ips.txt')
+        with open(feed_path, 'w') as f:
+            f.write('\n'.join(entries) + '\n')
+
+        # Referencia: set de cadenas leído del mismo archivo (solo IPs exactas)
+        tracemalloc.start()
+        started = time.perf_counter()
+        with open(feed_path) as f:
+            string_set = {line.strip() for line in f}
+        results['string_set'] = {
+            'build_seconds': round(time.perf_counter() - started, 2),
+            'memory_mb': round(tracemalloc.get_traced_memory()[0] / 1e6, 1)
+        }
+        tracemalloc.stop()
+        started = time.perf_counter()
+        hits = sum(1 for ip in queries if ip in string_set)
+        results['string_set'].update({'lookup_us': round((time.perf_counter() - started) / lookups * 1e6, 2),
+                                      'hits': hits})
+        del string_set
+
+        started = time.perf_counter()
+        index = ReputationIndex()
+        index.load_feed_file(feed_path, 'malicious_ips')
+        build_seconds = time.perf_counter() - started
+        index.lookup('1.1.1.1')  # Construir las tablas de salto fuera de la medición
+        started = time.perf_counter()
+        hits = sum(1 for ip in queries if index.lookup(ip))
+        results['radix_index'] = {
+            'build_seconds': round(build_seconds, 2),
+            'memory_mb': round(index.get_stats()['memory_bytes'] / 1e6, 1),
+            'lookup_us': round((time.perf_counter() - started) / lookups * 1e6, 2),
+            'hits': hits  # Incluye IPs dentro de los /24 del feed
+        }
+        del index
+
+        # Índice serializado: construcción offline, reconstrucción sin cambios y arranque con mmap
+        feeds_dir, index_dir = os.path.join(tmp, 'feeds'), os.path.join(tmp, 'index')
+        os.makedirs(feeds_dir)
+        os.replace(feed_path, os.path.join(feeds_dir, 'malicious_ips.txt'))
+        started = time.perf_counter()
+        manifest = build_reputation_index(feeds_dir, index_dir)
+        build_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        unchanged = build_reputation_index(feeds_dir, index_dir)
+        unchanged_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        mapped = ReputationIndex.load(os.path.join(index_dir, manifest['index_file']))
+        load_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        hits = sum(1 for ip in queries if mapped.lookup(ip))
+        results['mapped_index'] = {
+            'build_and_save_seconds': round(build_seconds, 2),
+            'unchanged_check_seconds': round(unchanged_seconds, 4),
+            'skipped_unchanged': unchanged is None,
+            'mmap_load_seconds': round(load_seconds, 4),
+            'lookup_us': round((time.perf_counter() - started) / lookups * 1e6, 2),
+            'hits': hits
+        }
+        del mapped
+
+    return results
+
+# Código que ejecuta cada opción del menú del lanzador hasta estar lista (proceso nuevo)
+COLD_START_OPTIONS = {
+    '1_gui': "import ivory_security_center",
+    '2_console': "from ivory_core_engine import IvorySecurityEngine\n"
+                 "engine = IvorySecurityEngine()\nengine.generate_security_report()",
+    '4_config_editor': "import ivory_launcher\nivory_launcher.IvoryLauncher().load_config()",
+    '5_quick_report': "import ivory_launcher\nfrom ivory_core_engine import IvorySecurityEngine\n"
+                      "IvorySecurityEngine().generate_security_report()",
+    '6_backfill_first_batch': "from ivory_core_engine import IvorySecurityEngine\n"
+                              "engine = IvorySecurityEngine()\nengine.analyze_records_batch("
+                              "[engine.parse_log_line(line) for line in LINES])",
+}
+
+COLD_START_PROBE = """
+import sys, time, json, logging
+logging.disable(logging.CRITICAL)
+LINES = {lines!r}
+started = time.perf_counter()
+error = None
+try:
+{code}
+except Exception as e:
+    error = repr(e)
+print(json.dumps({{
+    'in_process_seconds': round(time.perf_counter() - started, 3),
+    'heavy_modules': [name for name in ('numpy', 'sklearn', 'joblib', 'geoip2', 'aiofiles', 'requests')
+                      if name in sys.modules],
+    'error': error
+}}))
+"""
+
+def benchmark_cold_start(repeats: int = 3):
+    """🥶 Arranque en frío de cada opción del lanzador (proceso nuevo, mejor de N)"""
+    import subprocess
+    engine_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=engine_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    lines = generate_log_lines(200)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'ivory_config.json'), 'w') as f:
+            json.dump({}, f)
+
+        # Primera ejecución fuera de la medición: crea BD, índice de reputación y modelos .joblib
+        probe = COLD_START_PROBE.format(lines=lines, code='    ' + COLD_START_OPTIONS['6_backfill_first_batch']
+                                        .replace('\n', '\n    '))
+        subprocess.run([sys.executable, '-c', probe], cwd=tmp, env=env, capture_output=True)
+
+        for name, code in COLD_START_OPTIONS.items():
+            probe = COLD_START_PROBE.format(lines=lines, code='    ' + code.replace('\n', '\n    '))
+            timings = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                output = subprocess.run([sys.executable, '-c', probe], cwd=tmp, env=env,
+                                        capture_output=True, text=True).stdout
+                timings.append(time.perf_counter() - started)
+            result = json.loads(output.strip().splitlines()[-1])
+            result['wall_seconds'] = round(min(timings), 3)
+            results[name] = result
+
+    return results
+
+def benchmark_tracing_overhead(line_count: int = 2000):
+    """🔬 Coste del trazado por etapa en modo línea a línea (desactivado, muestreo 1 %, todas las líneas)"""
+    lines = generate_log_lines(line_count)
+    results = {}
+    original_cwd = os.getcwd()
+
+    try:
+        for label, enabled, sample_rate in [('off', False, 0.0), ('sampled', True, 0.01), ('all_lines', True, 1.0)]:
+            with tempfile.TemporaryDirectory() as tmp:
+                engine = create_engine(Path(tmp))
+                engine.tracer.configure(enabled, sample_rate)
+                asyncio.run(_run_line_mode(engine, lines[:200]))  # calentar modelos y cachés
+                started = time.perf_counter()
+                asyncio.run(_run_line_mode(engine, lines))
+                elapsed = time.perf_counter() - started
+
+                results[label] = {
+                    'lines_per_second': round(line_count / elapsed, 1),
+                    'sampled_traces': engine.tracer.sampled,
+                    'slowest_stages': sorted(
+                        ((stage, stats['avg_ms']) for stage, stats in engine.tracer.get_stats()['stages'].items()),
+                        key=lambda item: item[1], reverse=True
+                    )[:3]
+                }
+                engine.close()
+                os.chdir(original_cwd)
+    finally:
+        os.chdir(original_cwd)
+
+    return results
+
+BENCHMARKS = {
+    'ingestion': benchmark_ingestion,
+    'cidr': benchmark_cidr_aggregation,
+    'reading': benchmark_log_reading,
+    'pipeline': benchmark_pipeline,
+    'memory': benchmark_event_memory,
+    'reputation': benchmark_reputation_index,
+    'cold_start': benchmark_cold_start,
+    'tracing': benchmark_tracing_overhead,
+}
+
+def main():
+    """🎯 Ejecutar benchmarks seleccionados (por defecto todos)"""
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    logging.disable(logging.CRITICAL)  # Silenciar alertas del motor durante las mediciones
+
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"❌ Benchmark desconocido: {name} (disponibles: {', '.join(BENCHMARKS)})")
+            continue
+
+        print(f"\n⏱️ Ejecutando benchmark: {name}")
+        print(json.dumps(BENCHMARKS[name](), indent=2))
+
+if __name__ == "__main__":
+    main()
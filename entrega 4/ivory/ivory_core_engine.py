@@ -5,97 +5,3126 @@ Motor Avanzado de Seguridad Web con IA y Análisis Predictivo
 Versión: 2.0 Pro Edition - Núcleo Mejorado
 """
 
-import geoip2.database
-import ipaddress
+import bisect
 import os
 import re
 import shutil
+import sys
+import socket
+import tempfile
 import json
 import hashlib
-import requests
+import hmac
+import secrets
+import urllib.parse
+import itertools
+import math
+import glob
+import gzip
+import mmap
 import sqlite3
 import threading
+import queue
+import random
 import time
-from datetime import datetime, timedelta
-from collections import defaultdict, Counter
-from typing import Dict, List, Set, Tuple, Optional
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, deque, Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterable, List, Set, Tuple, Optional, TYPE_CHECKING
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from multiprocessing.util import Finalize
 from enum import Enum
 import asyncio
-import aiofiles
-import numpy as np
-from sklearn.ensemble import IsolationForest
-import joblib
+
+# numpy, scikit-learn, joblib y geoip2 se importan solo al usarse: los reportes
+# y la configuración arrancan sin cargar la pila de ML
+if TYPE_CHECKING:
+    import numpy as np
+
+# ═══════════════════════════════════════════════════════════
+# 🏗️ CONFIGURACIÓN Y ESTRUCTURAS DE DATOS
+# ═══════════════════════════════════════════════════════════
+
+# Patrón Apache Common Log Format + Combined (compilado una sola vez)
+APACHE_LOG_PATTERN = re.compile(r'^(\S+) \S+ \S+ \[(.*?)\] "(.*?)" (\d+) (\d+|-) "(.*?)" "(.*?)"')
+
+# Variante en bytes para recorrer logs mapeados en memoria sin decodificarlos
+# (solo se capturan los campos usados: IP, fecha, petición, estado y User-Agent)
+APACHE_LOG_PATTERN_BYTES = re.compile(
+    rb'^(\S+) \S+ \S+ \[(.*?)\] "(.*?)" (\d+) (?:\d+|-) "(?:.*?)" "(.*?)"', re.MULTILINE
+)
+
+APACHE_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+def parse_apache_timestamp(value: str) -> Optional[datetime]:
+    """🕐 Convertir '23/Jun/2025:14:32:15 +0200' en datetime con zona horaria"""
+    try:
+        day, month, rest = value.split('/', 2)
+        year, hour, minute, rest = rest.split(':', 3)
+        second, offset = rest.split(' ', 1)
+        offset_seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        if offset[0] == '-':
+            offset_seconds = -offset_seconds
+        return datetime(int(year), APACHE_MONTHS[month], int(day), int(hour), int(minute), int(second),
+                        tzinfo=timezone(timedelta(seconds=offset_seconds)))
+    except (ValueError, KeyError, IndexError):
+        return None
+
+def is_valid_ip(ip: str) -> bool:
+    """✅ Validar una IPv4/IPv6 con inet_pton (mucho más rápido que ipaddress)"""
+    try:
+        socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+        return True
+    except (OSError, ValueError):
+        return False
+
+def read_log_region(f, start: int, end: int) -> Tuple[List[Dict], int]:
+    """🗺️ Parsear [start, end) de un log mapeado en memoria
+    
+    Solo se procesan líneas completas: devuelve los registros y el offset
+    tras el último salto de línea, desde el que debe continuar la lectura.
+    """
+    if end <= start:
+        return [], start
+    
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        end = min(end, len(buffer))
+        cut = buffer.rfind(b'\n', start, end) + 1
+        if cut <= start:
+            return [], start
+        
+        records = []
+        for match in APACHE_LOG_PATTERN_BYTES.finditer(buffer, start, cut):
+            ip_bytes, timestamp_bytes, request_bytes, status_bytes, user_agent_bytes = match.groups()
+            ip = ip_bytes.decode('ascii', errors='replace')
+            if not is_valid_ip(ip):
+                continue
+            
+            records.append({
+                'ip': ip,
+                'timestamp_str': timestamp_bytes.decode('ascii', errors='replace'),
+                'request': request_bytes.decode('utf-8', errors='replace'),
+                'status_code': int(status_bytes),
+                'user_agent': user_agent_bytes.decode('utf-8', errors='replace')
+            })
+    
+    return records, cut
+
+# Caracteres especiales contados como característica de ML
+ML_SPECIAL_CHARS = '!@#$%^&*()[]{}|;:,.<>?'
+ML_SPECIAL_CHARS_TABLE = str.maketrans('', '', ML_SPECIAL_CHARS)
+
+class ThreatLevel(Enum):
+    """🚨 Niveles de amenaza"""
+    LOW = "LOW"
+    MEDIUM = "MEDIUM" 
+    HIGH = "HIGH"
+    CRITICAL = "CRITICAL"
+
+# Marca de IPv6 en las IPs empaquetadas (las IPv4 ocupan los 32 bits bajos)
+IPV6_FLAG = 1 << 128
+
+def pack_ip(ip: str) -> int:
+    """📦 IP en texto → entero (IPv6 con el bit 128 activado)"""
+    if ':' in ip:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big') | IPV6_FLAG
+    return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+
+def unpack_ip(value: int) -> str:
+    """📦 Entero empaquetado → IP en texto"""
+    if value & IPV6_FLAG:
+        return socket.inet_ntop(socket.AF_INET6, (value ^ IPV6_FLAG).to_bytes(16, 'big'))
+    return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, 'big'))
+
+class BoundedStringPool:
+    """🔁 Deduplicación de cadenas con tamaño acotado (LRU)
+    
+    Para campos de cardinalidad alta como el User-Agent: sys.intern guardaría
+    para siempre cada valor distinto, aquí solo se conservan los max_size
+    usados más recientemente.
+    """
+    
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.strings: 'OrderedDict[str, str]' = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, value: str) -> str:
+        with self.lock:
+            cached = self.strings.get(value)
+            if cached is not None:
+                self.strings.move_to_end(value)
+                return cached
+            self.strings[value] = value
+            if len(self.strings) > self.max_size:
+                self.strings.popitem(last=False)
+            return value
+
+USER_AGENT_POOL = BoundedStringPool()
+
+class SecurityEvent:
+    """📋 Evento de seguridad
+    
+    Representación compacta: __slots__ en lugar de __dict__, fecha como epoch,
+    IP empaquetada en un entero, país y tipo de amenaza internados (pocos
+    valores distintos) y User-Agent deduplicado en un pool LRU acotado
+    (miles de eventos comparten la misma cadena en lugar de una copia cada uno).
+    """
+    __slots__ = ('epoch', 'packed_ip', 'country', 'user_agent', 'threat_type', 'threat_level',
+                 'request_path', 'response_code', 'blocked', 'ml_score')
+    
+    def __init__(self, timestamp: datetime, ip: str, country: str, user_agent: str,
+                 threat_type: str, threat_level: ThreatLevel, request_path: str,
+                 response_code: int, blocked: bool = False, ml_score: float = 0.0):
+        self.epoch = timestamp.timestamp()
+        self.packed_ip = pack_ip(ip)
+        self.country = sys.intern(country)
+        self.user_agent = USER_AGENT_POOL.get(user_agent)
+        self.threat_type = sys.intern(threat_type)
+        self.threat_level = threat_level
+        self.request_path = request_path
+        self.response_code = response_code
+        self.blocked = blocked
+        self.ml_score = ml_score
+    
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.epoch)
+    
+    @property
+    def ip(self) -> str:
+        return unpack_ip(self.packed_ip)
+    
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SecurityEvent):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+    
+    def __repr__(self) -> str:
+        return (f"SecurityEvent(timestamp={self.timestamp!r}, ip={self.ip!r}, country={self.country!r}, "
+                f"threat_type={self.threat_type!r}, threat_level={self.threat_level}, "
+                f"request_path={self.request_path!r}, response_code={self.response_code}, "
+                f"blocked={self.blocked}, ml_score={self.ml_score})")
+
+@dataclass
+class IPIntelligence:
+    """🧠 Inteligencia de IP"""
+    ip: str
+    country: str
+    region: str
+    city: str
+    isp: str
+    threat_score: float
+    reputation_sources: List[str]
+    last_seen: datetime
+    attack_patterns: List[str]
+    blocked_count: int = 0
+    country_code: str = 'XX'
+    reputation_version: int = field(default=-1, repr=False)  # generación del índice usada (no se guarda)
+    
+    @property
+    def reputation_mask(self) -> int:
+        return sum(REPUTATION_SOURCES[source] for source in self.reputation_sources)
+
+class LRUCache:
+    """🗃️ Caché LRU acotada con contadores de aciertos/fallos"""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        """Devolver el valor cacheado (o None) y marcarlo como reciente"""
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def put(self, key, value):
+        """Guardar un valor expulsando el menos usado si se supera el tamaño"""
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self):
+        self.data.clear()
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def get_stats(self) -> Dict:
+        """📊 Estadísticas de uso de la caché"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+class IPIntelligenceCache:
+    """🧠 Inteligencia por IP en dos niveles: LRU en memoria y tabla ip_intelligence
+    
+    Las IPs que se repiten se resuelven en memoria (o con una lectura de la
+    tabla por lote) sin volver a consultar GeoIP ni el índice de reputación.
+    Los cambios se acumulan como pendientes y se escriben en una sola
+    transacción cada flush_interval segundos (write-back); una entrada
+    expulsada de la LRU sigue pendiente hasta ese volcado.
+    """
+    SELECT_SQL = '''
+        SELECT ip, country, region, city, isp, threat_score, reputation_sources,
+               last_seen, attack_patterns, blocked_count, country_code
+        FROM ip_intelligence WHERE ip IN ({})
+    '''
+    UPSERT_SQL = '''
+        INSERT INTO ip_intelligence
+        (ip, country, region, city, isp, threat_score, reputation_sources,
+         last_seen, attack_patterns, blocked_count, country_code)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(ip) DO UPDATE SET
+            threat_score = excluded.threat_score,
+            reputation_sources = excluded.reputation_sources,
+            last_seen = excluded.last_seen,
+            attack_patterns = excluded.attack_patterns,
+            blocked_count = excluded.blocked_count
+    '''
+    MAX_ATTACK_PATTERNS = 20
+    
+    def __init__(self, db_path: str, max_size: int, flush_interval: float = 5.0,
+                 write_back: bool = True, logger: Optional[logging.Logger] = None):
+        self.db_path = db_path
+        self.memory = LRUCache(max_size)
+        self.pending: Dict[str, IPIntelligence] = {}
+        self.flush_interval = flush_interval
+        self.write_back = write_back
+        self.logger = logger or logging.getLogger('IvorySecurityEngine')
+        self.conn: Optional[sqlite3.Connection] = None
+        self.deadline = time.monotonic() + flush_interval
+        self.reputation_version = 0  # se incrementa al cambiar el índice de reputación
+        self.stats = {
+            'lookups': 0,
+            'created': 0,
+            'db_loads': 0,
+            'written': 0,
+            'flushes': 0,
+            'errors': 0
+        }
+    
+    def connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        return self.conn
+    
+    def get(self, ip: str) -> Optional[IPIntelligence]:
+        """🔍 Inteligencia conocida de una IP (None si hay que calcularla)"""
+        self.stats['lookups'] += 1
+        intel = self.memory.get(ip)
+        if intel is None:
+            intel = self.pending.get(ip)
+            if intel is not None:
+                self.memory.put(ip, intel)
+        return intel
+    
+    def prefetch(self, ips):
+        """📥 Subir a memoria con una sola consulta las IPs de un lote que estén en la tabla"""
+        missing = [ip for ip in set(ips) if ip not in self.memory.data and ip not in self.pending]
+        try:
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = self.connection().execute(self.SELECT_SQL.format(','.join('?' * len(chunk))), chunk)
+                for row in rows:
+                    self.memory.put(row[0], self.from_row(row))
+                    self.stats['db_loads'] += 1
+        except sqlite3.Error as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"❌ Error leyendo inteligencia de IPs: {e}")
+    
+    def peek(self, ip: str) -> Optional[IPIntelligence]:
+        """👀 Entrada en memoria sin contarla como consulta"""
+        return self.memory.data.get(ip) or self.pending.get(ip)
+    
+    def add(self, intel: IPIntelligence):
+        """➕ Registrar la inteligencia recién calculada de una IP"""
+        self.stats['created'] += 1
+        self.memory.put(intel.ip, intel)
+        self.mark_dirty(intel)
+    
+    def mark_dirty(self, intel: IPIntelligence):
+        self.pending[intel.ip] = intel
+    
+    def maybe_flush(self):
+        """⏱️ Volcar los cambios pendientes si ha vencido el intervalo"""
+        if time.monotonic() >= self.deadline:
+            self.flush()
+    
+    def flush(self):
+        """💾 Escribir todos los cambios pendientes en una transacción"""
+        self.deadline = time.monotonic() + self.flush_interval
+        if not self.pending or not self.write_back:
+            self.pending.clear()
+            return
+        
+        rows = [self.to_row(intel) for intel in self.pending.values()]
+        try:
+            with self.connection() as conn:
+                conn.executemany(self.UPSERT_SQL, rows)
+            self.stats['written'] += len(rows)
+            self.stats['flushes'] += 1
+            self.pending.clear()
+        except sqlite3.Error as e:
+            # Los cambios siguen pendientes y se reintentan en el próximo volcado
+            self.stats['errors'] += 1
+            self.logger.error(f"❌ Error guardando inteligencia de {len(rows)} IPs: {e}")
+    
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    @staticmethod
+    def to_row(intel: IPIntelligence) -> Tuple:
+        return (
+            intel.ip, intel.country, intel.region, intel.city, intel.isp,
+            round(intel.threat_score, 3), json.dumps(intel.reputation_sources),
+            format_db_timestamp(intel.last_seen), json.dumps(intel.attack_patterns),
+            intel.blocked_count, intel.country_code
+        )
+    
+    @staticmethod
+    def from_row(row: Tuple) -> IPIntelligence:
+        ip, country, region, city, isp, threat_score, sources, last_seen, patterns, blocked_count, country_code = row
+        return IPIntelligence(
+            ip=ip, country=country, region=region, city=city, isp=isp,
+            threat_score=threat_score or 0.0,
+            reputation_sources=json.loads(sources or '[]'),
+            last_seen=datetime.strptime(last_seen, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc),
+            attack_patterns=json.loads(patterns or '[]'),
+            blocked_count=blocked_count or 0,
+            country_code=country_code or 'XX'
+        )
+    
+    def get_stats(self) -> Dict:
+        """📊 Aciertos (sin GeoIP ni reputación), expulsiones y escrituras"""
+        lookups = self.stats['lookups']
+        return {
+            'size': len(self.memory),
+            'max_size': self.memory.max_size,
+            'lookups': lookups,
+            'memory_hits': self.memory.hits,
+            'db_loads': self.stats['db_loads'],
+            'created': self.stats['created'],
+            'hit_ratio': round((lookups - self.stats['created']) / lookups, 3) if lookups else 0.0,
+            'evictions': self.memory.evictions,
+            'pending_writes': len(self.pending),
+            'written': self.stats['written'],
+            'flushes': self.stats['flushes'],
+            'errors': self.stats['errors']
+        }
+
+class ThreatMatcher:
+    """🎯 Buscador multi-patrón compilado a partir de config['security']
+    
+    Todas las reglas de un campo se combinan en una sola expresión regular
+    con lookahead, de modo que una única pasada encuentra todas las reglas
+    presentes (incluidas las que se solapan, como 'dirb' y 'dirbuster').
+    """
+    
+    def __init__(self, security_config: Dict):
+        self.user_agent_rules = self.compile_rules([
+            ('user_agent', pattern, True)
+            for pattern in security_config.get('suspicious_user_agents', [])
+        ])
+        self.request_rules = self.compile_rules(
+            [('attack', pattern, True) for pattern in security_config.get('attack_signatures', [])] +
+            [('honeypot', pattern, False) for pattern in security_config.get('honeypot_paths', [])] +
+            [('extension', pattern, True) for pattern in security_config.get('blocked_extensions', [])]
+        )
+    
+    @staticmethod
+    def compile_rules(rules: List[Tuple[str, str, bool]]) -> Tuple:
+        """🔧 Compilar reglas (categoría, literal, ignorar mayúsculas)"""
+        # Normalizar y eliminar duplicados conservando el orden
+        rules = list(dict.fromkeys(
+            (category, literal.lower() if ignore_case else literal, ignore_case)
+            for category, literal, ignore_case in rules if literal
+        ))
+        
+        if not rules:
+            return None, [], []
+        
+        # Los literales más largos primero: en cada posición gana el más largo
+        alternatives = []
+        for i in sorted(range(len(rules)), key=lambda i: -len(rules[i][1])):
+            category, literal, ignore_case = rules[i]
+            escaped = re.escape(literal)
+            alternatives.append(f'(?P<r{i}>(?i:{escaped}))' if ignore_case else f'(?P<r{i}>{escaped})')
+        regex = re.compile('(?=(?:' + '|'.join(alternatives) + '))')
+        
+        # Reglas que son prefijo de otra pueden coincidir en la misma posición
+        prefixes = []
+        for i, (_, literal, _) in enumerate(rules):
+            prefixes.append([
+                j for j, (_, other, _) in enumerate(rules)
+                if j != i and len(other) <= len(literal) and literal.lower().startswith(other.lower())
+            ])
+        
+        return regex, rules, prefixes
+    
+    @staticmethod
+    def scan(compiled: Tuple, text: str) -> Dict[str, List[str]]:
+        """🔍 Una pasada sobre el texto devolviendo coincidencias por categoría"""
+        regex, rules, prefixes = compiled
+        hits = {}
+        if regex is None:
+            return hits
+        
+        seen = set()
+        for match in regex.finditer(text):
+            rule_index = int(match.lastgroup[1:])
+            position = match.start()
+            
+            for j in [rule_index] + prefixes[rule_index]:
+                if j in seen:
+                    continue
+                category, literal, ignore_case = rules[j]
+                if j != rule_index:
+                    candidate = text[position:position + len(literal)]
+                    if (candidate.lower() if ignore_case else candidate) != literal:
+                        continue
+                seen.add(j)
+                hits.setdefault(category, []).append(literal)
+        
+        return hits
+    
+    def match_user_agent(self, user_agent: str) -> List[str]:
+        """🤖 User-Agents sospechosos presentes"""
+        return self.scan(self.user_agent_rules, user_agent).get('user_agent', [])
+    
+    def match_request(self, request: str) -> Dict[str, List[str]]:
+        """🌐 Firmas de ataque, honeypots y extensiones presentes en la petición"""
+        return self.scan(self.request_rules, request)
+
+class IPRateWindow:
+    """⏱️ Contadores por cubetas de una IP (minuto y últimas 24 horas)"""
+    __slots__ = ('counts', 'minute_last', 'hour_last', 'max_score', 'max_score_hour', 'last_seen')
+    
+    def __init__(self):
+        # [0:12] peticiones por 5s | [12:36] peticiones por hora | [36:60] sospechosas por hora
+        self.counts = array('I', bytes(4 * 60))
+        self.minute_last = 0
+        self.hour_last = 0
+        self.max_score = 0.0
+        self.max_score_hour = 0
+        self.last_seen = 0.0
+
+class SlidingWindowRateLimiter:
+    """🚦 Limitador en memoria con ventanas deslizantes por IP
+    
+    Cada IP guarda un anillo de 12 cubetas de 5 segundos (último minuto) y
+    dos anillos de 24 cubetas horarias (peticiones y peticiones sospechosas),
+    por lo que registrar y consultar es O(1) amortizado. Las IPs se guardan
+    en orden de actividad: las inactivas se expulsan desde el principio.
+    """
+    MINUTE_BUCKETS = 12
+    MINUTE_WIDTH = 5
+    HOUR_BUCKETS = 24
+    HOUR_WIDTH = 3600
+    HOUR_OFFSETS = (MINUTE_BUCKETS, MINUTE_BUCKETS + HOUR_BUCKETS)
+    
+    def __init__(self, max_ips: int = 100000, idle_seconds: int = 86400):
+        self.max_ips = max_ips
+        self.idle_seconds = idle_seconds
+        self.windows: 'OrderedDict[str, IPRateWindow]' = OrderedDict()
+        self.evictions = 0
+        self.records_since_eviction = 0
+    
+    @staticmethod
+    def advance(counts: array, offsets: Tuple[int, ...], size: int, last: int, current: int) -> int:
+        """Poner a cero las cubetas que han salido de la ventana"""
+        if current <= last:
+            return last
+        for offset in offsets:
+            if current - last >= size:
+                for i in range(offset, offset + size):
+                    counts[i] = 0
+            else:
+                for index in range(last + 1, current + 1):
+                    counts[offset + index % size] = 0
+        return current
+    
+    def refresh(self, window: IPRateWindow, timestamp: float):
+        """Deslizar las ventanas de una IP hasta el instante dado"""
+        counts = window.counts
+        window.minute_last = self.advance(counts, (0,), self.MINUTE_BUCKETS,
+                                          window.minute_last, int(timestamp // self.MINUTE_WIDTH))
+        window.hour_last = self.advance(counts, self.HOUR_OFFSETS, self.HOUR_BUCKETS,
+                                        window.hour_last, int(timestamp // self.HOUR_WIDTH))
+    
+    def record(self, ip: str, suspicious: bool = False, score: float = 0.0, timestamp: Optional[float] = None):
+        """➕ Registrar una petición de una IP"""
+        timestamp = time.time() if timestamp is None else timestamp
+        window = self.windows.get(ip)
+        
+        if window is None:
+            window = IPRateWindow()
+            window.minute_last = int(timestamp // self.MINUTE_WIDTH)
+            window.hour_last = int(timestamp // self.HOUR_WIDTH)
+            self.windows[ip] = window
+        else:
+            self.windows.move_to_end(ip)
+            self.refresh(window, timestamp)
+        
+        minute_index = int(timestamp // self.MINUTE_WIDTH)
+        hour_index = int(timestamp // self.HOUR_WIDTH)
+        counts = window.counts
+        
+        # Eventos antiguos (p.ej. al precargar desde la BD) solo si siguen en la ventana
+        if window.minute_last - minute_index < self.MINUTE_BUCKETS:
+            counts[minute_index % self.MINUTE_BUCKETS] += 1
+        if window.hour_last - hour_index < self.HOUR_BUCKETS:
+            counts[self.MINUTE_BUCKETS + hour_index % self.HOUR_BUCKETS] += 1
+            if suspicious:
+                counts[self.MINUTE_BUCKETS + self.HOUR_BUCKETS + hour_index % self.HOUR_BUCKETS] += 1
+            if score >= window.max_score or window.hour_last - window.max_score_hour >= self.HOUR_BUCKETS:
+                window.max_score = score
+                window.max_score_hour = hour_index
+        
+        window.last_seen = max(window.last_seen, timestamp)
+        
+        # Memoria acotada: expulsión periódica de IPs inactivas y límite duro
+        self.records_since_eviction += 1
+        if self.records_since_eviction >= 10000:
+            self.evict_idle(timestamp)
+        while len(self.windows) > self.max_ips:
+            self.windows.popitem(last=False)
+            self.evictions += 1
+    
+    def requests_last_minute(self, ip: str, timestamp: Optional[float] = None) -> int:
+        """🔢 Peticiones de la IP en los últimos 60 segundos"""
+        window = self.windows.get(ip)
+        if window is None:
+            return 0
+        self.refresh(window, time.time() if timestamp is None else timestamp)
+        return sum(window.counts[:self.MINUTE_BUCKETS])
+    
+    def get_history(self, ip: str, timestamp: Optional[float] = None) -> Dict:
+        """📋 Resumen de las últimas 24 horas de la IP"""
+        window = self.windows.get(ip)
+        if window is None:
+            return {'total_requests': 0, 'suspicious_requests': 0, 'max_threat_score': 0.0}
+        
+        self.refresh(window, time.time() if timestamp is None else timestamp)
+        hours_start = self.MINUTE_BUCKETS
+        suspicious_start = self.MINUTE_BUCKETS + self.HOUR_BUCKETS
+        max_score_valid = window.hour_last - window.max_score_hour < self.HOUR_BUCKETS
+        
+        return {
+            'total_requests': sum(window.counts[hours_start:suspicious_start]),
+            'suspicious_requests': sum(window.counts[suspicious_start:]),
+            'max_threat_score': window.max_score if max_score_valid else 0.0
+        }
+    
+    def evict_idle(self, timestamp: Optional[float] = None):
+        """🧹 Expulsar IPs sin actividad en la ventana más larga"""
+        cutoff = (time.time() if timestamp is None else timestamp) - self.idle_seconds
+        while self.windows:
+            ip, window = next(iter(self.windows.items()))
+            if window.last_seen >= cutoff:
+                break
+            self.windows.popitem(last=False)
+            self.evictions += 1
+        self.records_since_eviction = 0
+    
+    def get_stats(self) -> Dict:
+        """📊 Estado del limitador"""
+        return {
+            'tracked_ips': len(self.windows),
+            'max_ips': self.max_ips,
+            'evictions': self.evictions
+        }
+
+class IPBehaviorWindow:
+    """📈 Comportamiento reciente de una IP en memoria constante"""
+    __slots__ = ('counts', 'minute_last', 'path_bits', 'previous_path_bits', 'path_minute',
+                 'ua_risk', 'geo_risk', 'last_seen')
+    
+    def __init__(self):
+        # [0:12] peticiones por 5s | [12:24] respuestas de error (>= 400) por 5s
+        self.counts = array('I', bytes(4 * 24))
+        self.minute_last = 0
+        self.path_bits = 0  # bitmap de rutas del minuto actual (128 bits)
+        self.previous_path_bits = 0  # y del minuto anterior
+        self.path_minute = 0
+        self.ua_risk = 0.0
+        self.geo_risk = 0.0
+        self.last_seen = 0.0
+
+class IPBehaviorTracker:
+    """🕵️ Características de comportamiento por IP para el predictor de amenazas
+    
+    Mantiene para cada IP, en memoria constante, las entradas documentadas
+    del modelo: [requests_per_minute, unique_paths, error_rate, geo_risk,
+    ua_risk]. Peticiones y errores usan anillos de 12 cubetas de 5 s; las
+    rutas distintas se estiman con un bitmap de 128 bits (linear counting)
+    sobre el minuto actual y el anterior. Todas se normalizan a [0, 1].
+    """
+    MINUTE_BUCKETS = 12
+    MINUTE_WIDTH = 5
+    PATH_BITS = 128
+    PATH_SCALE = 50.0  # rutas distintas a partir de las cuales unique_paths vale 1
+    UA_RISK_ALPHA = 0.3  # peso de la última petición en la media móvil de ua_risk
+    
+    def __init__(self, rate_limit_per_minute: int, max_ips: int = 100000, idle_seconds: int = 3600):
+        self.rate_limit_per_minute = max(1, rate_limit_per_minute)
+        self.max_ips = max_ips
+        self.idle_seconds = idle_seconds
+        self.windows: 'OrderedDict[str, IPBehaviorWindow]' = OrderedDict()
+        self.evictions = 0
+        self.records_since_eviction = 0
+    
+    def record(self, ip: str, path: str, status_code: int, ua_risk: float, geo_risk: float,
+               timestamp: Optional[float] = None) -> List[float]:
+        """➕ Registrar una petición y devolver el vector de características actualizado"""
+        timestamp = time.time() if timestamp is None else timestamp
+        minute_index = int(timestamp // self.MINUTE_WIDTH)
+        window = self.windows.get(ip)
+        
+        if window is None:
+            window = IPBehaviorWindow()
+            window.minute_last = minute_index
+            window.path_minute = int(timestamp // 60)
+            window.ua_risk = ua_risk
+            self.windows[ip] = window
+        else:
+            self.windows.move_to_end(ip)
+            window.minute_last = SlidingWindowRateLimiter.advance(
+                window.counts, (0, self.MINUTE_BUCKETS), self.MINUTE_BUCKETS, window.minute_last, minute_index
+            )
+            window.ua_risk += self.UA_RISK_ALPHA * (ua_risk - window.ua_risk)
+        
+        counts = window.counts
+        if window.minute_last - minute_index < self.MINUTE_BUCKETS:
+            counts[minute_index % self.MINUTE_BUCKETS] += 1
+            if status_code >= 400:
+                counts[self.MINUTE_BUCKETS + minute_index % self.MINUTE_BUCKETS] += 1
+        
+        # Bitmap de rutas: se rota al cambiar de minuto
+        path_minute = int(timestamp // 60)
+        if path_minute > window.path_minute:
+            window.previous_path_bits = window.path_bits if path_minute == window.path_minute + 1 else 0
+            window.path_bits = 0
+            window.path_minute = path_minute
+        window.path_bits |= 1 << (zlib.crc32(path.encode('utf-8', 'replace')) % self.PATH_BITS)
+        
+        window.geo_risk = geo_risk
+        window.last_seen = max(window.last_seen, timestamp)
+        
+        self.records_since_eviction += 1
+        if self.records_since_eviction >= 10000:
+            self.evict_idle(timestamp)
+        while len(self.windows) > self.max_ips:
+            self.windows.popitem(last=False)
+            self.evictions += 1
+        
+        return self.features_of(window)
+    
+    def features_of(self, window: IPBehaviorWindow) -> List[float]:
+        """🔢 [requests_per_minute, unique_paths, error_rate, geo_risk, ua_risk] normalizados"""
+        requests = sum(window.counts[:self.MINUTE_BUCKETS])
+        errors = sum(window.counts[self.MINUTE_BUCKETS:])
+        
+        # Linear counting: n ≈ -m·ln(bits a cero / m)
+        zero_bits = self.PATH_BITS - bin(window.path_bits | window.previous_path_bits).count('1')
+        distinct_paths = -self.PATH_BITS * math.log(max(zero_bits, 1) / self.PATH_BITS)
+        
+        return [
+            min(requests / self.rate_limit_per_minute, 1.0),
+            min(distinct_paths / self.PATH_SCALE, 1.0),
+            errors / requests if requests else 0.0,
+            window.geo_risk,
+            window.ua_risk
+        ]
+    
+    def get_features(self, ip: str) -> Optional[List[float]]:
+        window = self.windows.get(ip)
+        return self.features_of(window) if window is not None else None
+    
+    def evict_idle(self, timestamp: Optional[float] = None):
+        """🧹 Expulsar IPs sin actividad reciente"""
+        cutoff = (time.time() if timestamp is None else timestamp) - self.idle_seconds
+        while self.windows:
+            ip, window = next(iter(self.windows.items()))
+            if window.last_seen >= cutoff:
+                break
+            self.windows.popitem(last=False)
+            self.evictions += 1
+        self.records_since_eviction = 0
+    
+    def get_stats(self) -> Dict:
+        return {
+            'tracked_ips': len(self.windows),
+            'max_ips': self.max_ips,
+            'evictions': self.evictions
+        }
+
+def format_db_timestamp(moment: datetime) -> str:
+    """🕐 Fecha en el formato UTC de CURRENT_TIMESTAMP de SQLite"""
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+class HyperLogLog:
+    """🔢 Estimador HyperLogLog de elementos distintos (IPs únicas en ~2 KB)
+    
+    Con precisión 11 (2048 registros) el error típico ronda el 2,3 %; dos
+    sketches se combinan tomando el máximo de cada registro, de modo que los
+    buckets por minuto/hora/día se suman sin volver a leer los eventos.
+    """
+    
+    HASH_BITS = 64
+    
+    def __init__(self, precision: int = 11, registers: Optional[bytes] = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+    
+    @staticmethod
+    def hash_value(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8', errors='replace'), digest_size=8).digest(), 'big')
+    
+    @staticmethod
+    def hash_int(value: int) -> int:
+        """🔀 Mezcla splitmix64 de un entero (p. ej. una IP empaquetada), sin pasar por texto"""
+        value = (value ^ (value >> 64)) & 0xFFFFFFFFFFFFFFFF
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return value ^ (value >> 31)
+    
+    def add_hash(self, hashed: int):
+        """➕ Añadir un valor ya hasheado (permite reutilizar el hash entre sketches)"""
+        rest_bits = self.HASH_BITS - self.precision
+        index = hashed >> rest_bits
+        rank = rest_bits - (hashed & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def add(self, value: str):
+        self.add_hash(self.hash_value(value))
+    
+    def __len__(self) -> int:
+        return self.count()
+    
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)  # Corrección para cardinalidades bajas
+        return int(round(estimate))
+    
+    def to_bytes(self) -> bytes:
+        return zlib.compress(bytes(self.registers))
+    
+    @classmethod
+    def from_bytes(cls, data: bytes, precision: int = 11) -> 'HyperLogLog':
+        return cls(precision, zlib.decompress(data))
+
+class SpaceSaving:
+    """🏆 Top-k aproximado con memoria fija (algoritmo Space-Saving)
+    
+    Guarda como máximo capacity contadores: un elemento nuevo con la tabla
+    llena sustituye al de menor cuenta y hereda esa cuenta (sobreestimación
+    acotada por total / capacity). Todo elemento más frecuente que eso está
+    siempre en la tabla.
+    """
+    __slots__ = ('capacity', 'counts')
+    
+    def __init__(self, capacity: int = 100):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+    
+    def add(self, item: str, count: int = 1):
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+        elif len(counts) < self.capacity:
+            counts[item] = count
+        else:
+            victim = min(counts, key=counts.__getitem__)
+            counts[item] = counts.pop(victim) + count
+
+class MetricsShard:
+    """📦 Contadores de un hilo: solo él los escribe"""
+    __slots__ = ('total', 'blocked', 'unique_ips', 'countries', 'patterns',
+                 'minutes', 'minute_last', 'hours', 'hour_last')
+    
+    def __init__(self, top_k: int, hour_buckets: int):
+        self.total = 0
+        self.blocked = 0
+        self.unique_ips = HyperLogLog()
+        self.countries = SpaceSaving(top_k)
+        self.patterns = SpaceSaving(top_k)
+        # [0:N] peticiones por cubeta | [N:2N] bloqueadas por cubeta
+        self.minutes = array('q', bytes(8 * 2 * RealTimeMetrics.MINUTE_BUCKETS))
+        self.minute_last = -1
+        self.hours = array('q', bytes(8 * 2 * hour_buckets))
+        self.hour_last = -1
+
+class RealTimeMetrics:
+    """📊 Métricas en tiempo real con memoria constante y sin locks al escribir
+    
+    Cada hilo escribe en su propio fragmento (threading.local): totales, un
+    HyperLogLog de IPs, top-k Space-Saving de países y patrones de ataque y
+    anillos de cubetas enteras (60 minutos y N horas) que se reciclan con
+    SlidingWindowRateLimiter.advance. Las lecturas combinan copias de todos
+    los fragmentos, así que ningún contador crece con el tiempo de ejecución
+    ni con el número de IPs, países o patrones distintos.
+    """
+    MINUTE_BUCKETS = 60
+    
+    def __init__(self, top_k: int = 100, hour_buckets: int = 48):
+        self.top_k = top_k
+        self.hour_buckets = hour_buckets
+        self.local = threading.local()
+        self.shards: List[MetricsShard] = []
+        self.shards_lock = threading.Lock()  # solo al registrar un hilo nuevo
+    
+    def shard(self) -> MetricsShard:
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = MetricsShard(self.top_k, self.hour_buckets)
+            with self.shards_lock:
+                self.shards = self.shards + [shard]  # lista nueva: los lectores iteran sin lock
+        return shard
+    
+    @staticmethod
+    def add_to_ring(counts: array, size: int, last: int, bucket: int, blocked: bool) -> int:
+        if bucket > last:
+            last = SlidingWindowRateLimiter.advance(counts, (0, size), size, last, bucket)
+        elif bucket <= last - size:
+            return last  # más antiguo que la ventana
+        slot = bucket % size
+        counts[slot] += 1
+        if blocked:
+            counts[size + slot] += 1
+        return last
+    
+    def record(self, epoch: float, ip_hash: int, blocked: bool, country: str, threat_type: str):
+        """➕ Contar un evento en el fragmento del hilo actual"""
+        shard = self.shard()
+        shard.total += 1
+        shard.unique_ips.add_hash(ip_hash)
+        if blocked:
+            shard.blocked += 1
+            shard.countries.add(country)
+            shard.patterns.add(threat_type)
+        
+        minute = int(epoch // 60)
+        shard.minute_last = self.add_to_ring(shard.minutes, self.MINUTE_BUCKETS, shard.minute_last, minute, blocked)
+        shard.hour_last = self.add_to_ring(shard.hours, self.hour_buckets, shard.hour_last, minute // 60, blocked)
+    
+    def ring_window(self, ring: str, width: int, now: Optional[float] = None) -> List[Tuple[int, int, int]]:
+        """🕐 (inicio epoch, peticiones, bloqueadas) de cada cubeta de la ventana, combinando fragmentos"""
+        size = self.MINUTE_BUCKETS if ring == 'minutes' else self.hour_buckets
+        current = int((time.time() if now is None else now) // width)
+        first = current - size + 1
+        totals = [0] * size
+        blocked = [0] * size
+        
+        for shard in self.shards:
+            last = getattr(shard, 'minute_last' if ring == 'minutes' else 'hour_last')
+            counts = getattr(shard, ring).tolist()
+            # Solo valen las cubetas que el fragmento ya ha reciclado hasta su último instante
+            for bucket in range(max(first, last - size + 1), min(current, last) + 1):
+                slot = bucket % size
+                totals[bucket - first] += counts[slot]
+                blocked[bucket - first] += counts[size + slot]
+        
+        return [((first + i) * width, totals[i], blocked[i]) for i in range(size)]
+    
+    def merged(self) -> Dict:
+        """🔗 Totales, IPs únicas y top-k combinados de todos los fragmentos"""
+        unique_ips = HyperLogLog()
+        countries, patterns = Counter(), Counter()
+        total = blocked = 0
+        for shard in self.shards:
+            total += shard.total
+            blocked += shard.blocked
+            unique_ips.merge(HyperLogLog(registers=bytes(shard.unique_ips.registers)))
+            countries.update(shard.countries.counts.copy())
+            patterns.update(shard.patterns.counts.copy())
+        
+        return {
+            'total_requests': total,
+            'blocked_requests': blocked,
+            'unique_ips': unique_ips,
+            'threat_countries': Counter(dict(countries.most_common(self.top_k))),
+            'attack_patterns': Counter(dict(patterns.most_common(self.top_k)))
+        }
+    
+    def snapshot(self) -> Dict:
+        """📋 Vista con el formato clásico de engine.stats (hourly_stats solo de la ventana)"""
+        merged = self.merged()
+        merged['hourly_stats'] = {
+            format_db_timestamp(datetime.fromtimestamp(start, timezone.utc)): count
+            for start, count, _ in self.ring_window('hours', 3600) if count
+        }
+        return merged
+    
+    def get_stats(self) -> Dict:
+        merged = self.merged()
+        minutes = self.ring_window('minutes', 60)
+        return {
+            'shards': len(self.shards),
+            'total_requests': merged['total_requests'],
+            'blocked_requests': merged['blocked_requests'],
+            'unique_ips': merged['unique_ips'].count(),
+            'requests_last_minute': minutes[-1][1],
+            'requests_last_hour': sum(count for _, count, _ in minutes),
+            'blocked_last_hour': sum(blocked for _, _, blocked in minutes),
+            'top_threat_countries': merged['threat_countries'].most_common(5),
+            'top_attack_patterns': merged['attack_patterns'].most_common(5)
+        }
+
+class LatencyHistogram:
+    """⏱️ Histograma de latencias con cubetas fijas (las de Prometheus, en segundos)
+    
+    Cada histograma tiene un único escritor (el bucle de eventos o el hilo
+    del sink), así que observe() no necesita lock.
+    """
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+              0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    __slots__ = ('counts', 'count', 'sum')
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # la última cubeta es +Inf
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+    
+    def drain(self) -> Tuple[List[int], int, float]:
+        """📤 Entregar lo acumulado y empezar de cero (para sumarlo en otro proceso)"""
+        snapshot = (self.counts, self.count, self.sum)
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        return snapshot
+    
+    def merge(self, snapshot: Tuple[List[int], int, float]):
+        """➕ Sumar lo entregado por drain()"""
+        counts, count, total = snapshot
+        for i, value in enumerate(counts):
+            self.counts[i] += value
+        self.count += count
+        self.sum += total
+    
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """📈 (le, cuenta acumulada) en el formato de las series _bucket"""
+        total = 0
+        buckets = []
+        for bound, count in zip(self.BOUNDS + (float('inf'),), list(self.counts)):
+            total += count
+            buckets.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return buckets
+    
+    def quantile(self, q: float) -> float:
+        """📐 Límite superior de la cubeta que contiene el cuantil q"""
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return self.BOUNDS[-1]
+    
+    def get_stats(self) -> Dict:
+        count = self.count
+        return {
+            'count': count,
+            'avg_ms': round(self.sum / count * 1000, 3) if count else 0.0,
+            'p50_ms': self.quantile(0.5) * 1000 if count else 0.0,
+            'p99_ms': self.quantile(0.99) * 1000 if count else 0.0
+        }
+
+class StageTracer:
+    """🔬 Trazado opcional por etapa del camino línea a línea
+    
+    Desactivado (por defecto), cada punto de medida cuesta una comprobación
+    de atributo. Activado, cada etapa suma su duración (perf_counter,
+    monótono) a su histograma y una fracción sample_rate de las líneas guarda
+    además su traza completa en un anillo con las últimas max_traces.
+    """
+    
+    def __init__(self, enabled: bool = False, sample_rate: float = 0.001, max_traces: int = 200,
+                 logger: Optional[logging.Logger] = None):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.traces = deque(maxlen=max_traces)
+        self.current: Optional[Dict[str, float]] = None  # etapas de la línea muestreada en curso
+        self.current_started = 0.0
+        self.sampled = 0
+        self.logger = logger or logging.getLogger('IvorySecurityEngine')
+    
+    def configure(self, enabled: bool, sample_rate: Optional[float] = None):
+        self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        self.current = None
+    
+    def begin(self) -> bool:
+        """▶️ Empezar una línea y decidir si se muestrea su traza"""
+        if random.random() < self.sample_rate:
+            self.current = {}
+            self.current_started = time.perf_counter()
+        else:
+            self.current = None
+        return True
+    
+    def span(self, stage: str, started: float) -> float:
+        """⏱️ Cerrar una etapa iniciada en started; devuelve el instante actual para encadenar"""
+        now = time.perf_counter()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.observe(now - started)
+        if self.current is not None:
+            self.current[stage] = round((now - started) * 1000, 3)
+        return now
+    
+    def end(self, event: Optional['SecurityEvent']):
+        """⏹️ Terminar la línea: guardar su traza si estaba muestreada"""
+        if self.current is None:
+            return
+        trace = {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+            'ip': event.ip if event else None,
+            'threat_level': event.threat_level.value if event else None,
+            'total_ms': round((time.perf_counter() - self.current_started) * 1000, 3),
+            'stages_ms': self.current
+        }
+        self.current = None
+        self.traces.append(trace)
+        self.sampled += 1
+        self.logger.debug(f"🔬 Traza: {json.dumps(trace)}")
+    
+    def get_stats(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'sampled_traces': self.sampled,
+            'stages': {stage: histogram.get_stats() for stage, histogram in sorted(self.histograms.items())}
+        }
+
+class RollupAggregator:
+    """📈 Agregados incrementales por minuto, hora y día
+    
+    Se alimenta con las filas que se escriben en security_events y acumula en
+    memoria totales, bloqueos, suma de puntuaciones, un HyperLogLog de IPs y
+    contadores por país/tipo de amenaza. flush() los suma a las tablas
+    rollup_* con UPSERT, así los reportes leen unas pocas filas agregadas.
+    """
+    
+    # (granularidad, longitud del prefijo de la fecha, sufijo del bucket)
+    GRANULARITIES = (('minute', 16, ':00'), ('hour', 13, ':00:00'), ('day', 10, ''))
+    THREAT_LEVELS = ('HIGH', 'CRITICAL')
+    
+    def __init__(self):
+        # En memoria solo se acumula por minuto; horas y días se derivan al volcar
+        self.pending: Dict[str, list] = {}
+    
+    @staticmethod
+    def new_bucket() -> list:
+        return [0, 0, 0.0, HyperLogLog(), Counter(), Counter()]
+    
+    def add_rows(self, rows: List[Tuple]):
+        """➕ Acumular filas con el formato de SecurityEventSink.to_row"""
+        for timestamp, ip, country, _, _, _, threat_type, threat_level, blocked, ml_score in rows:
+            minute = timestamp[:16] + ':00'
+            bucket = self.pending.get(minute)
+            if bucket is None:
+                bucket = self.pending[minute] = self.new_bucket()
+            bucket[0] += 1
+            bucket[1] += 1 if blocked else 0
+            bucket[2] += ml_score or 0.0
+            bucket[3].add_hash(HyperLogLog.hash_value(ip))
+            if threat_level in self.THREAT_LEVELS:
+                bucket[4][country] += 1
+            bucket[5][threat_type] += 1
+    
+    def expand_pending(self) -> Dict[Tuple[str, str], list]:
+        """🧮 Combinar los minutos pendientes en sus horas y días"""
+        expanded = {}
+        for minute, (total, blocked, score_sum, sketch, countries, types) in self.pending.items():
+            for granularity, length, suffix in self.GRANULARITIES:
+                key = (granularity, minute[:length] + suffix)
+                bucket = expanded.get(key)
+                if bucket is None:
+                    bucket = expanded[key] = self.new_bucket()
+                bucket[0] += total
+                bucket[1] += blocked
+                bucket[2] += score_sum
+                bucket[3].merge(sketch)
+                bucket[4].update(countries)
+                bucket[5].update(types)
+        return expanded
+    
+    def flush(self, conn: sqlite3.Connection):
+        """💾 Sumar lo acumulado a las tablas rollup_* en una transacción"""
+        if not self.pending:
+            return
+        
+        with conn:
+            self.write(conn)
+        self.pending.clear()
+    
+    def write(self, conn: sqlite3.Connection):
+        """💾 Sumar lo acumulado a las tablas rollup_* dentro de la transacción en curso"""
+        for (granularity, bucket), (total, blocked, score_sum, sketch, countries, types) in self.expand_pending().items():
+            table = f'rollup_{granularity}'
+            existing = conn.execute(f'SELECT ip_sketch FROM {table} WHERE bucket = ?', (bucket,)).fetchone()
+            if existing and existing[0]:
+                sketch.merge(HyperLogLog.from_bytes(existing[0]))
+            
+            conn.execute(f'''
+                INSERT INTO {table} (bucket, total, blocked, score_sum, ip_sketch)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(bucket) DO UPDATE SET
+                    total = total + excluded.total,
+                    blocked = blocked + excluded.blocked,
+                    score_sum = score_sum + excluded.score_sum,
+                    ip_sketch = excluded.ip_sketch
+            ''', (bucket, total, blocked, score_sum, sketch.to_bytes()))
+            
+            conn.executemany('''
+                INSERT INTO rollup_dimensions (granularity, bucket, dimension, value, count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(granularity, bucket, dimension, value) DO UPDATE SET
+                    count = count + excluded.count
+            ''', [(granularity, bucket, 'threat_country', value, count) for value, count in countries.items()] +
+                 [(granularity, bucket, 'threat_type', value, count) for value, count in types.items()])
+
+def new_rollup_window() -> Dict:
+    return {'total': 0, 'blocked': 0, 'score_sum': 0.0, 'sketch': HyperLogLog(),
+            'threat_country': Counter(), 'threat_type': Counter()}
+
+def add_rollup_rows(window: Dict, rows, dimension_rows):
+    """➕ Sumar filas (total, blocked, score_sum, ip_sketch) y (dimensión, valor, cuenta) a una ventana"""
+    for total, blocked, score_sum, ip_sketch in rows:
+        window['total'] += total
+        window['blocked'] += blocked
+        window['score_sum'] += score_sum
+        if ip_sketch:
+            window['sketch'].merge(HyperLogLog.from_bytes(ip_sketch))
+    for dimension, value, count in dimension_rows:
+        window[dimension][value] += count
+
+def finish_rollup_window(window: Dict) -> Dict:
+    window['unique_ips'] = window.pop('sketch').count() if window['total'] else 0
+    return window
+
+def read_rollup_window(conn: sqlite3.Connection, since: datetime) -> Dict:
+    """📊 Agregar una ventana [since, ahora] desde los rollups
+    
+    El tramo inicial hasta la siguiente hora completa se lee por minutos y el
+    resto por horas: como máximo 60 + N filas, sin tocar security_events.
+    """
+    since = since.astimezone(timezone.utc).replace(second=0, microsecond=0)
+    first_hour = since.replace(minute=0) + (timedelta(hours=1) if since.minute else timedelta(0))
+    minute_range = (format_db_timestamp(since), format_db_timestamp(first_hour))
+    hour_start = format_db_timestamp(first_hour)
+    
+    window = new_rollup_window()
+    add_rollup_rows(window, conn.execute('''
+        SELECT total, blocked, score_sum, ip_sketch FROM rollup_minute WHERE bucket >= ? AND bucket < ?
+        UNION ALL
+        SELECT total, blocked, score_sum, ip_sketch FROM rollup_hour WHERE bucket >= ?
+    ''', (*minute_range, hour_start)), conn.execute('''
+        SELECT dimension, value, SUM(count) FROM rollup_dimensions
+        WHERE granularity = 'minute' AND bucket >= ? AND bucket < ? GROUP BY dimension, value
+        UNION ALL
+        SELECT dimension, value, SUM(count) FROM rollup_dimensions
+        WHERE granularity = 'hour' AND bucket >= ? GROUP BY dimension, value
+    ''', (*minute_range, hour_start)))
+    
+    return finish_rollup_window(window)
+
+def read_hour_rollups(conn: sqlite3.Connection, day: str) -> Tuple[List[Tuple], List[Tuple]]:
+    """📊 Rollups por hora de un día ('AAAA-MM-DD') y sus dimensiones"""
+    bounds = (day, next_day(day))
+    rows = conn.execute(
+        'SELECT bucket, total, blocked, score_sum, ip_sketch FROM rollup_hour WHERE bucket >= ? AND bucket < ?',
+        bounds
+    ).fetchall()
+    dimension_rows = conn.execute('''
+        SELECT bucket, dimension, value, count FROM rollup_dimensions
+        WHERE granularity = 'hour' AND bucket >= ? AND bucket < ?
+    ''', bounds).fetchall()
+    return rows, dimension_rows
+
+def write_hourly_stats(conn: sqlite3.Connection, hour_keys: Iterable[str]):
+    """📊 (Re)calcular hourly_stats de esas horas a partir de rollup_hour
+    
+    rollup_hour ya suma todo lo escrito en la hora (directo y backfill) y su
+    HyperLogLog combina las IPs, así que reescribir la fila es idempotente.
+    """
+    rows = []
+    for hour_key in hour_keys:
+        rollup = conn.execute(
+            'SELECT total, blocked, score_sum, ip_sketch FROM rollup_hour WHERE bucket = ?', (hour_key,)
+        ).fetchone()
+        if not rollup:
+            continue
+        
+        top_country = conn.execute('''
+            SELECT value FROM rollup_dimensions 
+            WHERE granularity = 'hour' AND bucket = ? AND dimension = 'threat_country'
+            ORDER BY count DESC LIMIT 1
+        ''', (hour_key,)).fetchone()
+        
+        total, blocked, score_sum, ip_sketch = rollup
+        rows.append((
+            hour_key, total, blocked,
+            HyperLogLog.from_bytes(ip_sketch).count() if ip_sketch else 0,
+            top_country[0] if top_country else None,
+            score_sum / total if total else 0.0
+        ))
+    
+    conn.executemany('''
+        INSERT OR REPLACE INTO hourly_stats 
+        (hour_timestamp, total_requests, blocked_requests, unique_ips, 
+         top_threat_country, avg_threat_score)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def next_day(day: str) -> str:
+    return (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+class EventPartitions:
+    """🗂️ security_events particionada por día (UTC): una tabla security_events_pAAAAMMDD por día
+    
+    Las consultas por rango de tiempo solo recorren las particiones de esos
+    días y la retención elimina particiones completas con DROP TABLE en
+    lugar de borrar filas con DELETE. La vista security_events (UNION ALL
+    de las particiones) mantiene las consultas ad hoc y herramientas externas.
+    """
+    PREFIX = 'security_events_p'
+    COLUMNS = ('timestamp, ip, country, user_agent, request_path, response_code, '
+               'threat_type, threat_level, blocked, ml_score')
+    MAX_VIEW_PARTITIONS = 500  # límite de SQLite para SELECT compuestos
+    
+    def __init__(self):
+        self.known: Set[str] = set()
+    
+    @classmethod
+    def name_for(cls, day: str) -> str:
+        """'2025-06-23' -> security_events_p20250623"""
+        return cls.PREFIX + day.replace('-', '')
+    
+    @classmethod
+    def day_of(cls, name: str) -> str:
+        digits = name[len(cls.PREFIX):]
+        return f'{digits[:4]}-{digits[4:6]}-{digits[6:]}'
+    
+    @classmethod
+    def list(cls, conn: sqlite3.Connection) -> List[str]:
+        """📋 Particiones existentes, de la más antigua a la más nueva"""
+        return [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ? ORDER BY name",
+            (cls.PREFIX + '[0-9]*',)
+        )]
+    
+    def ensure(self, conn: sqlite3.Connection, day: str) -> str:
+        """🧱 Crear (si falta) la partición de un día con sus índices"""
+        name = self.name_for(day)
+        if name in self.known:
+            return name
+        
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (name,)).fetchone()
+        if not exists:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {name} (
+                    id INTEGER PRIMARY KEY,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    ip TEXT NOT NULL,
+                    country TEXT,
+                    user_agent TEXT,
+                    request_path TEXT,
+                    response_code INTEGER,
+                    threat_type TEXT,
+                    threat_level TEXT,
+                    blocked BOOLEAN DEFAULT FALSE,
+                    ml_score REAL
+                )
+            ''')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_ip_timestamp ON {name}(ip, timestamp)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_timestamp ON {name}(timestamp)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_threat_level ON {name}(threat_level)')
+            self.refresh_view(conn)
+        
+        self.known.add(name)
+        return name
+    
+    @classmethod
+    def refresh_view(cls, conn: sqlite3.Connection):
+        """🔭 Rehacer la vista security_events sobre las particiones actuales"""
+        legacy = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'security_events'"
+        ).fetchone()
+        if legacy:
+            return  # la migración crea la vista al retirar la tabla antigua
+        
+        names = cls.list(conn)[-cls.MAX_VIEW_PARTITIONS:]
+        conn.execute('DROP VIEW IF EXISTS security_events')
+        if names:
+            conn.execute('CREATE VIEW security_events AS ' + ' UNION ALL '.join(
+                f'SELECT id, {cls.COLUMNS} FROM {name}' for name in names
+            ))
+    
+    def insert_rows(self, conn: sqlite3.Connection, rows: List[Tuple]):
+        """💾 Insertar filas (formato SecurityEventSink.to_row) en la partición de su día"""
+        by_day = defaultdict(list)
+        for row in rows:
+            by_day[row[0][:10]].append(row)
+        
+        for day, day_rows in by_day.items():
+            name = self.ensure(conn, day)
+            conn.executemany(f'INSERT INTO {name} ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', day_rows)
+    
+    @classmethod
+    def for_range(cls, conn: sqlite3.Connection, since: datetime, until: Optional[datetime] = None) -> List[str]:
+        """🧭 Particiones que contienen el rango [since, until)"""
+        first_day = format_db_timestamp(since)[:10]
+        last_day = format_db_timestamp(until)[:10] if until is not None else '9999-12-31'
+        return [name for name in cls.list(conn) if first_day <= cls.day_of(name) <= last_day]
+    
+    @classmethod
+    def select(cls, conn: sqlite3.Connection, columns: str, since: datetime, until: Optional[datetime] = None,
+               order_by_time: bool = False):
+        """🔍 Filas del rango leyendo solo sus particiones (en orden de día si order_by_time)"""
+        bounds = 'timestamp >= ?' + (' AND timestamp < ?' if until is not None else '')
+        params = (format_db_timestamp(since),) + ((format_db_timestamp(until),) if until is not None else ())
+        order = ' ORDER BY timestamp' if order_by_time else ''
+        
+        for name in cls.for_range(conn, since, until):
+            yield from conn.execute(f'SELECT {columns} FROM {name} WHERE {bounds}{order}', params)
+    
+    @classmethod
+    def drop_before(cls, conn: sqlite3.Connection, cutoff_day: str) -> List[str]:
+        """🧹 Eliminar las particiones de días anteriores a cutoff_day ('AAAA-MM-DD')"""
+        expired = [name for name in cls.list(conn) if cls.day_of(name) < cutoff_day]
+        if expired:
+            with conn:
+                for name in expired:
+                    conn.execute(f'DROP TABLE IF EXISTS {name}')
+                cls.refresh_view(conn)
+        return expired
+    
+    def migrate_legacy(self, conn: sqlite3.Connection) -> int:
+        """📦 Repartir por días la antigua tabla única security_events y sustituirla por la vista"""
+        legacy = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'security_events'"
+        ).fetchone()
+        if not legacy:
+            return 0
+        
+        moved = 0
+        with conn:
+            days = [day for (day,) in conn.execute(
+                'SELECT DISTINCT substr(timestamp, 1, 10) FROM security_events WHERE timestamp IS NOT NULL'
+            )]
+            for day in days:
+                name = self.ensure(conn, day)
+                moved += conn.execute(f'''
+                    INSERT INTO {name} ({self.COLUMNS})
+                    SELECT {self.COLUMNS} FROM security_events WHERE substr(timestamp, 1, 10) = ?
+                ''', (day,)).rowcount
+            conn.execute('DROP TABLE security_events')
+            self.refresh_view(conn)
+        return moved
+
+def import_pyarrow():
+    """📦 pyarrow es opcional: solo lo necesitan el archivo columnar y su lectura"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("El archivo columnar requiere pyarrow (pip install pyarrow)") from e
+    return pa, pq
+
+class ColumnarArchive:
+    """🧊 Archivo columnar (Parquet) de eventos y rollups, un fichero por día
+    
+    Cada partición diaria de security_events se vuelca en streaming, por lotes
+    de batch_rows filas, a <dir>/events/AAAA-MM-DD.parquet: la memoria no
+    depende del tamaño del día. country, user_agent, threat_type y
+    threat_level van codificadas como diccionario. Junto a los eventos se
+    guardan los rollups por hora del día (con el sketch de IPs) y sus
+    dimensiones, que son la ruta rápida de los reportes históricos: unas
+    decenas de filas por día en lugar de todos los eventos. Todos los
+    ficheros de una tabla comparten esquema, así que el directorio se puede
+    abrir directamente con pyarrow.dataset, DuckDB o pandas.
+    
+    Un día exportado cuando ya estaba cerrado recibe además una marca en
+    <dir>/complete/AAAA-MM-DD.json; sin ella (exportado en curso) el día se
+    vuelve a exportar en cuanto se cierra.
+    """
+    TABLES = ('events', 'rollup_hour', 'rollup_dimensions')
+    
+    def __init__(self, archive_dir: str, batch_rows: int = 50000):
+        self.archive_dir = archive_dir
+        self.batch_rows = batch_rows
+    
+    @staticmethod
+    def schemas(pa) -> Dict:
+        text = pa.dictionary(pa.int32(), pa.string())
+        moment = pa.timestamp('s', tz='UTC')
+        return {
+            'events': pa.schema([
+                ('id', pa.int64()), ('timestamp', moment), ('ip', pa.string()), ('country', text),
+                ('user_agent', text), ('request_path', pa.string()), ('response_code', pa.int32()),
+                ('threat_type', text), ('threat_level', text), ('blocked', pa.bool_()), ('ml_score', pa.float64())
+            ]),
+            'rollup_hour': pa.schema([
+                ('bucket', moment), ('total', pa.int64()), ('blocked', pa.int64()),
+                ('score_sum', pa.float64()), ('ip_sketch', pa.binary())
+            ]),
+            'rollup_dimensions': pa.schema([
+                ('bucket', moment), ('dimension', text), ('value', text), ('count', pa.int64())
+            ])
+        }
+    
+    def path_for(self, table: str, day: str) -> str:
+        return os.path.join(self.archive_dir, table, f'{day}.parquet')
+    
+    def archived_days(self) -> List[str]:
+        """📋 Días con todos sus ficheros archivados"""
+        directory = os.path.join(self.archive_dir, 'rollup_hour')
+        if not os.path.isdir(directory):
+            return []
+        days = (name[:-len('.parquet')] for name in os.listdir(directory) if name.endswith('.parquet'))
+        return sorted(day for day in days if self.is_archived(day))
+    
+    def is_archived(self, day: str) -> bool:
+        return all(os.path.exists(self.path_for(table, day)) for table in self.TABLES)
+    
+    def marker_path(self, day: str) -> str:
+        return os.path.join(self.archive_dir, 'complete', f'{day}.json')
+    
+    def is_complete(self, day: str) -> bool:
+        """✅ Archivado después de cerrarse el día (no le faltan eventos)"""
+        return self.is_archived(day) and os.path.exists(self.marker_path(day))
+    
+    def mark_complete(self, day: str, counts: Dict):
+        """✅ Marcar un día cerrado como archivado por completo"""
+        path = self.marker_path(day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + '.tmp'
+        with open(partial, 'w') as f:
+            json.dump({'exported_at': format_db_timestamp(datetime.now(timezone.utc)), 'counts': counts}, f)
+        os.replace(partial, path)
+    
+    @staticmethod
+    def to_array(pa, values, field):
+        """🔄 Columna de SQLite -> array de Arrow del tipo del esquema"""
+        if pa.types.is_dictionary(field.type):
+            return pa.array(values, pa.string()).dictionary_encode()
+        if pa.types.is_timestamp(field.type):
+            # Texto UTC sin zona de SQLite -> timestamp sin zona -> UTC
+            return pa.array(values, pa.string()).cast(pa.timestamp('s')).cast(field.type)
+        if pa.types.is_boolean(field.type):
+            return pa.array(values, pa.int8()).cast(field.type)
+        return pa.array(values, field.type)
+    
+    def write_table(self, table: str, day: str, rows) -> int:
+        """💾 Volcar filas (cursor o lista) a Parquet por lotes; el fichero aparece completo o no aparece"""
+        pa, pq = import_pyarrow()
+        schema = self.schemas(pa)[table]
+        path = self.path_for(table, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        rows = iter(rows)
+        written = 0
+        partial = path + '.tmp'
+        try:
+            with pq.ParquetWriter(partial, schema, compression='zstd') as writer:
+                while True:
+                    chunk = list(itertools.islice(rows, self.batch_rows))
+                    if not chunk:
+                        break
+                    arrays = [self.to_array(pa, values, field) for values, field in zip(zip(*chunk), schema)]
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                    written += len(chunk)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        return written
+    
+    def export_day(self, conn: sqlite3.Connection, day: str, complete: bool = False) -> Dict:
+        """🧊 Archivar un día: su partición de eventos, sus rollups por hora y sus dimensiones
+        
+        complete indica que el día ya estaba cerrado al exportarlo.
+        """
+        partition = EventPartitions.name_for(day)
+        events = conn.execute(f'SELECT id, {EventPartitions.COLUMNS} FROM {partition} ORDER BY id')
+        rollups, dimensions = read_hour_rollups(conn, day)
+        
+        # Los eventos primero: is_archived() solo es cierto cuando existen los tres ficheros
+        counts = {'events': self.write_table('events', day, events)}
+        counts['rollup_dimensions'] = self.write_table('rollup_dimensions', day, dimensions)
+        counts['rollup_hour'] = self.write_table('rollup_hour', day, rollups)
+        if complete:
+            self.mark_complete(day, counts)  # la marca al final: solo si los tres ficheros están escritos
+        return counts
+    
+    def read_day_window(self, day: str, window: Dict):
+        """📊 Sumar a una ventana los rollups archivados de un día"""
+        _, pq = import_pyarrow()
+        rollups = pq.read_table(self.path_for('rollup_hour', day),
+                                columns=['total', 'blocked', 'score_sum', 'ip_sketch']).to_pydict()
+        dimensions = pq.read_table(self.path_for('rollup_dimensions', day),
+                                   columns=['dimension', 'value', 'count']).to_pydict()
+        add_rollup_rows(window, zip(*rollups.values()), zip(*dimensions.values()))
+
+class SecurityEventSink:
+    """💾 Escritura diferida (write-behind) de eventos en SQLite
+    
+    Los eventos se encolan como tuplas y un hilo dedicado, con una única
+    conexión en modo WAL, los inserta con executemany en una transacción
+    por lote (al llegar a batch_size o al vencer flush_interval). El mismo
+    hilo mantiene los rollups, que se vuelcan cada rollup_interval segundos.
+    
+    Encolar nunca bloquea al bucle de eventos: con la cola llena el evento
+    se descarta y se cuenta. Un lote que falla (p. ej. "database is locked"
+    durante un backfill) se conserva y se reintenta con espera creciente.
+    """
+    FLUSH = object()
+    STOP = object()
+    
+    def __init__(self, db_path: str, batch_size: int = 500, flush_interval: float = 1.0,
+                 max_queue: int = 100000, logger: Optional[logging.Logger] = None,
+                 rollup_interval: float = 5.0, latency: Optional[LatencyHistogram] = None):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        self.rollups = RollupAggregator()
+        self.partitions = EventPartitions()
+        self.max_queue = max_queue
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.logger = logger or logging.getLogger('IvorySecurityEngine')
+        self.thread = None
+        self.lock = threading.Lock()
+        self.latency = latency or LatencyHistogram()
+        self.stats = {
+            'events_written': 0,
+            'flushes': 0,
+            'errors': 0,
+            'retries': 0,
+            'dropped': 0,
+            'rollup_flushes': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0
+        }
+    
+    def start(self):
+        """🚀 Arrancar el hilo escritor (una sola vez)"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='IvoryEventSink', daemon=True)
+                self.thread.start()
+    
+    @staticmethod
+    def to_row(event: 'SecurityEvent') -> Tuple:
+        return (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(event.epoch)), event.ip, event.country, event.user_agent,
+            event.request_path, event.response_code, event.threat_type,
+            event.threat_level.value, event.blocked, event.ml_score
+        )
+    
+    def submit(self, event: 'SecurityEvent'):
+        """➕ Encolar un evento (se copia su estado actual)"""
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(self.to_row(event))
+        except queue.Full:
+            self.count_dropped(1)
+    
+    def count_dropped(self, count: int):
+        if self.stats['dropped'] % 10000 == 0:
+            self.logger.warning(f"⚠️ Cola de eventos llena: {count} eventos descartados "
+                                f"({self.stats['dropped'] + count} en total)")
+        self.stats['dropped'] += count
+    
+    def submit_many(self, events: List['SecurityEvent']):
+        """➕ Encolar varios eventos"""
+        for event in events:
+            self.submit(event)
+    
+    def flush(self, timeout: Optional[float] = None):
+        """⏬ Forzar la escritura de todo lo encolado y esperar"""
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put((self.FLUSH, done))
+        done.wait(timeout)
+    
+    def close(self):
+        """🔒 Escribir lo pendiente y detener el hilo"""
+        if self.thread is None:
+            return
+        self.queue.put((self.STOP, None))
+        self.thread.join()
+        self.thread = None
+    
+    def run(self):
+        """🔄 Bucle del hilo escritor"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        rollup_deadline = time.monotonic() + self.rollup_interval
+        retry_at = 0.0  # tras un fallo no se reintenta antes de este instante
+        failures = 0
+        
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            
+            control = item[0] if item is not None and item[0] in (self.FLUSH, self.STOP) else None
+            if item is not None and control is None:
+                pending.append(item)
+            
+            due = control is not None or len(pending) >= self.batch_size or time.monotonic() >= deadline
+            if due and (control is not None or time.monotonic() >= retry_at):
+                if self.write_batch(conn, pending):
+                    pending = []
+                    failures = 0
+                else:
+                    # Conservar el lote (acotado por max_queue) y reintentar más tarde
+                    failures += 1
+                    self.stats['retries'] += 1
+                    retry_at = time.monotonic() + min(self.flush_interval * 2 ** failures, 30.0)
+                    if len(pending) > self.max_queue:
+                        self.count_dropped(len(pending) - self.max_queue)
+                        pending = pending[-self.max_queue:]
+                deadline = time.monotonic() + self.flush_interval
+            
+            if control is not None or time.monotonic() >= rollup_deadline:
+                self.flush_rollups(conn)
+                rollup_deadline = time.monotonic() + self.rollup_interval
+            
+            if control is self.FLUSH:
+                item[1].set()
+            elif control is self.STOP:
+                if pending:
+                    self.logger.error(f"❌ {len(pending)} eventos sin escribir al cerrar")
+                break
+        
+        conn.close()
+    
+    def write_batch(self, conn: sqlite3.Connection, rows: List[Tuple]) -> bool:
+        """💾 Insertar un lote en una sola transacción (False si falla: se revierte entero)"""
+        if not rows:
+            return True
+        
+        started = time.perf_counter()
+        written = False
+        try:
+            with conn:
+                self.partitions.insert_rows(conn, rows)
+            self.stats['events_written'] += len(rows)
+            self.rollups.add_rows(rows)
+            written = True
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"❌ Error escribiendo {len(rows)} eventos (se reintentará): {e}")
+        
+        elapsed = time.perf_counter() - started
+        self.latency.observe(elapsed)
+        elapsed_ms = elapsed * 1000
+        self.stats['flushes'] += 1
+        self.stats['last_flush_ms'] = elapsed_ms
+        self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed_ms)
+        self.stats['total_flush_ms'] += elapsed_ms
+        return written
+    
+    def flush_rollups(self, conn: sqlite3.Connection):
+        """📈 Volcar los rollups acumulados"""
+        try:
+            self.rollups.flush(conn)
+            self.stats['rollup_flushes'] += 1
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"❌ Error actualizando rollups: {e}")
+    
+    def get_stats(self) -> Dict:
+        """📊 Profundidad de cola y latencia de escritura"""
+        flushes = self.stats['flushes']
+        return {
+            'queue_depth': self.queue.qsize(),
+            'events_written': self.stats['events_written'],
+            'flushes': flushes,
+            'errors': self.stats['errors'],
+            'retries': self.stats['retries'],
+            'dropped': self.stats['dropped'],
+            'rollup_flushes': self.stats['rollup_flushes'],
+            'last_flush_ms': round(self.stats['last_flush_ms'], 2),
+            'avg_flush_ms': round(self.stats['total_flush_ms'] / flushes, 2) if flushes else 0.0,
+            'max_flush_ms': round(self.stats['max_flush_ms'], 2)
+        }
+
+IP_FAMILIES = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+def parse_ip_network(entry: str) -> Optional[Tuple[int, int, int]]:
+    """🔢 Convertir una IP o CIDR en (versión, red como entero, longitud de prefijo)"""
+    address, _, prefix = entry.strip().partition('/')
+    version = 6 if ':' in address else 4
+    family, bits = IP_FAMILIES[version]
+    
+    try:
+        start = int.from_bytes(socket.inet_pton(family, address), 'big')
+        prefixlen = int(prefix) if prefix else bits
+    except (OSError, ValueError):
+        return None
+    
+    if not 0 <= prefixlen <= bits:
+        return None
+    
+    return version, start & ~((1 << (bits - prefixlen)) - 1), prefixlen
+
+def parse_ip_range(entry: str) -> Optional[Tuple[int, int, int]]:
+    """🔢 Convertir una IP o CIDR en (versión, inicio, fin) como enteros"""
+    network = parse_ip_network(entry)
+    if network is None:
+        return None
+    
+    version, start, prefixlen = network
+    return version, start, start | ((1 << (IP_FAMILIES[version][1] - prefixlen)) - 1)
+
+def range_to_cidrs(start: int, end: int, version: int) -> List[str]:
+    """🧮 Mínimo conjunto de bloques CIDR que cubren [inicio, fin]"""
+    family, bits = IP_FAMILIES[version]
+    cidrs = []
+    
+    while start <= end:
+        # Bloque más grande alineado en 'start' que no se pasa de 'end'
+        size = start & -start if start else 1 << bits
+        while size > end - start + 1:
+            size >>= 1
+        
+        address = socket.inet_ntop(family, start.to_bytes(bits // 8, 'big'))
+        prefixlen = bits - size.bit_length() + 1
+        cidrs.append(address if prefixlen == bits else f"{address}/{prefixlen}")
+        start += size
+    
+    return cidrs
+
+def aggregate_blocked_networks(entries: Set[str], prefix_block: Optional[Dict] = None) -> List[str]:
+    """🧮 Reducir IPs/CIDRs bloqueados al mínimo conjunto de rangos CIDR
+    
+    Equivale a ipaddress.collapse_addresses pero opera con enteros, lo que
+    permite agregar decenas de miles de IPs en cada volcado. Con prefix_block
+    habilitado, un prefijo completo (p.ej. /24) se bloquea cuando contiene al
+    menos min_hosts direcciones marcadas.
+    """
+    ranges = {4: [], 6: []}
+    for entry in entries:
+        parsed = parse_ip_range(entry)
+        if parsed:
+            version, start, end = parsed
+            ranges[version].append((start, end))
+    
+    if prefix_block and prefix_block.get('enabled'):
+        for version, prefix_key in ((4, 'ipv4_prefix'), (6, 'ipv6_prefix')):
+            shift = IP_FAMILIES[version][1] - prefix_block[prefix_key]
+            hosts_per_prefix = Counter()
+            for start, end in ranges[version]:
+                if end - start < (1 << shift):
+                    hosts_per_prefix[start >> shift] += end - start + 1
+            ranges[version].extend(
+                (prefix << shift, ((prefix + 1) << shift) - 1)
+                for prefix, hosts in hosts_per_prefix.items()
+                if hosts >= prefix_block['min_hosts']
+            )
+    
+    rules = []
+    for version in (4, 6):
+        # Fusionar rangos solapados o contiguos
+        merged = []
+        for start, end in sorted(ranges[version]):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        
+        for start, end in merged:
+            rules.extend(range_to_cidrs(start, end, version))
+    
+    return rules
+
+class HtaccessBlockWriter:
+    """🔧 Escritor coalescente del bloque Ivory en .htaccess
+    
+    Las IPs nuevas se acumulan en memoria y se vuelcan como mucho una vez
+    por flush_interval. El contenido ajeno a Ivory y las IPs ya escritas se
+    guardan en caché: el archivo solo se vuelve a parsear si alguien lo
+    modifica desde fuera. La escritura es atómica (temporal + rename).
+    """
+    START_MARKER = "# BEGIN IVORY SECURITY ENGINE v2.0\n"
+    END_MARKER = "# END IVORY SECURITY ENGINE v2.0\n"
+    RULE_PREFIX = "Require not ip "
+    
+    def __init__(self, htaccess_path: str, flush_interval: float = 5.0,
+                 backup_retention: int = 7, logger: Optional[logging.Logger] = None,
+                 aggregate: bool = True, prefix_block: Optional[Dict] = None,
+                 latency: Optional[LatencyHistogram] = None):
+        self.htaccess_path = htaccess_path
+        self.flush_interval = flush_interval
+        self.backup_retention = backup_retention
+        self.aggregate = aggregate
+        self.prefix_block = prefix_block
+        self.logger = logger or logging.getLogger('IvorySecurityEngine')
+        
+        self.pending: Set[str] = set()
+        self.blocked: Set[str] = set()
+        self.outside_lines: List[str] = []
+        self.rules: List[str] = []  # Reglas escritas en el archivo
+        self.file_signature = None  # (mtime_ns, tamaño) del archivo que tenemos en caché
+        self.last_flush = 0.0
+        self.flushes = 0
+        self.latency = latency or LatencyHistogram()
+    
+    def add(self, ips: Set[str]):
+        """➕ Añadir IPs a la cola de bloqueo"""
+        self.pending.update(ips)
+    
+    def current_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.htaccess_path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    
+    def load(self):
+        """📖 Parsear el archivo solo si cambió desde nuestra última escritura"""
+        signature = self.current_signature()
+        if signature is not None and signature == self.file_signature:
+            return
+        
+        outside_lines = []
+        blocked = set()
+        
+        if signature is not None:
+            with open(self.htaccess_path, 'r', encoding='utf-8') as f:
+                in_ivory_block = False
+                for line in f:
+                    if self.START_MARKER.strip() in line:
+                        in_ivory_block = True
+                    elif self.END_MARKER.strip() in line:
+                        in_ivory_block = False
+                    elif not in_ivory_block:
+                        outside_lines.append(line)
+                    elif self.RULE_PREFIX in line:
+                        blocked.add(line.split(self.RULE_PREFIX, 1)[1].strip())
+        
+        # Evitar que se acumulen líneas en blanco antes del bloque
+        while outside_lines and not outside_lines[-1].strip():
+            outside_lines.pop()
+        if outside_lines and not outside_lines[-1].endswith('\n'):
+            outside_lines[-1] += '\n'
+        
+        self.outside_lines = outside_lines
+        self.blocked = blocked
+        self.rules = sorted(blocked)
+        self.file_signature = signature
+    
+    def build_rules(self) -> List[str]:
+        """🧮 Reglas a escribir (agregadas en CIDR si está habilitado)"""
+        if self.aggregate:
+            return aggregate_blocked_networks(self.blocked, self.prefix_block)
+        return sorted(self.blocked)
+    
+    def render(self) -> List[str]:
+        """📝 Contenido completo del archivo con el bloque Ivory"""
+        security_block = [
+            f"\n{self.START_MARKER}",
+            "# Auto-generated by Ivory Security Engine\n",
+            f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n",
+            f"# Total blocked IPs: {len(self.blocked)} ({len(self.rules)} rules)\n",
+            "<RequireAll>\n",
+            "    Require all granted\n"
+        ]
+        
+        # Añadir reglas (IPs o rangos CIDR) ordenadas
+        for rule in self.rules:
+            security_block.append(f"    {self.RULE_PREFIX}{rule}\n")
+        
+        security_block.extend([
+            "</RequireAll>\n",
+            self.END_MARKER
+        ])
+        
+        return self.outside_lines + security_block
+    
+    def flush(self, force: bool = False) -> bool:
+        """⏬ Volcar las IPs pendientes (respetando el intervalo mínimo)"""
+        if not self.pending:
+            return False
+        if not force and time.monotonic() - self.last_flush < self.flush_interval:
+            return False
+        
+        new_ips = set()
+        started = time.perf_counter()
+        try:
+            self.load()
+            new_ips = self.pending - self.blocked
+            self.pending = set()
+            self.last_flush = time.monotonic()
+            
+            if not new_ips:
+                return False
+            
+            self.blocked |= new_ips
+            rules = self.build_rules()
+            if rules == self.rules:
+                return False  # IPs ya cubiertas por rangos existentes
+            self.rules = rules
+            
+            # Crear backup con timestamp
+            if self.file_signature is not None:
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                backup_path = f"{self.htaccess_path}.backup_{timestamp}"
+                shutil.copy2(self.htaccess_path, backup_path)
+                self.logger.info(f"💾 Backup creado: {backup_path}")
+            
+            self.write_atomic(self.render())
+            self.flushes += 1
+            self.logger.info(f"✅ .htaccess actualizado: {len(self.blocked)} IPs bloqueadas "
+                             f"(+{len(new_ips)}) en {len(self.rules)} reglas")
+            
+            # Limpiar backups antiguos
+            self.cleanup_old_backups()
+            self.latency.observe(time.perf_counter() - started)
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ Error actualizando .htaccess: {e}")
+            # Reintentar en el siguiente volcado sin perder IPs
+            self.pending |= new_ips
+            self.file_signature = None
+            return False
+    
+    def get_stats(self) -> Dict:
+        return {
+            'pending': len(self.pending),
+            'blocked_ips': len(self.blocked),
+            'rules': len(self.rules),
+            'flushes': self.flushes
+        }
+    
+    def write_atomic(self, lines: List[str]):
+        """💾 Escribir en un temporal del mismo directorio y renombrar"""
+        directory = os.path.dirname(os.path.abspath(self.htaccess_path))
+        fd, temp_path = tempfile.mkstemp(prefix='.htaccess.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp crea el fichero con 0600; Apache necesita poder leerlo
+            try:
+                mode = os.stat(self.htaccess_path).st_mode & 0o7777
+            except FileNotFoundError:
+                mode = 0o644
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, self.htaccess_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.file_signature = self.current_signature()
+    
+    def cleanup_old_backups(self):
+        """🧹 Limpiar backups antiguos"""
+        try:
+            backup_dir = os.path.dirname(os.path.abspath(self.htaccess_path))
+            backup_prefix = os.path.basename(self.htaccess_path) + '.backup_'
+            backup_files = []
+            
+            for file in os.listdir(backup_dir):
+                if file.startswith(backup_prefix):
+                    full_path = os.path.join(backup_dir, file)
+                    backup_files.append((full_path, os.path.getmtime(full_path)))
+            
+            # Ordenar por fecha y mantener solo los últimos N backups
+            backup_files.sort(key=lambda x: x[1], reverse=True)
+            
+            for backup_path, mtime in backup_files[self.backup_retention:]:
+                os.remove(backup_path)
+                self.logger.info(f"🗑️ Backup eliminado: {os.path.basename(backup_path)}")
+                
+        except Exception as e:
+            self.logger.error(f"❌ Error limpiando backups: {e}")
+
+# ═══════════════════════════════════════════════════════════
+# 🌐 ÍNDICE DE REPUTACIÓN (ÁRBOL RADIX)
+# ═══════════════════════════════════════════════════════════
+
+# Bit de cada feed en la máscara de fuentes de un prefijo
+REPUTATION_SOURCES = {'malicious_ips': 1, 'tor_nodes': 2, 'botnets': 4}
+
+class RadixTrie:
+    """🌳 Árbol radix binario con compresión de caminos sobre arrays planos
+    
+    Cada nodo guarda su prefijo (alineado a la izquierda en `width` bits), la
+    longitud del prefijo, la máscara de fuentes y sus dos hijos. Los nodos
+    viven en arrays de tipos primitivos ('I', 'B', 'Q'), unas 18 bytes por
+    nodo en IPv4 frente a los ~90 de una cadena dentro de un set. Una tabla
+    de salto sobre los primeros JUMP_BITS bits evita recorrer los niveles
+    superiores, casi completos, en cada búsqueda.
+    """
+    
+    JUMP_BITS = 16
+    
+    def __init__(self, width: int):
+        self.width = width
+        self.words = 1 if width <= 64 else 2  # Palabras de 64 bits por clave
+        # Nodo 0 = raíz (prefijo vacío); un hijo 0 significa "sin hijo"
+        self.left = array('I', [0])
+        self.right = array('I', [0])
+        self.prefix_lengths = array('B', [0])
+        self.tags = array('B', [0])
+        self.keys = array('Q', [0] * self.words)
+        self.jump_nodes: Optional[array] = None
+        self.jump_tags: Optional[array] = None
+    
+    ARRAYS = ('left', 'right', 'prefix_lengths', 'tags', 'keys', 'jump_nodes', 'jump_tags')
+    
+    def __len__(self) -> int:
+        return len(self.tags)
+    
+    def make_writable(self):
+        """✏️ Copiar a arrays propios los nodos mapeados desde disco (solo lectura)"""
+        for name in ('left', 'right', 'prefix_lengths', 'tags', 'keys'):
+            data = getattr(self, name)
+            if isinstance(data, memoryview):
+                setattr(self, name, array(data.format, data))
+    
+    def key_at(self, node: int) -> int:
+        if self.words == 1:
+            return self.keys[node]
+        return (self.keys[2 * node] << 64) | self.keys[2 * node + 1]
+    
+    def new_node(self, key: int, prefix_length: int, tag: int) -> int:
+        if self.words == 1:
+            self.keys.append(key)
+        else:
+            self.keys.append(key >> 64)
+            self.keys.append(key & 0xFFFFFFFFFFFFFFFF)
+        self.left.append(0)
+        self.right.append(0)
+        self.prefix_lengths.append(prefix_length)
+        self.tags.append(tag)
+        return len(self.tags) - 1
+    
+    def insert(self, value: int, prefix_length: int, tag: int):
+        """➕ Insertar un prefijo (value ya enmascarado) con su bit de fuente"""
+        self.make_writable()
+        width = self.width
+        left, right, prefix_lengths, tags = self.left, self.right, self.prefix_lengths, self.tags
+        keys, single = self.keys, self.words == 1
+        self.jump_nodes = None  # La tabla de salto se reconstruye en la próxima búsqueda
+        node = 0
+        
+        while True:
+            node_length = prefix_lengths[node]
+            if prefix_length == node_length:
+                tags[node] |= tag
+                return
+            
+            children = right if (value >> (width - 1 - node_length)) & 1 else left
+            child = children[node]
+            if not child:
+                children[node] = self.new_node(value, prefix_length, tag)
+                return
+            
+            # Prefijo común entre el hijo y el valor nuevo
+            child_key = keys[child] if single else (keys[2 * child] << 64) | keys[2 * child + 1]
+            child_length = prefix_lengths[child]
+            common = min(width - (child_key ^ value).bit_length(), child_length, prefix_length)
+            if common == child_length:
+                node = child
+                continue
+            
+            # Partir la arista: nodo intermedio con el prefijo común
+            middle = self.new_node(value & ~((1 << (width - common)) - 1), common, 0)
+            children[node] = middle
+            (right if (child_key >> (width - 1 - common)) & 1 else left)[middle] = child
+            
+            if common == prefix_length:
+                tags[middle] = tag
+            else:
+                leaf = self.new_node(value, prefix_length, tag)
+                (right if (value >> (width - 1 - common)) & 1 else left)[middle] = leaf
+            return
+    
+    def bulk_load(self, networks: List[Tuple[int, int, int]]):
+        """⚡ Construir un árbol vacío a partir de (valor, prefijo, fuente) en una pasada
+        
+        Ordenados por (valor, longitud) los prefijos salen en preorden del
+        árbol, así que basta mantener el camino más a la derecha en una pila
+        en lugar de bajar desde la raíz en cada inserción.
+        """
+        if len(self) > 1:
+            for value, prefix_length, tag in networks:
+                self.insert(value, prefix_length, tag)
+            return
+        
+        self.make_writable()
+        width = self.width
+        left, right, tags = self.left, self.right, self.tags
+        self.jump_nodes = None
+        stack = [(0, 0, 0)]  # (nodo, clave, longitud) del camino más a la derecha
+        previous_value, previous_length = 0, 0
+        
+        for value, prefix_length, tag in sorted(networks):
+            common = min(width - (value ^ previous_value).bit_length(), prefix_length, previous_length)
+            last = None
+            while stack[-1][2] > common:
+                last = stack.pop()
+            top, _, top_length = stack[-1]
+            
+            if top_length < common:
+                # Nodo intermedio entre la cima y el último nodo desapilado
+                middle = self.new_node(value & ~((1 << (width - common)) - 1), common, 0)
+                (right if (last[1] >> (width - 1 - top_length)) & 1 else left)[top] = middle
+                (right if (last[1] >> (width - 1 - common)) & 1 else left)[middle] = last[0]
+                stack.append((middle, value, common))
+                top, top_length = middle, common
+            
+            if prefix_length == top_length:
+                tags[top] |= tag
+            else:
+                leaf = self.new_node(value, prefix_length, tag)
+                (right if (value >> (width - 1 - top_length)) & 1 else left)[top] = leaf
+                stack.append((leaf, value, prefix_length))
+            
+            previous_value, previous_length = value, prefix_length
+    
+    def build_jump_table(self):
+        """🦘 Para cada valor de los primeros JUMP_BITS bits: fuentes acumuladas y nodo donde seguir"""
+        bits, width = self.JUMP_BITS, self.width
+        jump_nodes = array('I', [0]) * (1 << bits)
+        jump_tags = array('B', [0]) * (1 << bits)
+        
+        stack = [(0, 0)]  # (nodo, fuentes de sus ancestros)
+        while stack:
+            node, inherited = stack.pop()
+            key = self.key_at(node)
+            node_length = self.prefix_lengths[node]
+            slot = key >> (width - bits)
+            
+            if node_length >= bits:
+                # Primer nodo por debajo del corte: la búsqueda continúa aquí
+                jump_nodes[slot] = node
+                jump_tags[slot] = inherited
+                continue
+            
+            # Rango completo del nodo; los hijos (visitados después) lo sobrescriben
+            accumulated = inherited | self.tags[node]
+            span = 1 << (bits - node_length)
+            jump_nodes[slot:slot + span] = array('I', [0]) * span
+            jump_tags[slot:slot + span] = array('B', [accumulated]) * span
+            
+            for child in (self.left[node], self.right[node]):
+                if child:
+                    stack.append((child, accumulated))
+        
+        self.jump_nodes, self.jump_tags = jump_nodes, jump_tags
+    
+    def lookup(self, value: int) -> int:
+        """🔍 Máscara de fuentes de todos los prefijos que contienen value"""
+        if self.jump_nodes is None:
+            self.build_jump_table()
+        
+        width = self.width
+        slot = value >> (width - self.JUMP_BITS)
+        sources = self.jump_tags[slot]
+        node = self.jump_nodes[slot]
+        prefix_lengths, tags, left, right = self.prefix_lengths, self.tags, self.left, self.right
+        keys, single = self.keys, self.words == 1
+        
+        while node:
+            node_length = prefix_lengths[node]
+            key = keys[node] if single else (keys[2 * node] << 64) | keys[2 * node + 1]
+            if (value ^ key) >> (width - node_length):
+                break
+            sources |= tags[node]
+            if node_length == width:
+                break
+            node = (right if (value >> (width - 1 - node_length)) & 1 else left)[node]
+        
+        return sources
+    
+    def memory_bytes(self) -> int:
+        arrays = [self.left, self.right, self.prefix_lengths, self.tags, self.keys, self.jump_nodes, self.jump_tags]
+        return sum(a.itemsize * len(a) for a in arrays if a is not None)
+
+# Separadores de campos en feeds CSV, texto plano o formato AlienVault (IP#...)
+FEED_FIELD_SPLIT = re.compile(r'[\s,;#|"\']+')
+
+def iter_feed_entries(path: str):
+    """📄 IPs/CIDR de un feed: primera columna válida de cada línea (se ignoran comentarios)"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            for token in FEED_FIELD_SPLIT.split(line):
+                if token and (token[0].isdigit() or ':' in token):
+                    network = parse_ip_network(token)
+                    if network is not None:
+                        yield network
+                        break
+
+class ReputationIndex:
+    """🌐 Índice de reputación: IPs sueltas y bloques CIDR, IPv4 e IPv6
+    
+    Un RadixTrie por familia; cada prefijo lleva la máscara de feeds que lo
+    listan (REPUTATION_SOURCES) y lookup() devuelve las fuentes de todos los
+    prefijos que contienen la IP (del /0 al más largo) en una sola bajada.
+    """
+    
+    def __init__(self):
+        self.tries = {4: RadixTrie(32), 6: RadixTrie(128)}
+        self.counts = Counter()
+        self.mapped_file: Optional[str] = None
+    
+    def add(self, entry: str, source: str) -> bool:
+        """➕ Añadir una IP o CIDR en texto"""
+        network = parse_ip_network(entry)
+        if network is None:
+            return False
+        self.add_network(*network, source)
+        return True
+    
+    def add_network(self, version: int, value: int, prefix_length: int, source: str):
+        self.tries[version].insert(value, prefix_length, REPUTATION_SOURCES[source])
+        self.counts[source] += 1
+    
+    def load_feed_file(self, path: str, source: str) -> int:
+        """📥 Cargar un archivo de feed completo"""
+        return self.load_feed_files([(path, source)])[path]
+    
+    def load_feed_files(self, feeds: List[Tuple[str, str]]) -> Dict[str, int]:
+        """📥 Cargar varios feeds de una vez (construcción ordenada en bloque)"""
+        networks = {4: [], 6: []}
+        loaded = {}
+        for path, source in feeds:
+            tag = REPUTATION_SOURCES[source]
+            count = 0
+            for version, value, prefix_length in iter_feed_entries(path):
+                networks[version].append((value, prefix_length, tag))
+                count += 1
+            self.counts[source] += count
+            loaded[path] = count
+        
+        self.bulk_load(networks)
+        return loaded
+    
+    def bulk_load(self, networks: Dict[int, List[Tuple[int, int, int]]]):
+        """⚡ Cargar (valor, prefijo, fuente) por familia y preparar las tablas de salto"""
+        for version, entries in networks.items():
+            self.tries[version].bulk_load(entries)
+            self.tries[version].build_jump_table()
+    
+    def save(self, path: str, metadata: Optional[Dict] = None):
+        """💾 Serializar el índice (arrays planos) para poder mapearlo con mmap"""
+        for trie in self.tries.values():
+            if trie.jump_nodes is None:
+                trie.build_jump_table()
+        
+        arrays = {f'v{version}.{name}': getattr(trie, name)
+                  for version, trie in self.tries.items() for name in RadixTrie.ARRAYS}
+        write_array_file(path, dict(metadata or {}, counts=dict(self.counts)), arrays)
+    
+    @classmethod
+    def load(cls, path: str) -> 'ReputationIndex':
+        """🗺️ Abrir un índice serializado sin reconstruirlo: los nodos se leen del mmap"""
+        header, arrays = read_array_file(path)
+        index = cls()
+        for version, trie in index.tries.items():
+            for name in RadixTrie.ARRAYS:
+                setattr(trie, name, arrays[f'v{version}.{name}'])
+        index.counts = Counter(header['counts'])
+        index.mapped_file = path
+        return index
+    
+    def lookup(self, ip: str) -> int:
+        """🔍 Máscara de fuentes que contienen la IP (0 = sin reputación negativa)"""
+        try:
+            if ':' in ip:
+                return self.tries[6].lookup(int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big'))
+            return self.tries[4].lookup(int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'))
+        except (OSError, ValueError):
+            return 0
+    
+    def sources(self, ip: str) -> List[str]:
+        mask = self.lookup(ip)
+        return [source for source, bit in REPUTATION_SOURCES.items() if mask & bit]
+    
+    def __contains__(self, ip: str) -> bool:
+        return self.lookup(ip) != 0
+    
+    def get_stats(self) -> Dict:
+        return {
+            'entries': dict(self.counts),
+            'nodes': sum(len(trie) for trie in self.tries.values()),
+            'memory_bytes': sum(trie.memory_bytes() for trie in self.tries.values()),
+            'mapped_file': self.mapped_file
+        }
+
+# Formato binario de índices y cachés: cabecera JSON + arrays alineados a 8 bytes
+ARRAY_FILE_MAGIC = b'IVORYIX1'
+
+def write_array_file(path: str, header: Dict, arrays: Dict[str, array]):
+    """💾 Escribir arrays tipados con su cabecera (archivo temporal + os.replace)"""
+    layout = {}
+    offset = 0
+    for name, data in arrays.items():
+        layout[name] = [data.typecode, data.itemsize, offset, len(data)]
+        offset += -(-len(data) * data.itemsize // 8) * 8
+    
+    header_bytes = json.dumps(dict(header, arrays=layout)).encode('utf-8')
+    header_bytes += b' ' * (-(len(header_bytes) + 12) % 8)
+    
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(ARRAY_FILE_MAGIC)
+            f.write(len(header_bytes).to_bytes(4, 'little'))
+            f.write(header_bytes)
+            for data in arrays.values():
+                raw = data.tobytes()
+                f.write(raw)
+                f.write(b'\0' * (-len(raw) % 8))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def read_array_file(path: str) -> Tuple[Dict, Dict[str, memoryview]]:
+    """🗺️ Mapear un archivo de arrays: devuelve vistas tipadas sobre el mmap, sin copiar"""
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    view = memoryview(mapped)
+    if bytes(view[:8]) != ARRAY_FILE_MAGIC:
+        raise ValueError(f"Formato de índice desconocido: {path}")
+    
+    header_length = int.from_bytes(view[8:12], 'little')
+    header = json.loads(bytes(view[12:12 + header_length]))
+    base = 12 + header_length
+    
+    arrays = {}
+    for name, (typecode, itemsize, offset, length) in header['arrays'].items():
+        if array(typecode).itemsize != itemsize:
+            raise ValueError(f"Índice generado en otra plataforma: {path}")
+        start = base + offset
+        arrays[name] = view[start:start + length * itemsize].cast(typecode)
+    
+    return header, arrays
+
+def feed_source(name: str) -> str:
+    """🏷️ Fuente de un feed según el comienzo del nombre del archivo"""
+    return next((source for source in REPUTATION_SOURCES if name.startswith(source)), 'malicious_ips')
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _load_feed_networks(path: str, cache_path: str, tag: int) -> Tuple[Dict[int, List[Tuple[int, int, int]]], int]:
+    """📥 Redes de un feed: desde su caché parseada si existe, si no parseando y guardándola"""
+    if os.path.exists(cache_path):
+        _, arrays = read_array_file(cache_path)
+        v6_words = arrays['v6.values']
+        networks = {
+            4: [(value, length, tag) for value, length in zip(arrays['v4.values'], arrays['v4.lengths'])],
+            6: [((v6_words[2 * i] << 64) | v6_words[2 * i + 1], length, tag)
+                for i, length in enumerate(arrays['v6.lengths'])]
+        }
+        return networks, len(networks[4]) + len(networks[6])
+    
+    values = {4: array('Q'), 6: array('Q')}
+    lengths = {4: array('B'), 6: array('B')}
+    networks = {4: [], 6: []}
+    for version, value, prefix_length in iter_feed_entries(path):
+        networks[version].append((value, prefix_length, tag))
+        if version == 4:
+            values[4].append(value)
+        else:
+            values[6].append(value >> 64)
+            values[6].append(value & 0xFFFFFFFFFFFFFFFF)
+        lengths[version].append(prefix_length)
+    
+    write_array_file(cache_path, {'feed': os.path.basename(path)}, {
+        'v4.values': values[4], 'v4.lengths': lengths[4],
+        'v6.values': values[6], 'v6.lengths': lengths[6]
+    })
+    return networks, len(networks[4]) + len(networks[6])
+
+def read_reputation_manifest(index_dir: str) -> Optional[Dict]:
+    """📋 Manifiesto del último índice construido (None si no hay ninguno válido)"""
+    manifest_path = os.path.join(index_dir, 'manifest.json')
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if os.path.exists(os.path.join(index_dir, manifest['index_file'])) else None
+
+def build_reputation_index(feeds_dir: str, index_dir: str) -> Optional[Dict]:
+    """🏗️ Construir y serializar el índice de reputación (pensado para un proceso aparte)
+    
+    Los feeds cuyo sha256 no ha cambiado reutilizan su caché ya parseada; si
+    ninguno ha cambiado no se construye nada y se devuelve None. Si no, se
+    escribe un nuevo index-<digest>.bin y se reemplaza el manifiesto de forma
+    atómica; el motor solo tiene que mapear el archivo nuevo.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    previous = read_reputation_manifest(index_dir)
+    previous_feeds = previous['feeds'] if previous else {}
+    
+    feeds = {}
+    feed_paths = sorted(glob.glob(os.path.join(glob.escape(feeds_dir), '*'))) if os.path.isdir(feeds_dir) else []
+    for path in feed_paths:
+        if not os.path.isfile(path):
+            continue
+        name = os.path.basename(path)
+        st = os.stat(path)
+        known = previous_feeds.get(name)
+        # Tamaño y mtime iguales: se reutiliza el checksum sin releer el archivo
+        if known and known['size'] == st.st_size and known['mtime_ns'] == st.st_mtime_ns:
+            checksum = known['sha256']
+        else:
+            checksum = file_sha256(path)
+        feeds[name] = {'sha256': checksum, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                       'source': feed_source(name)}
+    
+    signature = sorted((name, info['sha256'], info['source']) for name, info in feeds.items())
+    if previous and signature == sorted((name, info['sha256'], info['source'])
+                                        for name, info in previous_feeds.items()):
+        return None
+    
+    started = time.perf_counter()
+    index = ReputationIndex()
+    networks = {4: [], 6: []}
+    for name, info in feeds.items():
+        cache_path = os.path.join(index_dir, f"feed-{info['sha256'][:24]}.bin")
+        feed_networks, info['entries'] = _load_feed_networks(
+            os.path.join(feeds_dir, name), cache_path, REPUTATION_SOURCES[info['source']]
+        )
+        for version, entries in feed_networks.items():
+            networks[version].extend(entries)
+        index.counts[info['source']] += info['entries']
+    index.bulk_load(networks)
+    
+    digest = hashlib.sha256(json.dumps(signature).encode('utf-8')).hexdigest()[:16]
+    index_file = f'index-{digest}.bin'
+    index.save(os.path.join(index_dir, index_file), {'feeds': sorted(feeds)})
+    
+    manifest = {
+        'index_file': index_file,
+        'feeds': feeds,
+        'entries': dict(index.counts),
+        'built_at': datetime.now().isoformat(),
+        'build_seconds': round(time.perf_counter() - started, 2)
+    }
+    manifest_path = os.path.join(index_dir, 'manifest.json')
+    fd, temp_path = tempfile.mkstemp(dir=index_dir, prefix='.manifest.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+    
+    # Limpiar índices y cachés que ya no se usan (en Windows puede seguir mapeado: se reintenta luego)
+    keep = {index_file} | {f"feed-{info['sha256'][:24]}.bin" for info in feeds.values()}
+    for path in glob.glob(os.path.join(glob.escape(index_dir), '*.bin')):
+        if os.path.basename(path) not in keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    return manifest
+
+class InotifyWatcher:
+    """👁️ Espera de cambios en un directorio con inotify (Linux, vía ctypes)
+    
+    Se integra en el bucle asyncio con loop.add_reader: el tailer despierta en
+    cuanto Apache escribe o rota el log, en lugar de sondear cada segundo.
+    """
+    
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    
+    def __init__(self, directory: str):
+        import ctypes
+        import ctypes.util
+        
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 falló')
+        
+        mask = self.IN_MODIFY | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch falló en {directory}')
+    
+    @staticmethod
+    def available() -> bool:
+        return sys.platform.startswith('linux')
+    
+    async def wait(self, timeout: float):
+        """⏳ Esperar un evento del directorio (o agotar el timeout)"""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(self.fd, lambda: ready.done() or ready.set_result(True))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(self.fd)
+        self.drain()
+    
+    def drain(self):
+        """🧹 Descartar los eventos pendientes (solo interesa que hubo cambios)"""
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+    
+    def close(self):
+        os.close(self.fd)
+
+def hash_last_line(f, offset: int) -> str:
+    """🔑 Hash de la última línea completa antes de offset (huella del checkpoint)"""
+    if offset <= 0:
+        return ''
+    start = max(0, offset - 8192)
+    f.seek(start)
+    data = f.read(offset - start)
+    line_start = data.rfind(b'\n', 0, len(data) - 1) + 1
+    return hashlib.sha1(data[line_start:]).hexdigest()
+
+class LogTailer:
+    """📡 Seguimiento de un log con checkpoint persistente y detección de rotación
+    
+    Guarda (dispositivo, inodo, offset, hash de la última línea) en la base de
+    datos del motor. Al arrancar reanuda desde el checkpoint; si el archivo fue
+    rotado mientras el motor estaba parado, termina primero de leer la rotación
+    (access.log.1) y si fue truncado vuelve a empezar desde el principio.
+    """
+    
+    def __init__(self, log_path: str, db_path: str, poll_interval: float = 0.25,
+                 use_inotify: bool = True, logger: Optional[logging.Logger] = None):
+        self.log_path = log_path
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.logger = logger or logging.getLogger(__name__)
+        self.f = None
+        self.current_path = log_path
+        self.offset = 0
+        self.watcher: Optional[InotifyWatcher] = None
+        self.conn: Optional[sqlite3.Connection] = None
+        self.stats = {'rotations': 0, 'truncations': 0, 'resumed_from': None, 'wakeup': 'polling'}
+    
+    def open(self):
+        """📂 Abrir el log y situarse según el checkpoint guardado"""
+        self.conn = sqlite3.connect(self.db_path)
+        checkpoint = self.conn.execute(
+            'SELECT device, inode, offset, last_line_hash FROM log_checkpoints WHERE path = ?',
+            (self.log_path,)
+        ).fetchone()
+        
+        self.f = open(self.log_path, 'rb')
+        self.current_path = self.log_path
+        st = os.fstat(self.f.fileno())
+        
+        if checkpoint is None:
+            # Primera ejecución: como antes, solo las líneas nuevas
+            self.offset = st.st_size
+        else:
+            device, inode, offset, last_line_hash = checkpoint
+            if (st.st_dev, st.st_ino) == (device, inode):
+                if offset <= st.st_size and hash_last_line(self.f, offset) == last_line_hash:
+                    self.offset = offset
+                    self.stats['resumed_from'] = offset
+                else:
+                    self.logger.warning(f"✂️ Log truncado o reescrito desde el último checkpoint: {self.log_path}")
+                    self.stats['truncations'] += 1
+                    self.offset = 0
+            else:
+                rotated_path = self.find_rotated_file(device, inode)
+                if rotated_path:
+                    # Terminar la rotación antes de pasar al archivo nuevo
+                    self.logger.info(f"🔄 Log rotado con el motor parado, drenando {rotated_path}")
+                    self.f.close()
+                    self.f = open(rotated_path, 'rb')
+                    self.current_path = rotated_path
+                    self.offset = min(offset, os.fstat(self.f.fileno()).st_size)
+                    self.stats['resumed_from'] = self.offset
+                else:
+                    self.offset = 0
+        
+        if self.use_inotify and InotifyWatcher.available():
+            try:
+                self.watcher = InotifyWatcher(os.path.dirname(os.path.abspath(self.log_path)))
+                self.stats['wakeup'] = 'inotify'
+            except OSError as e:
+                self.logger.warning(f"⚠️ inotify no disponible, usando sondeo: {e}")
+        
+        self.save_checkpoint()
+    
+    def find_rotated_file(self, device: int, inode: int) -> Optional[str]:
+        """🔍 Buscar entre las rotaciones sin comprimir el archivo del checkpoint"""
+        for path in find_rotated_logs(self.log_path):
+            if path == self.log_path or path.endswith('.gz'):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) == (device, inode):
+                return path
+        return None
+    
+    def available_bytes(self) -> int:
+        return os.fstat(self.f.fileno()).st_size - self.offset
+    
+    def advance(self, new_offset: int):
+        """✅ Confirmar el procesamiento hasta new_offset y persistir el checkpoint"""
+        self.offset = new_offset
+        self.save_checkpoint()
+    
+    def save_checkpoint(self):
+        st = os.fstat(self.f.fileno())
+        self.conn.execute('''
+            INSERT OR REPLACE INTO log_checkpoints (path, device, inode, offset, last_line_hash, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (self.log_path, st.st_dev, st.st_ino, self.offset, hash_last_line(self.f, self.offset)))
+        self.conn.commit()
+    
+    def check_rotation(self) -> bool:
+        """🔄 Tras drenar el descriptor actual: ¿rotación o truncado?"""
+        st = os.fstat(self.f.fileno())
+        if st.st_size < self.offset:
+            self.logger.warning(f"✂️ Log truncado: {self.current_path}")
+            self.stats['truncations'] += 1
+            self.advance(0)
+            return True
+        
+        try:
+            path_st = os.stat(self.log_path)
+        except FileNotFoundError:
+            return False  # Rotado pero Apache aún no ha creado el nuevo archivo
+        
+        if (path_st.st_dev, path_st.st_ino) != (st.st_dev, st.st_ino):
+            self.logger.info(f"🔄 Log rotado, continuando en el nuevo {self.log_path}")
+            self.stats['rotations'] += 1
+            self.f.close()
+            self.f = open(self.log_path, 'rb')
+            self.current_path = self.log_path
+            self.advance(0)
+            return True
+        
+        return False
+    
+    async def wait_for_data(self, timeout: float = 1.0):
+        """⏳ Esperar nuevas escrituras: inotify si existe, sondeo corto si no"""
+        if self.watcher:
+            await self.watcher.wait(timeout)
+        else:
+            await asyncio.sleep(self.poll_interval)
+    
+    def get_stats(self) -> Dict:
+        return {
+            'path': self.current_path,
+            'offset': self.offset,
+            **self.stats
+        }
+    
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+        if self.f:
+            self.f.close()
+            self.f = None
+        if self.conn:
+            self.conn.close()
+            self.conn = None
 
 # ═══════════════════════════════════════════════════════════
-# 🏗️ CONFIGURACIÓN Y ESTRUCTURAS DE DATOS
+# 🤖 SERVICIO DE MODELOS (CARGA PEREZOSA Y MMAP)
 # ═══════════════════════════════════════════════════════════
 
-class ThreatLevel(Enum):
-    """🚨 Niveles de amenaza"""
-    LOW = "LOW"
-    MEDIUM = "MEDIUM" 
-    HIGH = "HIGH"
-    CRITICAL = "CRITICAL"
+class ModelStore:
+    """🤖 Modelos de IA cargados bajo demanda desde archivos joblib mapeables
+    
+    Cada modelo se guarda sin compresión en <nombre>.joblib, de modo que
+    joblib.load(mmap_mode='r') mapea sus arrays (nodos de los árboles) en
+    lugar de copiarlos: la carga es casi inmediata y los procesos worker
+    comparten las mismas páginas. Si falta el archivo se entrena con la
+    función registrada y se guarda; los .pkl antiguos se migran una vez.
+    """
+    
+    def __init__(self, model_dir: str, trainers: Dict[str, Callable], logger: Optional[logging.Logger] = None):
+        self.model_dir = model_dir
+        self.trainers = trainers
+        self.logger = logger or logging.getLogger('IvorySecurityEngine')
+        self.models = {}
+        self.failed = set()
+        self.lock = threading.RLock()
+        self.mtimes = {}  # mtime del archivo de cada modelo cargado
+        self.refresh_interval = 30.0
+        self.refresh_deadline = time.monotonic() + self.refresh_interval
+        self.stats = {name: {'loaded': False, 'source': None, 'load_ms': 0.0, 'reloads': 0} for name in trainers}
+    
+    def path(self, name: str) -> str:
+        return os.path.join(self.model_dir, f'{name}.joblib')
+    
+    def get(self, name: str):
+        """📦 Modelo listo para usar (se carga o entrena en el primer acceso; None si falla)"""
+        model = self.models.get(name)
+        if model is not None or name in self.failed:
+            return model
+        
+        with self.lock:
+            if name in self.models or name in self.failed:
+                return self.models.get(name)
+            
+            started = time.perf_counter()
+            try:
+                model, source = self.load(name)
+                if model is None:
+                    self.logger.info(f"🎓 Entrenando modelo {name}...")
+                    model, source = self.trainers[name](), 'trained'
+                    self.save(name, model)
+            except Exception as e:
+                self.failed.add(name)
+                self.logger.error(f"❌ Error cargando modelo {name}: {e}")
+                return None
+            
+            self.models[name] = model
+            self.stats[name].update(loaded=True, source=source,
+                                    load_ms=round((time.perf_counter() - started) * 1000, 1))
+            self.logger.info(f"🤖 Modelo {name} listo ({source}, {self.stats[name]['load_ms']} ms)")
+            return model
+    
+    def load(self, name: str):
+        """📂 Abrir el modelo guardado: joblib mapeado o, si solo existe, el .pkl antiguo"""
+        import joblib
+        
+        path = self.path(name)
+        if os.path.exists(path):
+            self.mtimes[name] = os.stat(path).st_mtime_ns
+            return joblib.load(path, mmap_mode='r'), 'mmap'
+        
+        legacy_path = os.path.join(self.model_dir, f'{name}.pkl')
+        if os.path.exists(legacy_path):
+            # Migración: se reescribe en el formato mapeable y se vuelve a abrir con mmap
+            self.save(name, joblib.load(legacy_path))
+            return joblib.load(path, mmap_mode='r'), 'migrated'
+        
+        return None, None
+    
+    def save(self, name: str, model):
+        """💾 Guardar un modelo (archivo temporal + os.replace) y usarlo desde ya"""
+        import joblib
+        
+        os.makedirs(self.model_dir or '.', exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.model_dir or '.', prefix=f'.{name}.')
+        os.close(fd)
+        try:
+            joblib.dump(model, temp_path)  # sin compresión: necesario para mmap_mode
+            os.replace(temp_path, self.path(name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        
+        with self.lock:
+            self.models[name] = model
+            self.mtimes[name] = os.stat(self.path(name)).st_mtime_ns
+            self.failed.discard(name)
+    
+    def reload(self, name: str):
+        """🔄 Mapear la versión guardada por otro proceso y sustituir la referencia en uso"""
+        import joblib
+        
+        started = time.perf_counter()
+        path = self.path(name)
+        mtime = os.stat(path).st_mtime_ns
+        model = joblib.load(path, mmap_mode='r')
+        with self.lock:
+            self.models[name] = model
+            self.mtimes[name] = mtime
+            self.failed.discard(name)
+        self.stats[name].update(loaded=True, source='reloaded',
+                                load_ms=round((time.perf_counter() - started) * 1000, 1))
+        self.stats[name]['reloads'] += 1
+        return model
+    
+    def maybe_refresh(self):
+        """👀 Recargar (como mucho cada refresh_interval s) los modelos reemplazados en disco"""
+        if time.monotonic() < self.refresh_deadline:
+            return
+        self.refresh_deadline = time.monotonic() + self.refresh_interval
+        
+        for name, mtime in list(self.mtimes.items()):
+            try:
+                if os.stat(self.path(name)).st_mtime_ns != mtime:
+                    self.reload(name)
+                    self.logger.info(f"🔄 Modelo {name} recargado desde disco")
+            except Exception as e:
+                self.logger.error(f"❌ Error recargando modelo {name}: {e}")
+    
+    def is_loaded(self, name: str) -> bool:
+        return name in self.models
+    
+    def warm_up(self, names: Optional[List[str]] = None):
+        """🔥 Cargar los modelos en segundo plano para que el primer lote no espere"""
+        names = [name for name in (names or self.trainers) if not self.is_loaded(name)]
+        if names:
+            threading.Thread(target=lambda: [self.get(name) for name in names],
+                             name='IvoryModelWarmUp', daemon=True).start()
+    
+    def get_stats(self) -> Dict:
+        return {name: dict(stats) for name, stats in self.stats.items()}
 
-@dataclass
-class SecurityEvent:
-    """📋 Evento de seguridad"""
-    timestamp: datetime
-    ip: str
-    country: str
-    user_agent: str
-    threat_type: str
-    threat_level: ThreatLevel
-    request_path: str
-    response_code: int
-    blocked: bool = False
+def new_anomaly_model():
+    """🌲 IsolationForest con los parámetros del motor"""
+    from sklearn.ensemble import IsolationForest
+    return IsolationForest(contamination=0.1, random_state=42, n_estimators=100)
 
-@dataclass
-class IPIntelligence:
-    """🧠 Inteligencia de IP"""
-    ip: str
-    country: str
-    region: str
-    city: str
-    isp: str
-    threat_score: float
-    reputation_sources: List[str]
-    last_seen: datetime
-    attack_patterns: List[str]
-    blocked_count: int = 0
+def fit_anomaly_model(samples: 'np.ndarray', model_dir: str) -> Dict:
+    """🎓 Entrenar y guardar el modelo de anomalías (se ejecuta en un proceso aparte)"""
+    started = time.perf_counter()
+    model = new_anomaly_model()
+    model.fit(samples)
+    ModelStore(model_dir, {}).save('anomaly_model', model)
+    return {'fit_seconds': round(time.perf_counter() - started, 3), 'samples': len(samples)}
+
+class FeatureReservoir:
+    """🪣 Muestra acotada de vectores de características con sesgo temporal
+    
+    Muestreo ponderado (A-Res) con peso exp(decay * t): cada vector recibe la
+    clave decay * t - ln(-ln u) y se conservan las `capacity` claves mayores,
+    así que la probabilidad de que un vector siga en la muestra se reduce a
+    la mitad cada half_life segundos. Los lotes se acumulan y se compactan
+    con argpartition (vectorizado) cuando superan una cuarta parte del tamaño.
+    También acumula la media de la ventana reciente para detectar deriva.
+    """
+    
+    def __init__(self, capacity: int, half_life: float, seed: Optional[int] = None):
+        self.capacity = max(1, capacity)
+        self.decay = math.log(2) / half_life
+        self.seed = seed
+        self.rng = None
+        self.keys = None
+        self.data = None
+        self.pending_keys = []
+        self.pending_data = []
+        self.pending_count = 0
+        self.seen = 0
+        self.window_sum = None
+        self.window_count = 0
+    
+    def add(self, features: 'np.ndarray', now: Optional[float] = None):
+        """➕ Ofrecer un lote de vectores (n x d) a la muestra"""
+        import numpy as np
+        
+        if self.rng is None:
+            self.rng = np.random.default_rng(self.seed)
+        count = len(features)
+        if not count:
+            return
+        
+        now = time.time() if now is None else now
+        uniform = self.rng.random(count) * (1 - 2e-16) + 1e-16
+        self.pending_keys.append(self.decay * now - np.log(-np.log(uniform)))
+        self.pending_data.append(np.asarray(features, dtype=float))
+        self.pending_count += count
+        self.seen += count
+        
+        window = self.pending_data[-1].sum(axis=0)
+        self.window_sum = window if self.window_sum is None else self.window_sum + window
+        self.window_count += count
+        
+        if self.pending_count >= self.capacity // 4:
+            self.compact()
+    
+    def compact(self):
+        """🗜️ Incorporar lo pendiente conservando las capacity claves mayores"""
+        import numpy as np
+        
+        if not self.pending_count:
+            return
+        keys = self.pending_keys if self.keys is None else [self.keys] + self.pending_keys
+        data = self.pending_data if self.data is None else [self.data] + self.pending_data
+        keys, data = np.concatenate(keys), np.concatenate(data)
+        
+        if len(keys) > self.capacity:
+            keep = np.argpartition(keys, len(keys) - self.capacity)[len(keys) - self.capacity:]
+            keys, data = keys[keep], data[keep]
+        
+        self.keys, self.data = keys, data
+        self.pending_keys, self.pending_data, self.pending_count = [], [], 0
+    
+    def snapshot(self) -> 'np.ndarray':
+        """📸 Copia de la muestra actual (para entrenar fuera de este proceso)"""
+        self.compact()
+        return self.data.copy() if self.data is not None else None
+    
+    def window_mean(self) -> Optional['np.ndarray']:
+        return self.window_sum / self.window_count if self.window_count else None
+    
+    def reset_window(self):
+        self.window_sum = None
+        self.window_count = 0
+    
+    def __len__(self) -> int:
+        return (0 if self.keys is None else len(self.keys)) + self.pending_count
 
 class IvorySecurityEngine:
     """🛡️ Motor Principal de Seguridad Ivory"""
+    DB_PATH = "ivory_security_advanced.db"  # ruta fija: también la usan los workers
+    STAGES = ('parse', 'geo', 'analyze', 'ml', 'db', 'htaccess')
     
-    def __init__(self, config_path: str = "ivory_config.json"):
+    def __init__(self, config_path: str = "ivory_config.json", worker_mode: bool = False):
+        self.config_path = config_path
         self.config = self.load_config(config_path)
-        self.setup_logging()
-        self.setup_database()
+        self.config_mtime = self.get_config_mtime()
+        self.worker_mode = worker_mode
+        self.worker_refresh_deadline = 0.0  # próxima comprobación de cambios en disco (workers)
+        self.started_at = time.time()
+        # ⏱️ Latencia por etapa ('analyze' incluye 'geo' y 'ml'; 'geo' son los fallos de caché)
+        self.stage_latency = {stage: LatencyHistogram() for stage in self.STAGES}
+        # 🔬 Trazado fino por etapa (opcional) y captura de perfiles bajo demanda
+        self.tracer = StageTracer(self.config['monitoring']['tracing'],
+                                  self.config['monitoring']['trace_sample_rate'])
+        self.profiling = False
+        self.metrics_server: Optional['MetricsServer'] = None
+        
+        if worker_mode:
+            # Procesos worker: solo análisis (sin BD, .htaccess ni handlers de log)
+            self.logger = logging.getLogger('IvorySecurityEngine.worker')
+            self.db_path = self.DB_PATH  # solo para la caché de inteligencia de IPs
+        else:
+            self.setup_logging()
+            self.setup_database()
+            self.event_sink = SecurityEventSink(
+                self.db_path,
+                batch_size=self.config['optimization']['event_flush_size'],
+                flush_interval=self.config['optimization']['event_flush_interval'],
+                max_queue=self.config['optimization']['event_queue_size'],
+                logger=self.logger,
+                rollup_interval=self.config['optimization']['rollup_flush_interval'],
+                latency=self.stage_latency['db']
+            )
+            self.htaccess_writer = HtaccessBlockWriter(
+                self.config['paths']['htaccess'],
+                flush_interval=self.config['optimization']['htaccess_flush_interval'],
+                backup_retention=self.config['monitoring']['backup_retention_days'],
+                logger=self.logger,
+                aggregate=self.config['optimization']['aggregate_cidr'],
+                prefix_block=self.config['security']['prefix_block'],
+                latency=self.stage_latency['htaccess']
+            )
+        
+        self.threat_matcher = ThreatMatcher(self.config['security'])
+        self.setup_rate_limiter()
+        self.setup_geoip()
+        
+        # 📈 Modelos de Machine Learning (anomalías y predicción de amenazas), bajo demanda
         self.setup_ai_models()
         
-        # 📊 Estadísticas en tiempo real
-        self.stats = {
-            'total_requests': 0,
-            'blocked_requests': 0,
-            'unique_ips': set(),
-            'threat_countries': Counter(),
-            'attack_patterns': Counter(),
-            'hourly_stats': defaultdict(int)
-        }
+        # 📊 Estadísticas en tiempo real (fragmentadas por hilo, memoria constante)
+        self.metrics = RealTimeMetrics(self.config['optimization']['metrics_top_k'],
+                                       self.config['optimization']['metrics_hours'])
         
         # 🧠 Inteligencia de amenazas
-        self.ip_intelligence: Dict[str, IPIntelligence] = {}
-        self.reputation_feeds = self.load_reputation_feeds()
+        self.ip_intelligence = IPIntelligenceCache(
+            self.db_path,
+            self.config['optimization']['ip_intelligence_cache_size'],
+            flush_interval=self.config['optimization']['ip_intelligence_flush_interval'],
+            logger=self.logger
+        )
+        self.reputation_index = self.load_reputation_feeds()
         
         # 🔄 Control de hilos
         self.monitoring_active = False
         self.threads = []
         
-        # 📈 Modelo de Machine Learning para detección de anomalías
-        self.anomaly_detector = None
-        self.load_or_train_ml_model()
+        # ⚡ Métricas de ingesta (líneas/segundo)
+        self.ingest_stats = {
+            'lines': 0,
+            'batches': 0,
+            'busy_seconds': 0.0
+        }
+        self.log_tailer: Optional[LogTailer] = None
+        self.pipeline: Optional['AnalysisPipeline'] = None
     
     def load_config(self, config_path: str) -> Dict:
         """⚙️ Cargar configuración avanzada"""
@@ -105,7 +3134,8 @@ class IvorySecurityEngine:
                 'error_log': r'C:\xampp\apache\logs\error.log',
                 'htaccess': r'C:\xampp\htdocs\.htaccess',
                 'geoip_db': 'GeoLite2-Country.mmdb',
-                'city_db': 'GeoLite2-City.mmdb'
+                'city_db': 'GeoLite2-City.mmdb',
+                'archive_dir': 'ivory_archive'  # Parquet por días (eventos y rollups)
             },
             'security': {
                 'blocked_countries': ['CN', 'RU', 'KP', 'IR', 'CU'],
@@ -117,27 +3147,80 @@ class IvorySecurityEngine:
                 'blocked_extensions': ['.php~', '.bak', '.old', '.backup'],
                 'rate_limit_per_ip': 100,  # requests per minute
                 'auto_block_threshold': 10,  # suspicious requests
-                'honeypot_paths': ['/admin', '/wp-admin', '/phpmyadmin']
+                'honeypot_paths': ['/admin', '/wp-admin', '/phpmyadmin'],
+                'attack_signatures': ['../../../', 'union select', '<script>', 'php://input'],
+                'prefix_block': {
+                    'enabled': False,  # bloquear prefijos completos con muchos hosts marcados
+                    'ipv4_prefix': 24,
+                    'ipv6_prefix': 64,
+                    'min_hosts': 16
+                }
             },
             'ai': {
                 'anomaly_detection': True,
                 'threat_prediction': True,
                 'auto_learning': True,
-                'confidence_threshold': 0.8
+                'reservoir_size': 20000,  # vectores recientes conservados para reentrenar
+                'reservoir_half_life': 3600,  # segundos: la probabilidad de seguir en la muestra se reduce a la mitad
+                'retrain_interval': 3600,  # segundos entre reentrenamientos programados
+                'drift_check_interval': 60,  # segundos entre comprobaciones de deriva
+                'drift_threshold': 0.5,  # desplazamiento de la media (en desviaciones) que fuerza reentrenar
+                'drift_window': 2000,  # vectores mínimos en la ventana para evaluar la deriva
+                'min_retrain_samples': 1000,
+                'confidence_threshold': 0.8,
+                'model_dir': '.'  # modelos .joblib (se cargan con mmap al primer uso)
             },
             'monitoring': {
                 'scan_interval': 5,  # seconds
                 'log_rotation_days': 30,
+                'archive_closed_days': False,  # archivar en Parquet cada día cerrado (requiere pyarrow)
+                'metrics_endpoint': True,  # HTTP local con métricas (Prometheus/JSON) y control
+                'metrics_host': '127.0.0.1',
+                'metrics_port': 9477,
+                'control_token': '',  # /control/* exige la cabecera X-Ivory-Token (vacío = se genera al arrancar)
+                'tracing': False,  # histogramas por etapa del modo línea a línea
+                'trace_sample_rate': 0.001,  # fracción de líneas con traza completa (con tracing activo)
                 'backup_retention_days': 7,
                 'real_time_alerts': True
             },
             'reputation': {
                 'enable_feeds': True,
                 'update_interval': 3600,  # seconds
+                'feeds_dir': 'reputation_feeds',  # copias locales de los feeds (IPs y CIDR)
+                'index_dir': 'reputation_index',  # índice serializado (mmap) y cachés por feed
                 'trusted_sources': [
                     'https://feodotracker.abuse.ch/downloads/ipblocklist.csv',
                     'https://reputation.alienvault.com/reputation.data'
                 ]
+            },
+            'optimization': {
+                'cache_geoip_lookups': True,
+                'batch_process_logs': False,
+                'geoip_cache_size': 10000,  # IPs en caché LRU
+                'ip_intelligence_cache_size': 50000,  # IPs con inteligencia en memoria
+                'ip_intelligence_flush_interval': 5.0,  # segundos entre volcados a ip_intelligence
+                'rate_limiter_max_ips': 100000,
+                'rate_limiter_idle_seconds': 86400,
+                'behavior_max_ips': 100000,  # IPs con ventana de comportamiento (predictor de amenazas)
+                'behavior_idle_seconds': 3600,
+                'event_flush_size': 500,  # eventos por transacción
+                'event_flush_interval': 1.0,  # segundos
+                'event_queue_size': 100000,
+                'rollup_flush_interval': 5.0,  # segundos entre volcados de rollups
+                'rollup_minute_retention_hours': 48,  # los rollups por hora duran log_rotation_days
+                'htaccess_flush_interval': 5.0,  # segundos entre escrituras de .htaccess
+                'aggregate_cidr': True,  # agrupar IPs bloqueadas en rangos CIDR
+                'mmap_log_reader': True,  # leer el log mapeado en memoria
+                'use_inotify': True,  # despertar con inotify en Linux en lugar de sondear
+                'tail_poll_interval': 0.25,  # segundos entre sondeos sin inotify
+                'pipeline_workers': 0,  # procesos de análisis por IP (0 = análisis en el proceso principal)
+                'backfill_workers': 0,  # 0 = todos los núcleos
+                'backfill_chunk_bytes': 16 * 1024 * 1024,
+                'read_chunk_size': 1024 * 1024,  # bytes por lectura
+                'export_batch_rows': 50000,  # filas por lote al escribir Parquet
+                'metrics_top_k': 100,  # países y patrones de ataque seguidos en tiempo real
+                'metrics_hours': 48,  # horas en el anillo de estadísticas en tiempo real
+                'batch_size': 500  # líneas por lote
             }
         }
         
@@ -145,13 +3228,66 @@ class IvorySecurityEngine:
             try:
                 with open(config_path, 'r') as f:
                     user_config = json.load(f)
-                    # Merge configurations
-                    default_config.update(user_config)
+                    # Merge configurations (por sección, para conservar claves nuevas)
+                    for section, values in user_config.items():
+                        if isinstance(values, dict) and isinstance(default_config.get(section), dict):
+                            default_config[section].update(values)
+                        else:
+                            default_config[section] = values
             except Exception as e:
                 logging.error(f"Error loading config: {e}")
         
         return default_config
     
+    def get_config_mtime(self) -> Optional[float]:
+        """🕐 Fecha de modificación del archivo de configuración"""
+        try:
+            return os.path.getmtime(self.config_path)
+        except OSError:
+            return None
+    
+    def reload_config(self):
+        """🔄 Recargar configuración y reconstruir las estructuras derivadas"""
+        self.config = self.load_config(self.config_path)
+        self.config_mtime = self.get_config_mtime()
+        self.threat_matcher = ThreatMatcher(self.config['security'])
+        # Las características de comportamiento se normalizan con el límite por IP
+        self.behavior_tracker.rate_limit_per_minute = max(1, self.config['security']['rate_limit_per_ip'])
+        if not self.worker_mode:
+            self.htaccess_writer.flush_interval = self.config['optimization']['htaccess_flush_interval']
+            self.htaccess_writer.aggregate = self.config['optimization']['aggregate_cidr']
+            self.htaccess_writer.prefix_block = self.config['security']['prefix_block']
+        self.tracer.configure(self.config['monitoring']['tracing'], self.config['monitoring']['trace_sample_rate'])
+        self.logger.info("🔄 Configuración recargada")
+    
+    def refresh_worker_state(self):
+        """👀 (workers) Recoger los cambios que el proceso principal deja en disco
+        
+        Como ModelStore.maybe_refresh: como mucho cada scan_interval segundos
+        se comparan los mtime del archivo de configuración y del manifiesto
+        de reputación; si cambian se recargan el ThreatMatcher y los umbrales
+        o se mapea el índice nuevo que ha construido el proceso principal.
+        """
+        if time.monotonic() < self.worker_refresh_deadline:
+            return
+        self.worker_refresh_deadline = time.monotonic() + self.config['monitoring']['scan_interval']
+        
+        try:
+            if self.get_config_mtime() != self.config_mtime:
+                self.reload_config()
+        except Exception as e:
+            self.logger.error(f"❌ Error recargando configuración en el worker: {e}")
+        
+        try:
+            if self.config['reputation']['enable_feeds'] and \
+                    self.get_reputation_manifest_mtime() != self.reputation_manifest_mtime:
+                manifest = read_reputation_manifest(self.config['reputation']['index_dir'])
+                if manifest and manifest['feeds']:
+                    self.swap_reputation_index(self.open_reputation_index(manifest))
+                    self.logger.info("🌐 Índice de reputación recargado en el worker")
+        except Exception as e:
+            self.logger.error(f"❌ Error recargando reputación en el worker: {e}")
+    
     def setup_logging(self):
         """📝 Configurar sistema de logging avanzado"""
         log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -167,42 +3303,19 @@ class IvorySecurityEngine:
     
     def setup_database(self):
         """🗄️ Configurar base de datos avanzada"""
-        self.db_path = "ivory_security_advanced.db"
+        self.db_path = self.DB_PATH
         conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')  # Lectores no bloquean al escritor
         cursor = conn.cursor()
         
-        # Tabla de eventos de seguridad
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS security_events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                ip TEXT NOT NULL,
-                country TEXT,
-                user_agent TEXT,
-                request_path TEXT,
-                response_code INTEGER,
-                threat_type TEXT,
-                threat_level TEXT,
-                blocked BOOLEAN DEFAULT FALSE,
-                ml_score REAL
-            )
-        ''')
-        
-        # Crear índices por separado
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_security_events_ip_timestamp 
-            ON security_events(ip, timestamp)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_security_events_timestamp 
-            ON security_events(timestamp)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_security_events_threat_level 
-            ON security_events(threat_level)
-        ''')
+        # Eventos de seguridad: una partición por día (la tabla única anterior se migra una vez)
+        partitions = EventPartitions()
+        migrated = partitions.migrate_legacy(conn)
+        if migrated:
+            self.logger.info(f"🗂️ {migrated} eventos migrados a particiones diarias")
+        with conn:
+            partitions.ensure(conn, format_db_timestamp(datetime.now(timezone.utc))[:10])
+        self.prune_event_partitions(conn)
         
         # Tabla de inteligencia de IPs
         cursor.execute('''
@@ -216,10 +3329,16 @@ class IvorySecurityEngine:
                 reputation_sources TEXT,
                 last_seen DATETIME,
                 attack_patterns TEXT,
-                blocked_count INTEGER DEFAULT 0
+                blocked_count INTEGER DEFAULT 0,
+                country_code TEXT DEFAULT 'XX'
             )
         ''')
         
+        # Bases anteriores: la tabla se creó sin country_code
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(ip_intelligence)')}
+        if 'country_code' not in columns:
+            cursor.execute("ALTER TABLE ip_intelligence ADD COLUMN country_code TEXT DEFAULT 'XX'")
+        
         # Tabla de estadísticas por hora
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS hourly_stats (
@@ -230,133 +3349,356 @@ class IvorySecurityEngine:
                 top_threat_country TEXT,
                 avg_threat_score REAL
             )
-        ''')
+        ''')
+        
+        # Rollups incrementales (mantenidos por el escritor de eventos)
+        rollups_exist = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_hour'"
+        ).fetchone() is not None
+        
+        for granularity in ('minute', 'hour', 'day'):
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS rollup_{granularity} (
+                    bucket TEXT PRIMARY KEY,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    score_sum REAL NOT NULL DEFAULT 0,
+                    ip_sketch BLOB
+                )
+            ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_dimensions (
+                granularity TEXT,
+                bucket TEXT,
+                dimension TEXT,
+                value TEXT,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (granularity, bucket, dimension, value)
+            )
+        ''')
+        
+        # Checkpoints de lectura de logs (reanudar tras reinicio o rotación)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS log_checkpoints (
+                path TEXT PRIMARY KEY,
+                device INTEGER,
+                inode INTEGER,
+                offset INTEGER,
+                last_line_hash TEXT,
+                updated_at DATETIME
+            )
+        ''')
+        
+        # Progreso del backfill por archivo (huella de la primera línea): reimportar no duplica
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS backfill_progress (
+                fingerprint TEXT PRIMARY KEY,
+                path TEXT,
+                offset INTEGER,
+                updated_at DATETIME
+            )
+        ''')
+        
+        conn.commit()
+        
+        if not rollups_exist:
+            self.rebuild_rollups(conn)
+        
+        conn.close()
+    
+    def rebuild_rollups(self, conn: sqlite3.Connection):
+        """📈 Poblar los rollups una única vez a partir de los eventos existentes"""
+        since = datetime.now(timezone.utc) - timedelta(days=self.config['monitoring']['log_rotation_days'])
+        events = EventPartitions.select(conn, EventPartitions.COLUMNS, since)
+        
+        aggregator = RollupAggregator()
+        rows = 0
+        while True:
+            chunk = list(itertools.islice(events, 10000))
+            if not chunk:
+                break
+            aggregator.add_rows(chunk)
+            rows += len(chunk)
+        aggregator.flush(conn)
+        
+        if rows:
+            self.logger.info(f"📈 Rollups reconstruidos a partir de {rows} eventos")
+    
+    def setup_rate_limiter(self):
+        """🚦 Crear el limitador en memoria y precargarlo desde la BD"""
+        self.rate_limiter = SlidingWindowRateLimiter(
+            max_ips=self.config['optimization']['rate_limiter_max_ips'],
+            idle_seconds=self.config['optimization']['rate_limiter_idle_seconds']
+        )
+        self.behavior_tracker = IPBehaviorTracker(
+            self.config['security']['rate_limit_per_ip'],
+            max_ips=self.config['optimization']['behavior_max_ips'],
+            idle_seconds=self.config['optimization']['behavior_idle_seconds']
+        )
+        
+        if self.worker_mode:
+            return
+        
+        try:
+            conn = sqlite3.connect(self.db_path)
+            # Eventos de las últimas 24 horas (solo sus particiones) para que las decisiones sobrevivan a reinicios
+            recent = EventPartitions.select(
+                conn, "ip, CAST(strftime('%s', timestamp) AS INTEGER), threat_level, ml_score",
+                datetime.now(timezone.utc) - timedelta(hours=24), order_by_time=True
+            )
+            
+            loaded = 0
+            for ip, epoch, threat_level, ml_score in recent:
+                self.rate_limiter.record(ip, threat_level in ('HIGH', 'CRITICAL'), ml_score or 0.0, epoch)
+                loaded += 1
+            conn.close()
+            
+            if loaded:
+                self.logger.info(f"🚦 Limitador precargado con {loaded} eventos recientes")
+                
+        except Exception as e:
+            self.logger.error(f"❌ Error precargando limitador: {e}")
+    
+    def setup_geoip(self):
+        """🌍 Preparar la caché GeoIP (los lectores se abren en la primera consulta)"""
+        self.geo_readers: Optional[Tuple] = None
         
-        conn.commit()
-        conn.close()
+        if self.config['optimization']['cache_geoip_lookups']:
+            self.geo_cache = LRUCache(self.config['optimization']['geoip_cache_size'])
+        else:
+            self.geo_cache = None
+    
+    def open_geo_readers(self) -> Tuple:
+        """🌍 Abrir una sola vez los lectores GeoIP (país, ciudad)"""
+        if self.geo_readers is None:
+            self.geo_readers = (
+                self.open_geo_reader(self.config['paths']['geoip_db']),
+                self.open_geo_reader(self.config['paths']['city_db'])
+            )
+        return self.geo_readers
+    
+    @property
+    def geo_reader(self):
+        return self.open_geo_readers()[0]
+    
+    @property
+    def city_reader(self):
+        return self.open_geo_readers()[1]
+    
+    def open_geo_reader(self, db_path: str):
+        """🌍 Abrir una base de datos GeoIP (None si no está disponible)"""
+        try:
+            import geoip2.database
+            reader = geoip2.database.Reader(db_path)
+            self.logger.info(f"🌍 Base de datos GeoIP abierta: {db_path}")
+            return reader
+        except Exception as e:
+            self.logger.warning(f"⚠️ GeoIP no disponible ({db_path}): {e}")
+            return None
     
     def setup_ai_models(self):
-        """🤖 Configurar modelos de IA"""
-        if self.config['ai']['anomaly_detection']:
-            try:
-                # Intentar cargar modelo existente
-                if os.path.exists('anomaly_model.pkl'):
-                    self.anomaly_detector = joblib.load('anomaly_model.pkl')
-                    self.logger.info("🤖 Modelo de anomalías cargado exitosamente")
-                else:
-                    self.logger.info("🤖 Entrenando nuevo modelo de anomalías...")
-                    self.train_anomaly_model()
-            except Exception as e:
-                self.logger.error(f"❌ Error configurando IA: {e}")
+        """🤖 Configurar modelos de IA (se cargan o entrenan en el primer uso)"""
+        self.models = ModelStore(
+            self.config['ai']['model_dir'],
+            {
+                'anomaly_model': self.train_anomaly_model,
+                'threat_behavior_model': self.train_threat_prediction_model  # entradas por IP (antes por línea)
+            },
+            logger=self.logger
+        )
+        
+        # Aprendizaje incremental: muestra reciente de características y estado del reentrenamiento
+        ai_config = self.config['ai']
+        self.feature_reservoir = FeatureReservoir(ai_config['reservoir_size'], ai_config['reservoir_half_life'])
+        self.drift_reference: Optional[Tuple] = None  # (media, desviación) de la muestra del último entrenamiento
+        # Workers del pipeline: las características de cada lote se devuelven al principal
+        self.feature_outbox: Optional[List['np.ndarray']] = None
+        self.retrain_in_progress = False
+        self.last_retrain = time.monotonic()
+        self.learning_stats = {
+            'retrains': 0,
+            'last_reason': None,
+            'last_retrain_seconds': 0.0,
+            'last_fit_seconds': 0.0,
+            'last_samples': 0,
+            'last_drift': 0.0,
+            'errors': 0
+        }
     
-    def load_reputation_feeds(self) -> Dict[str, Set[str]]:
-        """🌐 Cargar feeds de reputación de IPs"""
-        feeds = {'malicious_ips': set(), 'tor_nodes': set(), 'botnets': set()}
+    @property
+    def anomaly_detector(self):
+        """🤖 IsolationForest de anomalías (None si está desactivado)"""
+        return self.models.get('anomaly_model') if self.config['ai']['anomaly_detection'] else None
+    
+    @property
+    def threat_predictor(self):
+        """🧠 RandomForest de predicción de amenazas (None si está desactivado)"""
+        return self.models.get('threat_behavior_model') if self.config['ai']['threat_prediction'] else None
+    
+    def load_reputation_feeds(self) -> ReputationIndex:
+        """🌐 Cargar feeds de reputación de IPs (IPs sueltas y CIDR) en el índice radix
+        
+        Cada archivo de reputation.feeds_dir aporta a la fuente que indica el
+        comienzo de su nombre (malicious_ips*, tor_nodes*, botnets*); el resto
+        se consideran IPs maliciosas. Si ya hay un índice construido en
+        reputation.index_dir se mapea directamente; si no, se construye aquí
+        una vez y después lo mantiene reputation_update_task en segundo plano.
+        """
+        index = ReputationIndex()
+        self.reputation_manifest_mtime = self.get_reputation_manifest_mtime()
         
         if not self.config['reputation']['enable_feeds']:
-            return feeds
+            return index
         
         try:
-            # Simulación de carga de feeds (en producción, descargar desde URLs)
-            sample_malicious_ips = [
-                '1.2.3.4', '5.6.7.8', '9.10.11.12', 
-                '192.168.100.100', '10.0.0.200'
-            ]
-            feeds['malicious_ips'].update(sample_malicious_ips)
-            self.logger.info(f"🌐 Cargados {len(feeds['malicious_ips'])} IPs maliciosos")
+            reputation_config = self.config['reputation']
+            manifest = read_reputation_manifest(reputation_config['index_dir'])
+            if manifest is None:
+                manifest = build_reputation_index(reputation_config['feeds_dir'], reputation_config['index_dir'])
+                self.reputation_manifest_mtime = self.get_reputation_manifest_mtime()
+            
+            if manifest and manifest['feeds']:
+                index = self.open_reputation_index(manifest)
+            else:
+                # Simulación de carga de feeds (en producción, descargar desde URLs)
+                sample_malicious_ips = [
+                    '1.2.3.4', '5.6.7.8', '9.10.11.12', 
+                    '192.168.100.100', '10.0.0.200'
+                ]
+                for ip in sample_malicious_ips:
+                    index.add(ip, 'malicious_ips')
+            
+            self.logger.info(f"🌐 Cargados {index.counts['malicious_ips']} IPs/rangos maliciosos")
             
         except Exception as e:
             self.logger.error(f"❌ Error cargando feeds de reputación: {e}")
         
-        return feeds
+        return index
     
-    def train_anomaly_model(self):
-        """🎓 Entrenar modelo de detección de anomalías"""
+    def get_reputation_manifest_mtime(self) -> Optional[int]:
+        """🕐 mtime del manifiesto del índice de reputación (None si no existe)"""
         try:
-            # Generar datos de entrenamiento simulados
-            # En producción, usar datos históricos reales
-            normal_patterns = np.random.normal(0, 1, (1000, 5))
-            anomaly_patterns = np.random.normal(3, 2, (50, 5))
-            
-            training_data = np.vstack([normal_patterns, anomaly_patterns])
-            
-            # Entrenar Isolation Forest
-            self.anomaly_detector = IsolationForest(
-                contamination=0.1,
-                random_state=42,
-                n_estimators=100
-            )
-            self.anomaly_detector.fit(training_data)
-            
-            # Guardar modelo
-            joblib.dump(self.anomaly_detector, 'anomaly_model.pkl')
-            self.logger.info("🎓 Modelo de anomalías entrenado y guardado")
-            
-        except Exception as e:
-            self.logger.error(f"❌ Error entrenando modelo IA: {e}")
+            return os.stat(os.path.join(self.config['reputation']['index_dir'], 'manifest.json')).st_mtime_ns
+        except OSError:
+            return None
     
-    def load_or_train_ml_model(self):
-        """🧠 Cargar o entrenar modelo de ML"""
-        model_path = 'threat_prediction_model.pkl'
-        if os.path.exists(model_path):
-            try:
-                self.threat_predictor = joblib.load(model_path)
-                self.logger.info("🧠 Modelo de predicción de amenazas cargado")
-            except:
-                self.train_threat_prediction_model()
+    def swap_reputation_index(self, index: ReputationIndex):
+        """🔀 Sustituir el índice en uso e invalidar la reputación cacheada por IP"""
+        self.reputation_index = index
+        self.reputation_manifest_mtime = self.get_reputation_manifest_mtime()
+        self.ip_intelligence.reputation_version += 1  # revalidar la reputación cacheada por IP
+    
+    def open_reputation_index(self, manifest: Dict) -> ReputationIndex:
+        """🗺️ Mapear el índice que describe el manifiesto"""
+        index = ReputationIndex.load(os.path.join(self.config['reputation']['index_dir'], manifest['index_file']))
+        for name, info in sorted(manifest['feeds'].items()):
+            self.logger.info(f"🌐 Feed {name}: {info['entries']} entradas ({info['source']})")
+        return index
+    
+    async def refresh_reputation_index(self):
+        """🔄 Reconstruir el índice en un proceso aparte e intercambiarlo sin detener el análisis
+        
+        La construcción (parseo, árbol radix y serialización) ocurre fuera de
+        este proceso; aquí solo se mapea el archivo resultante y se sustituye
+        la referencia self.reputation_index, que las búsquedas leen una vez.
+        """
+        reputation_config = self.config['reputation']
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            manifest = await loop.run_in_executor(
+                executor, build_reputation_index, reputation_config['feeds_dir'], reputation_config['index_dir']
+            )
+        
+        if manifest is None:
+            self.logger.info("🌐 Feeds de reputación sin cambios (checksum), índice actual conservado")
+            return
+        
+        if manifest['feeds']:
+            index = self.open_reputation_index(manifest)
         else:
-            self.train_threat_prediction_model()
+            index = self.load_reputation_feeds()
+        # Los workers del pipeline ven el cambio de mtime del manifiesto y mapean el mismo archivo
+        self.swap_reputation_index(index)
+        self.logger.info(f"🌐 Índice de reputación actualizado en {manifest['build_seconds']}s: "
+                         f"{index.get_stats()['entries']} entradas")
+    
+    def train_anomaly_model(self):
+        """🎓 Entrenar modelo de detección de anomalías"""
+        import numpy as np
+        
+        # Generar datos de entrenamiento simulados
+        # En producción, usar datos históricos reales
+        normal_patterns = np.random.normal(0, 1, (1000, 5))
+        anomaly_patterns = np.random.normal(3, 2, (50, 5))
+        
+        training_data = np.vstack([normal_patterns, anomaly_patterns])
+        
+        # Entrenar Isolation Forest
+        anomaly_detector = new_anomaly_model()
+        anomaly_detector.fit(training_data)
+        self.logger.info("🎓 Modelo de anomalías entrenado")
+        return anomaly_detector
     
     def train_threat_prediction_model(self):
         """🎯 Entrenar modelo de predicción de amenazas"""
         # Implementación simplificada - en producción usar datos reales
+        import numpy as np
         from sklearn.ensemble import RandomForestClassifier
         
-        # Características: [requests_per_minute, unique_paths, error_rate, geo_risk, ua_risk]
+        # Características (IPBehaviorTracker): [requests_per_minute, unique_paths, error_rate, geo_risk, ua_risk]
         X_train = np.random.rand(1000, 5)
-        y_train = np.random.choice([0, 1], 1000, p=[0.8, 0.2])  # 20% amenazas
-        
-        self.threat_predictor = RandomForestClassifier(n_estimators=100, random_state=42)
-        self.threat_predictor.fit(X_train, y_train)
+        # Etiquetas sintéticas coherentes con esas entradas: ráfagas, escaneo con errores, UA o país de riesgo
+        y_train = ((X_train[:, 0] > 0.8) | ((X_train[:, 1] > 0.6) & (X_train[:, 2] > 0.5)) |
+                   (X_train[:, 4] > 0.85) | ((X_train[:, 3] > 0.9) & (X_train[:, 0] > 0.4))).astype(int)
         
-        joblib.dump(self.threat_predictor, 'threat_prediction_model.pkl')
+        threat_predictor = RandomForestClassifier(n_estimators=100, random_state=42)
+        threat_predictor.fit(X_train, y_train)
         self.logger.info("🎯 Modelo de predicción entrenado")
+        return threat_predictor
     
     async def process_log_line_advanced(self, line: str) -> Optional[SecurityEvent]:
         """🔍 Procesamiento avanzado de línea de log"""
-        # Patrón Apache Common Log Format + Combined
-        pattern = r'^(\S+) \S+ \S+ \[(.*?)\] "(.*?)" (\d+) (\d+|-) "(.*?)" "(.*?)"'
-        match = re.match(pattern, line)
-        
-        if not match:
-            return None
-        
-        ip, timestamp_str, request, status_code, size, referer, user_agent = match.groups()
+        tracer = self.tracer
+        tracing = tracer.enabled and tracer.begin()
+        started = time.perf_counter() if tracing else 0.0
+        record = self.parse_log_line(line)
+        if tracing:
+            tracer.span('line.parse', started)
         
+        event = self.analyze_record(record) if record else None
+        if tracing:
+            tracer.end(event)
+        return event
+    
+    def analyze_record(self, record: Dict) -> Optional[SecurityEvent]:
+        """🔍 Analizar un registro ya parseado"""
+        started = time.perf_counter()
+        tracer = self.tracer
+        tracing = tracer.enabled
         try:
-            # Validar IP
-            ipaddress.ip_address(ip)
-            
-            # Obtener información geográfica
-            country_info = self.get_geo_info(ip)
+            # Geo y reputación: desde la caché de inteligencia si la IP ya es conocida
+            intel = self.get_ip_intelligence(record['ip'])
+            mark = tracer.span('line.intel', started) if tracing else 0.0
             
             # Analizar amenaza
-            threat_analysis = self.analyze_threat(ip, user_agent, request, int(status_code))
+            threat_analysis = self.analyze_threat(
+                record['ip'], record['user_agent'], record['request'],
+                record['status_code'], intel=intel
+            )
+            if tracing:
+                mark = tracer.span('line.threat', mark)
             
             # Crear evento de seguridad
-            event = SecurityEvent(
-                timestamp=datetime.now(),
-                ip=ip,
-                country=country_info.get('country', 'Unknown'),
-                user_agent=user_agent,
-                threat_type=threat_analysis['type'],
-                threat_level=threat_analysis['level'],
-                request_path=request.split()[1] if len(request.split()) > 1 else '',
-                response_code=int(status_code)
-            )
+            event = self.build_security_event(record, intel.country, threat_analysis)
             
             # Actualizar estadísticas
+            self.update_ip_intelligence(intel, event)
             self.update_real_time_stats(event)
+            self.ip_intelligence.maybe_flush()
+            if tracing:
+                tracer.span('line.update', mark)
+            self.stage_latency['analyze'].observe(time.perf_counter() - started)
             
             return event
             
@@ -364,62 +3706,328 @@ class IvorySecurityEngine:
             self.logger.error(f"❌ Error procesando línea: {e}")
             return None
     
+    def parse_log_line(self, line: str) -> Optional[Dict]:
+        """📝 Parsear una línea Apache (None si no es válida)"""
+        match = APACHE_LOG_PATTERN.match(line)
+        
+        if not match:
+            return None
+        
+        ip, timestamp_str, request, status_code, size, referer, user_agent = match.groups()
+        
+        # Validar IP
+        if not is_valid_ip(ip):
+            return None
+        
+        return {
+            'ip': ip,
+            'timestamp_str': timestamp_str,
+            'request': request,
+            'status_code': int(status_code),
+            'user_agent': user_agent
+        }
+    
+    def build_security_event(self, record: Dict, country: str, threat_analysis: Dict) -> SecurityEvent:
+        """📋 Construir el evento de seguridad a partir del análisis"""
+        request_parts = record['request'].split()
+        
+        return SecurityEvent(
+            timestamp=record.get('timestamp') or datetime.now(),
+            ip=record['ip'],
+            country=country,
+            user_agent=record['user_agent'],
+            threat_type=threat_analysis['type'],
+            threat_level=threat_analysis['level'],
+            request_path=request_parts[1] if len(request_parts) > 1 else '',
+            response_code=record['status_code'],
+            ml_score=threat_analysis['score']
+        )
+    
+    def analyze_records_batch(self, records: List[Dict]) -> List[SecurityEvent]:
+        """📦 Analizar un lote de registros con una sola llamada a los modelos"""
+        started = time.perf_counter()
+        # Inteligencia por IP: una consulta a la tabla para las IPs del lote que no estén en memoria
+        self.ip_intelligence.prefetch(record['ip'] for record in records)
+        intels = [self.get_ip_intelligence(record['ip']) for record in records]
+        
+        # Reglas (sin IA) para cada línea
+        analyses = [
+            self.analyze_threat_rules(
+                record['ip'], record['user_agent'], record['request'],
+                record['status_code'], intel=intel
+            )
+            for record, intel in zip(records, intels)
+        ]
+        
+        # IA: una sola matriz de características para todo el lote
+        if records:
+            import numpy as np
+            
+            features = self.extract_ml_features_batch(records)
+            self.observe_features(features)
+            # Ventanas por IP (en orden de llegada) para el predictor de amenazas
+            behavior_features = np.array([
+                self.record_behavior(record['ip'], record['user_agent'], record['request'],
+                                     record['status_code'], analysis, record.get('timestamp'))
+                for record, analysis in zip(records, analyses)
+            ])
+            anomaly_scores, threat_probabilities = self.score_ml_features(features, behavior_features)
+            
+            for i, analysis in enumerate(analyses):
+                self.apply_ml_scores(
+                    analysis,
+                    anomaly_scores[i] if anomaly_scores is not None else None,
+                    threat_probabilities[i] if threat_probabilities is not None else None
+                )
+        
+        events = []
+        for record, intel, analysis in zip(records, intels, analyses):
+            event = self.build_security_event(record, intel.country, self.finalize_threat_analysis(analysis))
+            self.update_ip_intelligence(intel, event)
+            self.update_real_time_stats(event)
+            events.append(event)
+        
+        self.ip_intelligence.maybe_flush()
+        self.stage_latency['analyze'].observe(time.perf_counter() - started)
+        return events
+    
+    async def process_log_batch(self, lines: List[str]) -> List[SecurityEvent]:
+        """📦 Procesar un lote de líneas como una unidad"""
+        started = time.perf_counter()
+        records = [record for record in map(self.parse_log_line, lines) if record]
+        self.stage_latency['parse'].observe(time.perf_counter() - started)
+        return await self.process_record_batch(records, len(lines), started)
+    
+    async def process_record_batch(self, records: List[Dict], line_count: Optional[int] = None,
+                                   started: Optional[float] = None) -> List[SecurityEvent]:
+        """📦 Procesar un lote de registros ya parseados"""
+        started = time.perf_counter() if started is None else started
+        
+        if self.pipeline is not None:
+            # Etapas 1 y 2 en los workers: cada uno analiza y decide sobre sus IPs
+            events, events_to_block = await self.analyze_in_pipeline(records)
+        else:
+            # Etapa 1: análisis (IA vectorizada) de todo el lote
+            try:
+                events = self.analyze_records_batch(records)
+            except Exception as e:
+                self.logger.error(f"❌ Error procesando lote: {e}")
+                events = []
+            
+            # Etapa 2: decisiones de bloqueo para todo el lote
+            events_to_block = [event for event in events if self.should_block_ip(event)]
+        
+        # Etapa 3: un único bloqueo (.htaccess) por lote
+        if events_to_block:
+            await self.block_events_batch(events_to_block)
+        
+        # Etapa 4: todos los eventos analizados a la cola de escritura
+        self.event_sink.submit_many(events)
+        
+        self.record_ingest(len(records) if line_count is None else line_count,
+                           time.perf_counter() - started, batches=1)
+        return events
+    
+    async def analyze_in_pipeline(self, records: List[Dict]) -> Tuple[List[SecurityEvent], List[SecurityEvent]]:
+        """🧵 Analizar en los workers por IP; el proceso principal solo agrega y bloquea"""
+        try:
+            results, features = await self.pipeline.analyze(records)
+            if features is not None:
+                # Los workers puntúan y devuelven sus características; la muestra se mantiene aquí
+                self.observe_features(features)
+        except BrokenProcessPool as e:
+            self.logger.error(f"❌ Pipeline de análisis caído, se continúa en el proceso principal: {e}")
+            self.stop_pipeline()
+            events = self.analyze_records_batch(records)
+            return events, [event for event in events if self.should_block_ip(event)]
+        
+        events = [event for event, _ in results]
+        for event in events:
+            self.update_aggregate_stats(event)
+        return events, [event for event, block in results if block]
+    
+    def start_pipeline(self):
+        """🧵 Arrancar los workers del pipeline si están configurados"""
+        workers = self.config['optimization']['pipeline_workers']
+        if workers > 0 and self.pipeline is None:
+            self.pipeline = AnalysisPipeline(self.config_path, workers,
+                                             self.config['optimization']['batch_size'],
+                                             latency=self.stage_latency)
+            self.logger.info(f"🧵 Pipeline de análisis con {workers} workers (fragmentado por IP)")
+    
+    def stop_pipeline(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+    
+    def record_ingest(self, lines: int, elapsed: float, batches: int = 0):
+        """⚡ Registrar líneas procesadas y tiempo empleado"""
+        self.ingest_stats['lines'] += lines
+        self.ingest_stats['batches'] += batches
+        self.ingest_stats['busy_seconds'] += elapsed
+    
+    def get_ingestion_rate(self) -> float:
+        """⚡ Líneas por segundo de procesamiento efectivo"""
+        busy = self.ingest_stats['busy_seconds']
+        return self.ingest_stats['lines'] / busy if busy > 0 else 0.0
+    
     def get_geo_info(self, ip: str) -> Dict[str, str]:
-        """🌍 Obtener información geográfica de IP"""
+        """🌍 Obtener información geográfica de IP (con caché LRU)"""
+        if self.geo_cache is not None:
+            geo_info = self.geo_cache.get(ip)
+            if geo_info is not None:
+                return geo_info
+        
+        started = time.perf_counter()
+        geo_info = self.lookup_geo_info(ip)
+        self.stage_latency['geo'].observe(time.perf_counter() - started)
+        
+        if self.geo_cache is not None:
+            self.geo_cache.put(ip, geo_info)
+        
+        return geo_info
+    
+    def get_ip_intelligence(self, ip: str) -> IPIntelligence:
+        """🧠 Inteligencia de una IP: de la caché si ya es conocida, si no GeoIP + reputación"""
+        cache = self.ip_intelligence
+        intel = cache.get(ip)
+        
+        if intel is None:
+            geo_info = self.get_geo_info(ip)
+            intel = IPIntelligence(
+                ip=ip,
+                country=geo_info.get('country', 'Unknown'),
+                region=geo_info.get('region', 'Unknown'),
+                city=geo_info.get('city', 'Unknown'),
+                isp=geo_info.get('isp', 'Unknown'),
+                threat_score=0.0,
+                reputation_sources=[],
+                last_seen=datetime.now(timezone.utc),
+                attack_patterns=[],
+                country_code=geo_info.get('country_code', 'XX')
+            )
+            cache.add(intel)
+        
+        # Reputación: solo se vuelve a consultar si el índice ha cambiado desde la última vez
+        if intel.reputation_version != cache.reputation_version:
+            mask = self.reputation_index.lookup(ip)
+            sources = [source for source, bit in REPUTATION_SOURCES.items() if mask & bit]
+            if sources != intel.reputation_sources:
+                intel.reputation_sources = sources
+                cache.mark_dirty(intel)
+            intel.reputation_version = cache.reputation_version
+        
+        return intel
+    
+    def update_ip_intelligence(self, intel: IPIntelligence, event: SecurityEvent):
+        """📝 Actualizar la inteligencia de la IP con un evento (se guarda en el próximo volcado)"""
+        intel.threat_score = max(intel.threat_score, event.ml_score)  # peor puntuación observada
+        intel.last_seen = datetime.fromtimestamp(event.epoch, timezone.utc)
+        if event.threat_type != "Normal" and event.threat_type not in intel.attack_patterns:
+            intel.attack_patterns.append(event.threat_type)
+            del intel.attack_patterns[:-IPIntelligenceCache.MAX_ATTACK_PATTERNS]
+        self.ip_intelligence.mark_dirty(intel)
+    
+    def lookup_geo_info(self, ip: str) -> Dict[str, str]:
+        """🌍 Consultar las bases GeoIP abiertas"""
+        if not self.geo_reader:
+            return {'country': 'Unknown', 'country_code': 'XX'}
+        
         try:
-            with geoip2.database.Reader(self.config['paths']['geoip_db']) as reader:
-                response = reader.country(ip)
-                
-                geo_info = {
-                    'country': response.country.name or 'Unknown',
-                    'country_code': response.country.iso_code or 'XX',
-                    'continent': response.continent.name or 'Unknown'
-                }
-                
-                # Intentar obtener información de ciudad si está disponible
+            response = self.geo_reader.country(ip)
+            
+            geo_info = {
+                'country': response.country.name or 'Unknown',
+                'country_code': response.country.iso_code or 'XX',
+                'continent': response.continent.name or 'Unknown'
+            }
+            
+            # Intentar obtener información de ciudad si está disponible
+            if self.city_reader:
                 try:
-                    with geoip2.database.Reader(self.config['paths']['city_db']) as city_reader:
-                        city_response = city_reader.city(ip)
-                        geo_info.update({
-                            'city': city_response.city.name or 'Unknown',
-                            'region': city_response.subdivisions.most_specific.name or 'Unknown'
-                        })
-                except:
+                    city_response = self.city_reader.city(ip)
+                    geo_info.update({
+                        'city': city_response.city.name or 'Unknown',
+                        'region': city_response.subdivisions.most_specific.name or 'Unknown'
+                    })
+                except Exception:
                     pass
-                
-                return geo_info
-                
+            
+            return geo_info
+            
         except Exception as e:
             return {'country': 'Unknown', 'country_code': 'XX'}
     
-    def analyze_threat(self, ip: str, user_agent: str, request: str, status_code: int) -> Dict:
+    def analyze_threat(self, ip: str, user_agent: str, request: str, status_code: int,
+                       geo_info: Optional[Dict] = None, intel: Optional[IPIntelligence] = None) -> Dict:
         """🎯 Análisis avanzado de amenazas con IA"""
+        tracer = self.tracer
+        tracing = tracer.enabled
+        started = time.perf_counter() if tracing else 0.0
+        analysis = self.analyze_threat_rules(ip, user_agent, request, status_code, geo_info, intel)
+        if tracing:
+            started = tracer.span('threat.rules', started)
+        
+        # 7. Usar IA para detectar anomalías
+        import numpy as np
+        features = np.array([self.extract_ml_features(ip, user_agent, request, status_code)])
+        self.observe_features(features)
+        behavior_features = np.array([self.record_behavior(ip, user_agent, request, status_code, analysis)])
+        if tracing:
+            started = tracer.span('threat.features', started)
+        anomaly_scores, threat_probabilities = self.score_ml_features(features, behavior_features)
+        self.apply_ml_scores(
+            analysis,
+            anomaly_scores[0] if anomaly_scores is not None else None,
+            threat_probabilities[0] if threat_probabilities is not None else None
+        )
+        if tracing:
+            tracer.span('threat.ml', started)
+        
+        return self.finalize_threat_analysis(analysis)
+    
+    def analyze_threat_rules(self, ip: str, user_agent: str, request: str, status_code: int,
+                             geo_info: Optional[Dict] = None, intel: Optional[IPIntelligence] = None) -> Dict:
+        """📏 Análisis de amenazas basado en reglas (sin IA)"""
         threat_score = 0.0
         threat_type = "Normal"
         threat_indicators = []
         
-        # 1. Verificar reputación de IP
-        if ip in self.reputation_feeds['malicious_ips']:
+        # 1. Verificar reputación de IP (IPs y rangos CIDR de los feeds)
+        reputation = intel.reputation_mask if intel is not None else self.reputation_index.lookup(ip)
+        if reputation & REPUTATION_SOURCES['malicious_ips']:
             threat_score += 0.8
             threat_indicators.append("IP en lista negra")
+        if reputation & REPUTATION_SOURCES['botnets']:
+            threat_score += 0.8
+            threat_indicators.append("IP de botnet")
+        if reputation & REPUTATION_SOURCES['tor_nodes']:
+            threat_score += 0.3
+            threat_indicators.append("Nodo de salida Tor")
         
         # 2. Analizar User Agent sospechoso
-        ua_lower = user_agent.lower()
-        for suspicious_ua in self.config['security']['suspicious_user_agents']:
-            if suspicious_ua in ua_lower:
-                threat_score += 0.6
-                threat_indicators.append(f"User-Agent sospechoso: {suspicious_ua}")
-                threat_type = "Bot Malicioso"
+        user_agent_hits = self.threat_matcher.match_user_agent(user_agent)
+        for suspicious_ua in user_agent_hits:
+            threat_score += 0.6
+            threat_indicators.append(f"User-Agent sospechoso: {suspicious_ua}")
+            threat_type = "Bot Malicioso"
         
         # 3. Verificar país bloqueado
-        geo_info = self.get_geo_info(ip)
-        if geo_info.get('country_code') in self.config['security']['blocked_countries']:
+        if intel is not None:
+            country_code, country = intel.country_code, intel.country
+        else:
+            if geo_info is None:
+                geo_info = self.get_geo_info(ip)
+            country_code, country = geo_info.get('country_code'), geo_info.get('country')
+        geo_blocked = country_code in self.config['security']['blocked_countries']
+        if geo_blocked:
             threat_score += 0.5
-            threat_indicators.append(f"País bloqueado: {geo_info.get('country')}")
+            threat_indicators.append(f"País bloqueado: {country}")
             threat_type = "Geo-Block"
         
-        # 4. Detectar patrones de ataque
-        if any(pattern in request.lower() for pattern in ['../../../', 'union select', '<script>', 'php://input']):
+        # 4. Detectar patrones de ataque (una sola pasada sobre la petición)
+        request_hits = self.threat_matcher.match_request(request)
+        if request_hits.get('attack'):
             threat_score += 0.9
             threat_indicators.append("Patrón de ataque detectado")
             threat_type = "Ataque Web"
@@ -430,29 +4038,90 @@ class IvorySecurityEngine:
             threat_indicators.append("Acceso no autorizado")
         
         # 6. Verificar paths honeypot
-        for honeypot in self.config['security']['honeypot_paths']:
-            if honeypot in request:
-                threat_score += 0.7
-                threat_indicators.append(f"Honeypot activado: {honeypot}")
-                threat_type = "Reconocimiento"
+        for honeypot in request_hits.get('honeypot', []):
+            threat_score += 0.7
+            threat_indicators.append(f"Honeypot activado: {honeypot}")
+            threat_type = "Reconocimiento"
+        
+        # 6b. Extensiones de archivos sensibles (backups, logs...)
+        if request_hits.get('extension'):
+            threat_score += 0.5
+            threat_indicators.append(f"Extensión bloqueada: {', '.join(request_hits['extension'])}")
+            threat_type = "Reconocimiento"
+        
+        return {
+            'type': threat_type,
+            'score': threat_score,
+            'indicators': threat_indicators,
+            'ua_suspicious': bool(user_agent_hits),
+            'geo_blocked': geo_blocked
+        }
+    
+    def record_behavior(self, ip: str, user_agent: str, request: str, status_code: int,
+                        analysis: Dict, timestamp: Optional[datetime] = None) -> List[float]:
+        """🕵️ Añadir la petición a la ventana de la IP y devolver sus características de comportamiento"""
+        parts = request.split()
+        path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+        
+        if analysis['ua_suspicious']:
+            ua_risk = 1.0
+        elif user_agent in ('', '-'):
+            ua_risk = 0.5
+        else:
+            ua_risk = 0.0
+        
+        return self.behavior_tracker.record(
+            ip, path, status_code, ua_risk,
+            geo_risk=1.0 if analysis['geo_blocked'] else 0.0,
+            timestamp=timestamp.timestamp() if timestamp is not None else None
+        )
+    
+    def score_ml_features(self, features: 'np.ndarray',
+                          behavior_features: Optional['np.ndarray'] = None) -> Tuple[Optional['np.ndarray'], Optional['np.ndarray']]:
+        """🤖 Puntuar un lote con una llamada por modelo
+        
+        features (por línea) alimenta al detector de anomalías;
+        behavior_features (ventanas por IP) al predictor de amenazas.
+        """
+        started = time.perf_counter()
+        anomaly_scores = None
+        threat_probabilities = None
+        self.models.maybe_refresh()  # modelos reentrenados por otro proceso
         
-        # 7. Usar IA para detectar anomalías
         if self.anomaly_detector and self.config['ai']['anomaly_detection']:
             try:
-                # Crear vector de características
-                features = self.extract_ml_features(ip, user_agent, request, status_code)
-                anomaly_score = self.anomaly_detector.decision_function([features])[0]
-                
-                if anomaly_score < -0.5:  # Threshold para anomalía
-                    threat_score += 0.6
-                    threat_indicators.append(f"IA: Anomalía detectada (score: {anomaly_score:.3f})")
-                    if threat_type == "Normal":
-                        threat_type = "Anomalía"
-            
+                anomaly_scores = self.anomaly_detector.decision_function(features)
             except Exception as e:
                 self.logger.error(f"Error en análisis IA: {e}")
         
-        # Determinar nivel de amenaza
+        if self.threat_predictor and self.config['ai']['threat_prediction']:
+            try:
+                threat_probabilities = self.threat_predictor.predict_proba(
+                    features if behavior_features is None else behavior_features
+                )[:, 1]
+            except Exception as e:
+                self.logger.error(f"Error en predicción IA: {e}")
+        
+        self.stage_latency['ml'].observe(time.perf_counter() - started)
+        return anomaly_scores, threat_probabilities
+    
+    def apply_ml_scores(self, analysis: Dict, anomaly_score: Optional[float],
+                        threat_probability: Optional[float]):
+        """🤖 Incorporar las puntuaciones de IA al análisis de una línea"""
+        if anomaly_score is not None and anomaly_score < -0.5:  # Threshold para anomalía
+            analysis['score'] += 0.6
+            analysis['indicators'].append(f"IA: Anomalía detectada (score: {anomaly_score:.3f})")
+            if analysis['type'] == "Normal":
+                analysis['type'] = "Anomalía"
+        
+        if threat_probability is not None and threat_probability >= self.config['ai']['confidence_threshold']:
+            analysis['score'] += 0.3
+            analysis['indicators'].append(f"IA: Amenaza predicha (p={threat_probability:.2f})")
+    
+    def finalize_threat_analysis(self, analysis: Dict) -> Dict:
+        """🚨 Determinar nivel de amenaza a partir de la puntuación"""
+        threat_score = analysis['score']
+        
         if threat_score >= 0.8:
             threat_level = ThreatLevel.CRITICAL
         elif threat_score >= 0.6:
@@ -462,12 +4131,8 @@ class IvorySecurityEngine:
         else:
             threat_level = ThreatLevel.LOW
         
-        return {
-            'type': threat_type,
-            'level': threat_level,
-            'score': threat_score,
-            'indicators': threat_indicators
-        }
+        analysis['level'] = threat_level
+        return analysis
     
     def extract_ml_features(self, ip: str, user_agent: str, request: str, status_code: int) -> List[float]:
         """🔢 Extraer características para ML"""
@@ -477,7 +4142,7 @@ class IvorySecurityEngine:
         features.append(min(len(user_agent) / 200.0, 1.0))
         
         # Feature 2: Número de caracteres especiales en request
-        special_chars = sum(1 for c in request if c in '!@#$%^&*()[]{}|;:,.<>?')
+        special_chars = sum(1 for c in request if c in ML_SPECIAL_CHARS)
         features.append(min(special_chars / 50.0, 1.0))
         
         # Feature 3: Es código de error (0 o 1)
@@ -493,251 +4158,250 @@ class IvorySecurityEngine:
         
         return features
     
-    def update_real_time_stats(self, event: SecurityEvent):
-        """📊 Actualizar estadísticas en tiempo real"""
-        self.stats['total_requests'] += 1
-        self.stats['unique_ips'].add(event.ip)
-        
-        if event.threat_level in [ThreatLevel.HIGH, ThreatLevel.CRITICAL]:
-            self.stats['blocked_requests'] += 1
-            self.stats['threat_countries'][event.country] += 1
-            self.stats['attack_patterns'][event.threat_type] += 1
-        
-        hour_key = event.timestamp.strftime('%Y-%m-%d %H:00:00')
-        self.stats['hourly_stats'][hour_key] += 1
-    
-    def should_block_ip(self, event: SecurityEvent) -> bool:
-        """🚫 Determinar si se debe bloquear una IP"""
-        # Bloqueo automático basado en nivel de amenaza
-        if event.threat_level == ThreatLevel.CRITICAL:
-            return True
-        
-        if event.threat_level == ThreatLevel.HIGH:
-            # Verificar historial de la IP
-            ip_history = self.get_ip_history(event.ip)
-            if ip_history['suspicious_requests'] >= self.config['security']['auto_block_threshold']:
-                return True
-        
-        # Verificar rate limiting
-        if self.check_rate_limit(event.ip):
-            return True
-        
-        return False
-    
-    def get_ip_history(self, ip: str) -> Dict:
-        """📋 Obtener historial de una IP"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Obtener estadísticas de las últimas 24 horas
-        yesterday = datetime.now() - timedelta(days=1)
-        cursor.execute('''
-            SELECT COUNT(*) as total_requests,
-                   SUM(CASE WHEN threat_level IN ('HIGH', 'CRITICAL') THEN 1 ELSE 0 END) as suspicious_requests,
-                   MAX(ml_score) as max_threat_score
-            FROM security_events 
-            WHERE ip = ? AND timestamp > ?
-        ''', (ip, yesterday))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        return {
-            'total_requests': result[0] or 0,
-            'suspicious_requests': result[1] or 0,
-            'max_threat_score': result[2] or 0.0
-        }
-    
-    def check_rate_limit(self, ip: str) -> bool:
-        """⏰ Verificar límite de velocidad"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Contar requests en el último minuto
-        one_minute_ago = datetime.now() - timedelta(minutes=1)
-        cursor.execute('''
-            SELECT COUNT(*) FROM security_events 
-            WHERE ip = ? AND timestamp > ?
-        ''', (ip, one_minute_ago))
-        
-        request_count = cursor.fetchone()[0]
-        conn.close()
+    def extract_ml_features_batch(self, records: List[Dict]) -> 'np.ndarray':
+        """🔢 Matriz de características (n_lineas x 5) para un lote"""
+        import numpy as np
+
+        user_agent_lengths = np.fromiter((len(r['user_agent']) for r in records), dtype=float, count=len(records))
+        special_chars = np.fromiter(
+            (len(r['request']) - len(r['request'].translate(ML_SPECIAL_CHARS_TABLE)) for r in records),
+            dtype=float, count=len(records)
+        )
+        status_codes = np.fromiter((r['status_code'] for r in records), dtype=float, count=len(records))
+        path_lengths = np.fromiter(
+            (len(parts[1]) if len(parts) > 1 else 0 for parts in (r['request'].split() for r in records)),
+            dtype=float, count=len(records)
+        )
         
-        return request_count > self.config['security']['rate_limit_per_ip']
-    
-    def update_htaccess_advanced(self, blocked_ips: Set[str]):
-        """🔧 Actualización avanzada de .htaccess con backup inteligente"""
-        htaccess_path = self.config['paths']['htaccess']
+        features = np.empty((len(records), 5))
+        features[:, 0] = np.minimum(user_agent_lengths / 200.0, 1.0)
+        features[:, 1] = np.minimum(special_chars / 50.0, 1.0)
+        features[:, 2] = (status_codes >= 400).astype(float)
+        features[:, 3] = np.minimum(path_lengths / 100.0, 1.0)
+        now = datetime.now()
+        features[:, 4] = np.fromiter(
+            ((r.get('timestamp') or now).hour for r in records), dtype=float, count=len(records)
+        ) / 24.0
         
-        try:
-            # Crear backup con timestamp
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_path = f"{htaccess_path}.backup_{timestamp}"
-            
-            if os.path.exists(htaccess_path):
-                shutil.copy2(htaccess_path, backup_path)
-                self.logger.info(f"💾 Backup creado: {backup_path}")
-            
-            # Leer contenido existente
-            content_lines = []
-            if os.path.exists(htaccess_path):
-                with open(htaccess_path, 'r', encoding='utf-8') as f:
-                    content_lines = f.readlines()
-            
-            # Marcadores mejorados
-            start_marker = "# BEGIN IVORY SECURITY ENGINE v2.0\n"
-            end_marker = "# END IVORY SECURITY ENGINE v2.0\n"
-            
-            # Filtrar contenido existente
-            new_content = []
-            in_ivory_block = False
-            existing_ips = set()
-            
-            for line in content_lines:
-                if start_marker.strip() in line:
-                    in_ivory_block = True
-                elif end_marker.strip() in line:
-                    in_ivory_block = False
-                elif not in_ivory_block:
-                    new_content.append(line)
-                elif "Require not ip" in line:
-                    # Extraer IP existente
-                    ip_match = re.search(r'Require not ip (\S+)', line)
-                    if ip_match:
-                        existing_ips.add(ip_match.group(1))
-            
-            # Combinar IPs existentes con nuevas
-            all_blocked_ips = existing_ips.union(blocked_ips)
-            
-            if all_blocked_ips:
-                # Generar nuevo bloque de seguridad
-                security_block = [
-                    f"\n{start_marker}",
-                    "# Auto-generated by Ivory Security Engine\n",
-                    f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n",
-                    f"# Total blocked IPs: {len(all_blocked_ips)}\n",
-                    "<RequireAll>\n",
-                    "    Require all granted\n"
-                ]
-                
-                # Añadir IPs bloqueadas ordenadas
-                for ip in sorted(all_blocked_ips):
-                    security_block.append(f"    Require not ip {ip}\n")
-                
-                security_block.extend([
-                    "</RequireAll>\n",
-                    end_marker
-                ])
-                
-                # Escribir archivo actualizado
-                new_content.extend(security_block)
-                
-                with open(htaccess_path, 'w', encoding='utf-8') as f:
-                    f.writelines(new_content)
-                
-                self.logger.info(f"✅ .htaccess actualizado: {len(all_blocked_ips)} IPs bloqueadas")
-                
-                # Limpiar backups antiguos
-                self.cleanup_old_backups(htaccess_path)
-                
-        except Exception as e:
-            self.logger.error(f"❌ Error actualizando .htaccess: {e}")
-            # Restaurar backup en caso de error
-            if 'backup_path' in locals() and os.path.exists(backup_path):
-                shutil.copy2(backup_path, htaccess_path)
-                self.logger.info("🔄 Backup restaurado debido a error")
-    
-    def cleanup_old_backups(self, htaccess_path: str):
-        """🧹 Limpiar backups antiguos"""
-        try:
-            backup_dir = os.path.dirname(htaccess_path)
-            backup_files = []
-            
-            for file in os.listdir(backup_dir):
-                if file.startswith(os.path.basename(htaccess_path) + '.backup_'):
-                    full_path = os.path.join(backup_dir, file)
-                    backup_files.append((full_path, os.path.getmtime(full_path)))
-            
-            # Ordenar por fecha y mantener solo los últimos N backups
-            backup_files.sort(key=lambda x: x[1], reverse=True)
-            retention_days = self.config['monitoring']['backup_retention_days']
-            
-            for backup_path, mtime in backup_files[retention_days:]:
-                os.remove(backup_path)
-                self.logger.info(f"🗑️ Backup eliminado: {os.path.basename(backup_path)}")
-                
-        except Exception as e:
-            self.logger.error(f"❌ Error limpiando backups: {e}")
+        return features
     
-    def generate_security_report(self) -> Dict:
-        """📊 Generar reporte avanzado de seguridad"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Estadísticas generales
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_events,
-                COUNT(DISTINCT ip) as unique_ips,
-                SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked_events,
-                AVG(ml_score) as avg_threat_score
-            FROM security_events 
-            WHERE timestamp > datetime('now', '-24 hours')
-        ''')
-        
-        general_stats = cursor.fetchone()
+    def update_real_time_stats(self, event: SecurityEvent):
+        """📊 Actualizar estadísticas en tiempo real"""
+        self.update_aggregate_stats(event)
         
-        # Top países amenazantes
-        cursor.execute('''
-            SELECT country, COUNT(*) as count 
-            FROM security_events 
-            WHERE threat_level IN ('HIGH', 'CRITICAL') 
-            AND timestamp > datetime('now', '-24 hours')
-            GROUP BY country 
-            ORDER BY count DESC 
-            LIMIT 10
-        ''')
+        # Ventanas deslizantes para rate limiting e historial
+        self.rate_limiter.record(
+            event.ip,
+            event.threat_level in (ThreatLevel.HIGH, ThreatLevel.CRITICAL),
+            event.ml_score,
+            event.epoch
+        )
+    
+    def update_aggregate_stats(self, event: SecurityEvent):
+        """📊 Contadores globales (sin estado por IP)"""
+        self.metrics.record(
+            event.epoch,
+            HyperLogLog.hash_int(event.packed_ip),
+            event.threat_level in (ThreatLevel.HIGH, ThreatLevel.CRITICAL),
+            event.country,
+            event.threat_type
+        )
+    
+    @property
+    def stats(self) -> Dict:
+        """📊 Estadísticas en tiempo real con el formato anterior (combinadas al leer)"""
+        return self.metrics.snapshot()
+    
+    def should_block_ip(self, event: SecurityEvent) -> bool:
+        """🚫 Determinar si se debe bloquear una IP (sin efectos: no cuenta el bloqueo)"""
+        tracing = self.tracer.enabled
+        started = time.perf_counter() if tracing else 0.0
+        block = self.evaluate_block_rules(event)
+        if tracing:
+            self.tracer.span('block.rules', started)
+        return block
+    
+    def count_blocks(self, events: List[SecurityEvent]):
+        """🔢 Sumar los bloqueos aplicados a la inteligencia de cada IP"""
+        for event in events:
+            intel = self.ip_intelligence.peek(event.ip)
+            if intel is not None:
+                intel.blocked_count += 1
+                self.ip_intelligence.mark_dirty(intel)
+    
+    def evaluate_block_rules(self, event: SecurityEvent,
+                             rate_limiter: Optional[SlidingWindowRateLimiter] = None) -> bool:
+        """📏 Reglas de bloqueo: nivel de amenaza, historial y rate limiting
         
-        top_threat_countries = cursor.fetchall()
+        Las ventanas se evalúan en el instante del evento (no en time.time()),
+        así un backfill de logs antiguos ve las mismas ráfagas que el directo.
+        """
+        # Bloqueo automático basado en nivel de amenaza
+        if event.threat_level == ThreatLevel.CRITICAL:
+            return True
         
-        # Tipos de amenazas más comunes
-        cursor.execute('''
-            SELECT threat_type, COUNT(*) as count 
-            FROM security_events 
-            WHERE timestamp > datetime('now', '-24 hours')
-            GROUP BY threat_type 
-            ORDER BY count DESC 
-            LIMIT 10
-        ''')
+        if event.threat_level == ThreatLevel.HIGH:
+            # Verificar historial de la IP
+            ip_history = self.get_ip_history(event.ip, event.epoch, rate_limiter)
+            if ip_history['suspicious_requests'] >= self.config['security']['auto_block_threshold']:
+                return True
         
-        top_threat_types = cursor.fetchall()
+        # Verificar rate limiting
+        if self.check_rate_limit(event.ip, event.epoch, rate_limiter):
+            return True
         
-        conn.close()
+        return False
+    
+    def get_ip_history(self, ip: str, timestamp: Optional[float] = None,
+                       rate_limiter: Optional[SlidingWindowRateLimiter] = None) -> Dict:
+        """📋 Obtener historial de una IP (últimas 24 horas, en memoria)"""
+        rate_limiter = self.rate_limiter if rate_limiter is None else rate_limiter
+        return rate_limiter.get_history(ip, timestamp)
+    
+    def check_rate_limit(self, ip: str, timestamp: Optional[float] = None,
+                         rate_limiter: Optional[SlidingWindowRateLimiter] = None) -> bool:
+        """⏰ Verificar límite de velocidad"""
+        rate_limiter = self.rate_limiter if rate_limiter is None else rate_limiter
+        request_count = rate_limiter.requests_last_minute(ip, timestamp)
+        return request_count > self.config['security']['rate_limit_per_ip']
+    
+    def update_htaccess_advanced(self, blocked_ips: Set[str], force: bool = False):
+        """🔧 Encolar IPs para .htaccess (volcado coalescente y atómico)"""
+        self.htaccess_writer.add(blocked_ips)
+        self.htaccess_writer.flush(force=force)
+    
+    @staticmethod
+    def summarize_window(window: Dict) -> Dict:
+        """📋 Estadísticas generales y rankings de una ventana de rollups"""
+        total = window['total']
+        return {
+            'general_stats': {
+                'total_events': total,
+                'unique_ips': window['unique_ips'],  # estimación HyperLogLog
+                'blocked_events': window['blocked'],
+                'avg_threat_score': round(window['score_sum'] / total if total else 0.0, 3),
+                'block_rate': round(window['blocked'] / max(total, 1) * 100, 2)
+            },
+            'top_threat_countries': [{'country': country, 'count': count}
+                                     for country, count in window['threat_country'].most_common(10)],
+            'top_threat_types': [{'type': threat_type, 'count': count}
+                                 for threat_type, count in window['threat_type'].most_common(10)]
+        }
+    
+    def generate_security_report(self) -> Dict:
+        """📊 Generar reporte avanzado de seguridad"""
+        # Lectura de rollups: coste constante aunque security_events crezca
+        conn = sqlite3.connect(self.db_path)
+        try:
+            window = read_rollup_window(conn, datetime.now(timezone.utc) - timedelta(hours=24))
+        finally:
+            conn.close()
         
         report = {
             'timestamp': datetime.now().isoformat(),
             'period': '24 hours',
-            'general_stats': {
-                'total_events': general_stats[0] or 0,
-                'unique_ips': general_stats[1] or 0,
-                'blocked_events': general_stats[2] or 0,
-                'avg_threat_score': round(general_stats[3] or 0.0, 3),
-                'block_rate': round((general_stats[2] or 0) / max(general_stats[0] or 1, 1) * 100, 2)
-            },
-            'top_threat_countries': [{'country': row[0], 'count': row[1]} for row in top_threat_countries],
-            'top_threat_types': [{'type': row[0], 'count': row[1]} for row in top_threat_types],
+            **self.summarize_window(window),
             'system_health': {
                 'monitoring_active': self.monitoring_active,
-                'ml_model_loaded': self.anomaly_detector is not None,
-                'reputation_feeds_count': len(self.reputation_feeds['malicious_ips']),
+                'ml_model_loaded': self.models.is_loaded('anomaly_model'),  # sin forzar la carga
+                'models': self.models.get_stats(),
+                'online_learning': dict(self.learning_stats, reservoir_size=len(self.feature_reservoir),
+                                        vectors_seen=self.feature_reservoir.seen,
+                                        retrain_in_progress=self.retrain_in_progress),
+                'ingest_lines_per_second': round(self.get_ingestion_rate(), 1),
+                'real_time': self.metrics.get_stats(),
+                'geoip_cache': self.geo_cache.get_stats() if self.geo_cache is not None else None,
+                'ip_intelligence': self.ip_intelligence.get_stats(),
+                'rate_limiter': self.rate_limiter.get_stats(),
+                'behavior_tracker': self.behavior_tracker.get_stats(),
+                'event_sink': self.event_sink.get_stats(),
+                'log_tailer': self.log_tailer.get_stats() if self.log_tailer is not None else None,
+                'pipeline': self.pipeline.get_stats() if self.pipeline is not None else None,
+                'reputation_feeds_count': self.reputation_index.counts['malicious_ips'],
+                'reputation_index': self.reputation_index.get_stats(),
                 'config_version': '2.0'
             }
         }
         
         return report
     
+    def generate_historical_report(self, start_day: str, end_day: str) -> Dict:
+        """🗓️ Reporte de un rango de días ('AAAA-MM-DD', ambos incluidos)
+        
+        Los días archivados por completo se leen de sus rollups en Parquet
+        (aunque la retención ya los haya borrado de SQLite); el resto, de
+        rollup_hour, salvo que SQLite ya no los tenga y haya un archivo parcial.
+        """
+        archive = self.columnar_archive()
+        archived = set(archive.archived_days())
+        window = new_rollup_window()
+        sources = {'archive_days': 0, 'database_days': 0}
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            day = start_day
+            while day <= end_day:
+                rows = dimension_rows = None
+                if not archive.is_complete(day):
+                    rows, dimension_rows = read_hour_rollups(conn, day)
+                
+                if day in archived and not rows:
+                    archive.read_day_window(day, window)
+                    sources['archive_days'] += 1
+                else:
+                    add_rollup_rows(window, (row[1:] for row in rows), (row[1:] for row in dimension_rows))
+                    sources['database_days'] += 1
+                day = next_day(day)
+        finally:
+            conn.close()
+        
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'period': f'{start_day} - {end_day}',
+            **self.summarize_window(finish_rollup_window(window)),
+            'sources': sources
+        }
+    
+    def columnar_archive(self) -> ColumnarArchive:
+        return ColumnarArchive(self.config['paths']['archive_dir'], self.config['optimization']['export_batch_rows'])
+    
+    def export_columnar_archive(self, include_today: bool = False, overwrite: bool = False) -> Dict[str, Dict]:
+        """🧊 Archivar en Parquet los días de security_events que aún no lo estén
+        
+        Solo se archivan días cerrados (UTC); con include_today también el día
+        en curso, que se vuelve a escribir en cada exportación. Un día que se
+        exportó sin haberse cerrado no queda completo y se vuelve a exportar.
+        """
+        archive = self.columnar_archive()
+        today = format_db_timestamp(datetime.now(timezone.utc))[:10]
+        exported = {}
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for partition in EventPartitions.list(conn):
+                day = EventPartitions.day_of(partition)
+                if day > today or (day == today and not include_today):
+                    continue
+                if day < today and archive.is_complete(day) and not overwrite:
+                    continue
+                exported[day] = archive.export_day(conn, day, complete=day < today)
+        finally:
+            conn.close()
+        
+        if exported:
+            events = sum(counts['events'] for counts in exported.values())
+            self.logger.info(f"🧊 {len(exported)} días archivados en {archive.archive_dir} ({events} eventos)")
+        return exported
+    
     def export_threat_intelligence(self, format_type: str = 'json') -> str:
         """📤 Exportar inteligencia de amenazas"""
+        if format_type.lower() == 'parquet':
+            # Eventos y rollups completos, por días, para análisis fuera de línea
+            self.export_columnar_archive(include_today=True)
+            output_file = self.config['paths']['archive_dir']
+            self.logger.info(f"📤 Inteligencia exportada: {output_file}")
+            return output_file
+        
         report = self.generate_security_report()
         
         if format_type.lower() == 'json':
@@ -762,35 +4426,40 @@ class IvorySecurityEngine:
         """🚀 Iniciar monitoreo avanzado con procesamiento asíncrono"""
         self.monitoring_active = True
         self.logger.info("🛡️ Iniciando monitoreo avanzado de seguridad...")
+        self.models.warm_up()
+        self.start_pipeline()
         
         tasks = [
             self.log_monitor_task(),
             self.reputation_update_task(),
             self.stats_aggregation_task(),
-            self.ml_retraining_task()
+            self.htaccess_flush_task(),
+            self.ml_retraining_task(),
+            self.config_watch_task(),
+            self.metrics_server_task()
         ]
         
         await asyncio.gather(*tasks)
     
     async def log_monitor_task(self):
-        """📊 Tarea de monitoreo de logs"""
+        """📊 Tarea de monitoreo de logs (reanuda desde el último checkpoint)"""
         log_path = self.config['paths']['apache_log']
         
         while self.monitoring_active:
             try:
                 if os.path.exists(log_path):
-                    # Procesar nuevas líneas del log
-                    async with aiofiles.open(log_path, 'r') as f:
-                        await f.seek(0, 2)  # Ir al final del archivo
-                        
-                        while self.monitoring_active:
-                            line = await f.readline()
-                            if line:
-                                event = await self.process_log_line_advanced(line.strip())
-                                if event and self.should_block_ip(event):
-                                    await self.block_ip_advanced(event.ip, event)
-                            else:
-                                await asyncio.sleep(1)
+                    tailer = LogTailer(
+                        log_path, self.db_path,
+                        poll_interval=self.config['optimization']['tail_poll_interval'],
+                        use_inotify=self.config['optimization']['use_inotify'],
+                        logger=self.logger
+                    )
+                    self.log_tailer = tailer
+                    try:
+                        tailer.open()
+                        await self.follow_log(tailer)
+                    finally:
+                        tailer.close()
                 
                 await asyncio.sleep(self.config['monitoring']['scan_interval'])
                 
@@ -798,21 +4467,121 @@ class IvorySecurityEngine:
                 self.logger.error(f"❌ Error en monitoreo de logs: {e}")
                 await asyncio.sleep(5)
     
+    async def follow_log(self, tailer: LogTailer):
+        """📡 Procesar el log por regiones, confirmando el checkpoint tras cada una"""
+        region_size = self.config['optimization']['read_chunk_size']
+        
+        while self.monitoring_active:
+            available = tailer.available_bytes()
+            if available > 0:
+                end = tailer.offset + min(available, region_size)
+                new_offset = await self.process_log_region(tailer.f, tailer.offset, end)
+                if new_offset == tailer.offset and available > region_size:
+                    # Línea más larga que la región: descartarla
+                    new_offset = end
+                if new_offset != tailer.offset:
+                    tailer.advance(new_offset)
+                    await asyncio.sleep(0)  # ceder el bucle entre regiones mientras haya atasco
+                    continue
+            
+            # Descriptor drenado: comprobar rotación/truncado antes de esperar
+            if not tailer.check_rotation():
+                await tailer.wait_for_data()
+    
+    async def process_log_region(self, f, start: int, end: int) -> int:
+        """🗺️ Parsear y procesar las líneas completas de [start, end) del log"""
+        started = time.perf_counter()
+        
+        if self.config['optimization']['mmap_log_reader']:
+            records, cut = read_log_region(f, start, end)
+        else:
+            f.seek(start)
+            data = f.read(end - start)
+            cut = start + data.rfind(b'\n') + 1
+            if cut <= start:
+                return start
+            lines = data[:cut - start].decode('utf-8', errors='replace').splitlines()
+            records = [record for record in map(self.parse_log_line, lines) if record]
+        self.stage_latency['parse'].observe(time.perf_counter() - started)
+        
+        # Sin pipeline el análisis no cede el bucle: se cede tras cada lote para que el
+        # endpoint de métricas y las tareas periódicas sigan atendiendo durante un atasco
+        batch_size = self.config['optimization']['batch_size']
+        if self.pipeline is not None:
+            # El pipeline reparte la región entera entre los workers
+            await self.process_record_batch(records, started=started)
+        elif self.config['optimization']['batch_process_logs']:
+            for i in range(0, len(records), batch_size):
+                await self.process_record_batch(records[i:i + batch_size], started=started)
+                await asyncio.sleep(0)
+                started = time.perf_counter()
+        else:
+            for i, record in enumerate(records, 1):
+                await self.process_single_record(record)
+                if i % batch_size == 0:
+                    await asyncio.sleep(0)
+        
+        return cut
+    
+    async def process_single_record(self, record: Dict):
+        """🔍 Modo línea a línea: analizar, bloquear y guardar un registro"""
+        started = time.perf_counter()
+        tracer = self.tracer
+        tracing = tracer.enabled and tracer.begin()
+        event = self.analyze_record(record)
+        if event and self.should_block_ip(event):
+            await self.block_ip_advanced(event.ip, event)
+        elif event:
+            await self.save_security_event(event)
+        if tracing:
+            tracer.end(event)
+        self.record_ingest(1, time.perf_counter() - started)
+    
+    async def block_events_batch(self, events: List[SecurityEvent]):
+        """🚫 Bloquear las IPs de un lote con una sola escritura de .htaccess"""
+        try:
+            for event in events:
+                event.blocked = True
+            
+            blocked_ips = {event.ip for event in events}
+            self.update_htaccess_advanced(blocked_ips)
+            if self.pipeline is None:
+                # Con pipeline la inteligencia de cada IP es del worker, que ya contó el bloqueo
+                self.count_blocks(events)
+            
+            for event in events:
+                if self.config['monitoring']['real_time_alerts']:
+                    await self.send_real_time_alert(event)
+                self.logger.warning(f"🚫 IP bloqueada: {event.ip} - {event.threat_type} ({event.threat_level.value})")
+            
+        except Exception as e:
+            self.logger.error(f"❌ Error bloqueando lote de IPs: {e}")
+    
     async def block_ip_advanced(self, ip: str, event: SecurityEvent):
         """🚫 Bloqueo avanzado de IP"""
+        tracer = self.tracer
+        tracing = tracer.enabled
+        started = time.perf_counter() if tracing else 0.0
         try:
             # Marcar evento como bloqueado
             event.blocked = True
+            self.count_blocks([event])
             
             # Guardar en base de datos
             await self.save_security_event(event)
+            if tracing:
+                started = tracer.span('block.save', started)
             
             # Actualizar .htaccess
             self.update_htaccess_advanced({ip})
+            if tracing:
+                started = tracer.span('block.htaccess', started)
             
             # Enviar alerta si está habilitada
             if self.config['monitoring']['real_time_alerts']:
                 await self.send_real_time_alert(event)
+            if tracing:
+                tracer.span('block.alert', started)
             
             self.logger.warning(f"🚫 IP bloqueada: {ip} - {event.threat_type} ({event.threat_level.value})")
             
@@ -820,23 +4589,8 @@ class IvorySecurityEngine:
             self.logger.error(f"❌ Error bloqueando IP {ip}: {e}")
     
     async def save_security_event(self, event: SecurityEvent):
-        """💾 Guardar evento de seguridad en base de datos"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO security_events 
-            (ip, country, user_agent, request_path, response_code, 
-             threat_type, threat_level, blocked, ml_score)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            event.ip, event.country, event.user_agent, event.request_path,
-            event.response_code, event.threat_type, event.threat_level.value,
-            event.blocked, 0.0  # ML score placeholder
-        ))
-        
-        conn.commit()
-        conn.close()
+        """💾 Guardar evento de seguridad (escritura diferida por lotes)"""
+        self.event_sink.submit(event)
     
     async def send_real_time_alert(self, event: SecurityEvent):
         """🚨 Enviar alerta en tiempo real"""
@@ -861,13 +4615,14 @@ class IvorySecurityEngine:
         """🌐 Tarea de actualización de feeds de reputación"""
         while self.monitoring_active:
             try:
-                # Actualizar feeds cada hora
-                await asyncio.sleep(self.config['reputation']['update_interval'])
-                self.reputation_feeds = self.load_reputation_feeds()
-                self.logger.info("🌐 Feeds de reputación actualizados")
+                if self.config['reputation']['enable_feeds']:
+                    await self.refresh_reputation_index()
                 
             except Exception as e:
                 self.logger.error(f"❌ Error actualizando reputación: {e}")
+            
+            # Actualizar feeds cada hora
+            await asyncio.sleep(self.config['reputation']['update_interval'])
     
     async def stats_aggregation_task(self):
         """📈 Tarea de agregación de estadísticas"""
@@ -876,90 +4631,819 @@ class IvorySecurityEngine:
                 await asyncio.sleep(3600)  # Cada hora
                 # Agregar estadísticas por hora
                 self.aggregate_hourly_stats()
+                if self.config['monitoring']['archive_closed_days']:
+                    self.export_columnar_archive()  # antes de que la retención borre esos días
+                self.prune_rollups()
+                self.prune_event_partitions()
                 self.logger.info("📈 Estadísticas agregadas")
                 
             except Exception as e:
                 self.logger.error(f"❌ Error agregando estadísticas: {e}")
     
+    async def htaccess_flush_task(self):
+        """🔧 Volcar periódicamente los bloqueos pendientes a .htaccess"""
+        while self.monitoring_active:
+            try:
+                await asyncio.sleep(self.htaccess_writer.flush_interval)
+                self.htaccess_writer.flush()
+                
+            except Exception as e:
+                self.logger.error(f"❌ Error volcando bloqueos: {e}")
+    
+    def ensure_control_token(self) -> str:
+        """🔑 Token de /control/*: se genera en el primer arranque y se guarda en la configuración"""
+        monitoring = self.config['monitoring']
+        if monitoring['control_token']:
+            return monitoring['control_token']
+        
+        token = monitoring['control_token'] = secrets.token_urlsafe(24)
+        try:
+            try:
+                with open(self.config_path, 'r') as f:
+                    stored = json.load(f)
+            except FileNotFoundError:
+                stored = {}
+            stored.setdefault('monitoring', {})['control_token'] = token
+            
+            partial = self.config_path + '.tmp'
+            with open(partial, 'w') as f:
+                json.dump(stored, f, indent=4)
+            os.replace(partial, self.config_path)
+            self.config_mtime = self.get_config_mtime()
+            self.logger.info(f"🔑 Token de control generado en {self.config_path} (monitoring.control_token)")
+        except (OSError, ValueError) as e:
+            # Sin guardarlo nadie lo conoce: los comandos quedan cerrados hasta configurar uno
+            self.logger.error(f"❌ No se pudo guardar el token de control: {e}")
+        return token
+    
+    async def metrics_server_task(self):
+        """📡 Endpoint local de métricas y control mientras dure el monitoreo"""
+        monitoring = self.config['monitoring']
+        if not monitoring['metrics_endpoint']:
+            return
+        
+        server = MetricsServer(self, monitoring['metrics_host'], monitoring['metrics_port'],
+                               self.ensure_control_token())
+        try:
+            await server.start()
+        except OSError as e:
+            self.logger.error(f"❌ Endpoint de métricas no disponible en "
+                              f"{monitoring['metrics_host']}:{monitoring['metrics_port']}: {e}")
+            return
+        
+        self.metrics_server = server
+        self.logger.info(f"📡 Métricas en http://{monitoring['metrics_host']}:{server.port}/metrics")
+        try:
+            while self.monitoring_active:
+                await asyncio.sleep(1)
+        finally:
+            await server.close()
+            self.metrics_server = None
+    
+    def get_live_metrics(self) -> Dict:
+        """📡 Estado del motor en memoria (sin consultas a la base de datos)"""
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'monitoring_active': self.monitoring_active,
+            'ingest': dict(self.ingest_stats, lines_per_second=round(self.get_ingestion_rate(), 1)),
+            'stages': {stage: histogram.get_stats() for stage, histogram in self.stage_latency.items()},
+            'queues': {
+                'event_sink': self.event_sink.queue.qsize(),
+                'htaccess_pending': len(self.htaccess_writer.pending),
+                'ip_intelligence_pending': len(self.ip_intelligence.pending)
+            },
+            'caches': {
+                'geoip': self.geo_cache.get_stats() if self.geo_cache is not None else None,
+                'ip_intelligence': self.ip_intelligence.get_stats()
+            },
+            'blocks': self.htaccess_writer.get_stats(),
+            'real_time': self.metrics.get_stats(),
+            'tracing': self.tracer.get_stats(),
+            'pipeline': self.pipeline.get_stats() if self.pipeline is not None else None
+        }
+    
+    async def capture_profile(self, seconds: float) -> Dict:
+        """🔬 Perfilar con cProfile el hilo del monitoreo durante N segundos
+        
+        Cubre el bucle de eventos (análisis, bloqueo y tareas); el hilo del
+        sink y los workers del pipeline quedan fuera. Guarda el volcado .prof
+        (pstats, snakeviz) y devuelve las funciones con más tiempo acumulado.
+        """
+        if self.profiling:
+            raise RuntimeError("Ya hay una captura de perfil en curso")
+        
+        import cProfile
+        import io
+        import pstats
+        
+        profiler = cProfile.Profile()
+        self.profiling = True
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self.profiling = False
+        
+        output_file = f"ivory_profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof"
+        profiler.dump_stats(output_file)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(20)
+        
+        self.logger.info(f"🔬 Perfil de {seconds}s guardado: {output_file}")
+        return {'file': os.path.abspath(output_file), 'seconds': seconds, 'summary': summary.getvalue()}
+    
+    async def flush_pending(self) -> Dict:
+        """⏬ Volcar ya los bloqueos, los eventos encolados y la inteligencia de IPs"""
+        htaccess_written = self.htaccess_writer.flush(force=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.event_sink.flush, 30.0)  # espera al hilo escritor
+        self.ip_intelligence.flush()
+        return {'htaccess_written': htaccess_written, 'event_queue': self.event_sink.queue.qsize()}
+    
+    async def config_watch_task(self):
+        """⚙️ Recargar la configuración cuando cambia el archivo"""
+        while self.monitoring_active:
+            try:
+                await asyncio.sleep(self.config['monitoring']['scan_interval'])
+                if self.get_config_mtime() != self.config_mtime:
+                    self.reload_config()
+                
+            except Exception as e:
+                self.logger.error(f"❌ Error recargando configuración: {e}")
+    
     async def ml_retraining_task(self):
-        """🤖 Tarea de reentrenamiento de IA"""
+        """🤖 Tarea de reentrenamiento incremental (programado o por deriva)"""
         while self.monitoring_active:
             try:
-                await asyncio.sleep(86400)  # Cada 24 horas
+                await asyncio.sleep(self.config['ai']['drift_check_interval'])
                 
-                if self.config['ai']['auto_learning']:
-                    # Reentrenar modelo con nuevos datos
-                    self.retrain_models_with_new_data()
-                    self.logger.info("🤖 Modelos de IA reentrenados")
+                reason = self.retrain_reason() if self.learning_enabled() else None
+                if reason:
+                    await self.retrain_anomaly_model(reason)
                 
             except Exception as e:
+                self.learning_stats['errors'] += 1
                 self.logger.error(f"❌ Error reentrenando IA: {e}")
     
+    def learning_enabled(self) -> bool:
+        """🎓 Solo el proceso principal mantiene la muestra y reentrena"""
+        return (not self.worker_mode and self.config['ai']['auto_learning']
+                and self.config['ai']['anomaly_detection'])
+    
+    def observe_features(self, features: 'np.ndarray'):
+        """🪣 Ofrecer las características de un lote a la muestra de reentrenamiento"""
+        if self.feature_outbox is not None:
+            self.feature_outbox.append(features)
+        elif self.learning_enabled():
+            self.feature_reservoir.add(features)
+    
+    def measure_drift(self) -> Optional[float]:
+        """📐 Mayor desplazamiento de la media reciente respecto al último entrenamiento (en desviaciones)"""
+        if self.drift_reference is None or self.feature_reservoir.window_count < self.config['ai']['drift_window']:
+            return None
+        
+        import numpy as np
+        mean, std = self.drift_reference
+        # Características normalizadas a [0, 1]: mínimo de 0.05 para las casi constantes
+        shift = np.abs(self.feature_reservoir.window_mean() - mean) / np.maximum(std, 0.05)
+        return float(shift.max())
+    
+    def retrain_reason(self) -> Optional[str]:
+        """❓ Motivo para reentrenar ahora (None si no hace falta o no hay muestras suficientes)"""
+        ai_config = self.config['ai']
+        if self.retrain_in_progress or len(self.feature_reservoir) < ai_config['min_retrain_samples']:
+            return None
+        
+        if self.drift_reference is None:
+            return 'initial'  # primer modelo entrenado con tráfico real en lugar de datos sintéticos
+        
+        drift = self.measure_drift()
+        if drift is not None:
+            self.learning_stats['last_drift'] = round(drift, 3)
+            if drift >= ai_config['drift_threshold']:
+                return 'drift'
+            self.feature_reservoir.reset_window()
+        
+        if time.monotonic() - self.last_retrain >= ai_config['retrain_interval']:
+            return 'scheduled'
+        return None
+    
+    async def retrain_anomaly_model(self, reason: str):
+        """🎓 Reentrenar con la muestra en un proceso aparte e intercambiar el modelo sin bloquear
+        
+        El análisis sigue puntuando con el modelo actual mientras se entrena;
+        al terminar, el nuevo archivo se mapea y se sustituye la referencia.
+        """
+        samples = self.feature_reservoir.snapshot()
+        self.retrain_in_progress = True
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = await loop.run_in_executor(
+                    executor, fit_anomaly_model, samples, self.config['ai']['model_dir']
+                )
+            self.models.reload('anomaly_model')
+        finally:
+            self.retrain_in_progress = False
+        
+        self.drift_reference = (samples.mean(axis=0), samples.std(axis=0))
+        self.feature_reservoir.reset_window()
+        self.last_retrain = time.monotonic()
+        
+        elapsed = time.perf_counter() - started
+        self.learning_stats.update(
+            last_reason=reason,
+            last_retrain_seconds=round(elapsed, 3),
+            last_fit_seconds=result['fit_seconds'],
+            last_samples=result['samples']
+        )
+        self.learning_stats['retrains'] += 1
+        self.logger.info(f"🎓 Modelo de anomalías reentrenado ({reason}) en {elapsed:.2f}s "
+                         f"con {result['samples']} muestras")
+    
     def aggregate_hourly_stats(self):
         """📊 Agregar estadísticas por hora"""
         conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        current_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+        current_hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO hourly_stats 
-            (hour_timestamp, total_requests, blocked_requests, unique_ips, avg_threat_score)
-            SELECT 
-                ? as hour_timestamp,
-                COUNT(*) as total_requests,
-                SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked_requests,
-                COUNT(DISTINCT ip) as unique_ips,
-                AVG(ml_score) as avg_threat_score
-            FROM security_events 
-            WHERE timestamp >= ? AND timestamp < ?
-        ''', (current_hour, current_hour, current_hour + timedelta(hours=1)))
+        # La hora anterior se completa con los últimos eventos de la anterior ejecución
+        try:
+            with conn:
+                write_hourly_stats(conn, [format_db_timestamp(hour) for hour in
+                                          (current_hour - timedelta(hours=1), current_hour)])
+        finally:
+            conn.close()
+    
+    def prune_event_partitions(self, conn: Optional[sqlite3.Connection] = None):
+        """🧹 Retención: eliminar las particiones diarias más antiguas que log_rotation_days"""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.config['monitoring']['log_rotation_days'])
+        own_connection = conn is None
+        conn = sqlite3.connect(self.db_path) if own_connection else conn
+        try:
+            expired = EventPartitions.drop_before(conn, format_db_timestamp(cutoff)[:10])
+        finally:
+            if own_connection:
+                conn.close()
         
-        conn.commit()
-        conn.close()
+        if expired:
+            self.logger.info(f"🧹 Particiones de eventos eliminadas: {', '.join(expired)}")
     
-    def retrain_models_with_new_data(self):
-        """🎓 Reentrenar modelos con datos nuevos"""
+    def prune_rollups(self):
+        """🧹 Eliminar rollups por minuto y por hora fuera de su retención"""
+        now = datetime.now(timezone.utc)
+        cutoffs = {
+            'minute': format_db_timestamp(now - timedelta(hours=self.config['optimization']['rollup_minute_retention_hours'])),
+            'hour': format_db_timestamp(now - timedelta(days=self.config['monitoring']['log_rotation_days']))
+        }
+        
+        conn = sqlite3.connect(self.db_path)
         try:
-            # Obtener datos recientes para reentrenamiento
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT ip, user_agent, request_path, response_code, threat_level, blocked
-                FROM security_events 
-                WHERE timestamp > datetime('now', '-7 days')
-                LIMIT 1000
-            ''')
-            
-            recent_data = cursor.fetchall()
+            with conn:
+                for granularity, cutoff in cutoffs.items():
+                    conn.execute(f'DELETE FROM rollup_{granularity} WHERE bucket < ?', (cutoff,))
+                    conn.execute('DELETE FROM rollup_dimensions WHERE granularity = ? AND bucket < ?',
+                                 (granularity, cutoff))
+        finally:
             conn.close()
-            
-            if len(recent_data) > 100:  # Suficientes datos para reentrenar
-                # Preparar datos para entrenamiento
-                X = []
-                y = []
-                
-                for row in recent_data:
-                    ip, user_agent, request_path, response_code, threat_level, blocked = row
-                    features = self.extract_ml_features(ip, user_agent or '', request_path or '', response_code or 200)
-                    X.append(features)
-                    y.append(1 if blocked else 0)
+    
+    def backfill_logs(self, log_paths: List[str], workers: Optional[int] = None,
+                      apply_blocks: bool = False) -> Dict:
+        """🗂️ Analizar logs históricos (incluidos rotados y .gz) en todos los núcleos
+        
+        Los archivos planos se dividen en rangos de bytes alineados a fin de
+        línea; cada rango se parsea y puntúa en un pool de procesos. Las
+        decisiones de bloqueo se toman aquí, recorriendo los rangos en orden
+        cronológico con un único rate limiter, para que las peticiones de una
+        IP repartidas entre rangos cuenten juntas. Cada archivo se identifica
+        por su primera línea y se guarda hasta dónde se importó: repetir el
+        backfill solo procesa lo nuevo (también tras una rotación).
+        """
+        started = time.perf_counter()
+        chunk_bytes = self.config['optimization']['backfill_chunk_bytes']
+        workers = workers or self.config['optimization']['backfill_workers'] or os.cpu_count()
+        
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        
+        imported = dict(conn.execute('SELECT fingerprint, offset FROM backfill_progress'))
+        tasks = []
+        skipped = 0
+        for path in log_paths:
+            fingerprint = log_fingerprint(path)
+            if not fingerprint:
+                continue
+            done = imported.get(fingerprint, 0)
+            if path.endswith('.gz'):
+                # Offset en bytes descomprimidos: un .gz nunca crece, pero puede ser la rotación de un log a medias
+                tasks.append((path, fingerprint, done, None))
+                continue
+            ranges = split_log_ranges(path, chunk_bytes, done)
+            if not ranges:
+                skipped += 1
+            tasks.extend((path, fingerprint, start, end) for start, end in ranges)
+        
+        self.logger.info(f"🗂️ Backfill: {len(log_paths)} archivos en {len(tasks)} rangos con {workers} procesos"
+                         f" ({skipped} ya importados)")
+        
+        totals = {'files': len(log_paths), 'ranges': len(tasks), 'skipped_files': skipped,
+                  'lines': 0, 'events': 0, 'workers': workers}
+        hours = set()
+        block_ips = set()
+        partitions = EventPartitions()
+        # Ventanas propias del backfill: no se mezclan con el tráfico en directo
+        rate_limiter = SlidingWindowRateLimiter(
+            max_ips=self.config['optimization']['rate_limiter_max_ips'],
+            idle_seconds=self.config['optimization']['rate_limiter_idle_seconds']
+        )
+        
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_backfill_worker,
+                                     initargs=(self.config_path,)) as pool:
+                # Como mucho 2 rangos por worker en vuelo: los resultados esperan en memoria
+                # a que se consuman en orden, así que no se encola todo el backfill de golpe
+                pending = iter(tasks)
+                in_flight = deque()
+                for path, fingerprint, start, end in itertools.islice(pending, 2 * workers):
+                    in_flight.append((path, fingerprint, pool.submit(_backfill_range, path, start, end)))
                 
-                # Reentrenar modelo de anomalías
-                if len(X) > 50:
-                    self.anomaly_detector.fit(X)
-                    joblib.dump(self.anomaly_detector, 'anomaly_model.pkl')
+                # En orden de envío (archivos de más antiguo a más nuevo): cronológico por IP
+                while in_flight:
+                    path, fingerprint, future = in_flight.popleft()
+                    result = future.result()
+                    for next_path, next_fingerprint, next_start, next_end in itertools.islice(pending, 1):
+                        in_flight.append((next_path, next_fingerprint,
+                                          pool.submit(_backfill_range, next_path, next_start, next_end)))
+                    rows = []
                     
-                    self.logger.info(f"🎓 Modelo reentrenado con {len(X)} nuevos ejemplos")
-            
-        except Exception as e:
-            self.logger.error(f"❌ Error reentrenando modelos: {e}")
+                    for event in result['events']:
+                        rate_limiter.record(
+                            event.ip,
+                            event.threat_level in (ThreatLevel.HIGH, ThreatLevel.CRITICAL),
+                            event.ml_score,
+                            event.epoch
+                        )
+                        if self.evaluate_block_rules(event, rate_limiter):
+                            block_ips.add(event.ip)
+                            event.blocked = apply_blocks
+                        rows.append(SecurityEventSink.to_row(event))
+                    
+                    # Horas del rango (UTC, mismo formato que los buckets de rollup_hour)
+                    range_hours = {row[0][:13] + ':00:00' for row in rows}
+                    hours |= range_hours
+                    
+                    # Eventos, rollups, hourly_stats y progreso del archivo en la misma transacción
+                    rollups = RollupAggregator()
+                    rollups.add_rows(rows)
+                    with conn:
+                        partitions.insert_rows(conn, rows)
+                        rollups.write(conn)
+                        write_hourly_stats(conn, sorted(range_hours))
+                        conn.execute('''
+                            INSERT OR REPLACE INTO backfill_progress (fingerprint, path, offset, updated_at)
+                            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                        ''', (fingerprint, path, result['end']))
+                    
+                    totals['lines'] += result['lines']
+                    totals['events'] += len(rows)
+        finally:
+            conn.close()
+        
+        if apply_blocks and block_ips:
+            self.update_htaccess_advanced(block_ips, force=True)
+        
+        elapsed = time.perf_counter() - started
+        totals.update({
+            'hours': len(hours),
+            'ips_to_block': len(block_ips),
+            'seconds': round(elapsed, 2),
+            'lines_per_second': round(totals['lines'] / elapsed, 1) if elapsed > 0 else 0.0
+        })
+        self.logger.info(f"🗂️ Backfill completado: {totals['lines']} líneas en {elapsed:.1f}s "
+                         f"({totals['lines_per_second']} líneas/s)")
+        return totals
     
     def stop_monitoring(self):
         """⏹️ Detener monitoreo"""
         self.monitoring_active = False
         self.logger.info("⏹️ Monitoreo de seguridad detenido")
+    
+    def close(self):
+        """🔒 Liberar recursos abiertos durante la vida del motor"""
+        self.stop_monitoring()
+        self.stop_pipeline()
+        self.htaccess_writer.flush(force=True)
+        self.event_sink.close()
+        self.ip_intelligence.close()
+        
+        for reader in self.geo_readers or ():
+            if reader:
+                reader.close()
+        self.geo_readers = None
+
+# ═══════════════════════════════════════════════════════════
+# 🗂️ BACKFILL PARALELO DE LOGS HISTÓRICOS
+# ═══════════════════════════════════════════════════════════
+
+_BACKFILL_ENGINE: Optional[IvorySecurityEngine] = None
+
+def find_rotated_logs(log_path: str) -> List[str]:
+    """📚 access.log y sus rotaciones (access.log.1, access.log.2.gz...), de más antigua a más nueva"""
+    candidates = [path for path in glob.glob(glob.escape(log_path) + '*') if os.path.isfile(path)]
+    return sorted(candidates, key=os.path.getmtime)
+
+def log_fingerprint(path: str) -> str:
+    """🔑 Huella de un log: hash de su primera línea (descomprimida en los .gz)
+    
+    No cambia al crecer el archivo ni al rotarlo o comprimirlo, así que sirve
+    para saber qué parte de un log ya importó un backfill anterior.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        first_line = f.readline(8192)
+    return hashlib.sha1(first_line).hexdigest() if first_line.endswith(b'\n') else ''
+
+def split_log_ranges(path: str, chunk_bytes: int, start: int = 0) -> List[Tuple[int, int]]:
+    """✂️ Dividir un archivo (desde start) en rangos de bytes alineados a fin de línea"""
+    size = os.path.getsize(path)
+    ranges = []
+    
+    with open(path, 'rb') as f:
+        # Una última línea sin '\n' puede estar a medias: queda para el siguiente backfill
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+        if tail and not tail.endswith(b'\n') and b'\n' in tail:
+            size -= len(tail) - tail.rfind(b'\n') - 1
+        
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                f.seek(end)
+                f.readline()  # Avanzar hasta el siguiente salto de línea
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    
+    return ranges
+
+def _init_backfill_worker(config_path: str):
+    """🧩 Inicializar el motor de análisis de cada proceso worker"""
+    global _BACKFILL_ENGINE
+    _BACKFILL_ENGINE = IvorySecurityEngine(config_path, worker_mode=True)
+    # Los rangos no se reparten por IP: varios workers verían la misma IP, solo caché en memoria
+    # (por eso las decisiones de bloqueo se toman en el proceso principal)
+    _BACKFILL_ENGINE.ip_intelligence.write_back = False
+
+def _read_backfill_lines(path: str, start: int, end: Optional[int], batch_size: int):
+    """📖 Leer las líneas de un rango (o de un .gz desde start) por lotes: (líneas, posición)"""
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            f.seek(start)
+            batch = []
+            for line in f:
+                batch.append(line.decode('utf-8', errors='replace'))
+                if len(batch) >= batch_size:
+                    yield batch, f.tell()
+                    batch = []
+            yield batch, f.tell()
+        return
+    
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode('utf-8', errors='replace').splitlines()
+    for i in range(0, len(lines), batch_size):
+        yield lines[i:i + batch_size], end  # el rango ya se leyó entero
+
+def _read_backfill_records(engine: IvorySecurityEngine, path: str, start: int,
+                           end: Optional[int], batch_size: int):
+    """📖 Registros parseados de un rango por lotes: (registros, líneas leídas, posición)"""
+    if path.endswith('.gz') or not engine.config['optimization']['mmap_log_reader']:
+        for lines, position in _read_backfill_lines(path, start, end, batch_size):
+            records = [record for record in (engine.parse_log_line(line.strip()) for line in lines) if record]
+            yield records, len(lines), position
+        return
+    
+    # Archivos planos: regex sobre bytes directamente en el buffer mapeado
+    with open(path, 'rb') as f:
+        # El rango termina en fin de línea; si falta el último '\n' se completa a mano
+        records, cut = read_log_region(f, start, end)
+        if cut < end:
+            f.seek(cut)
+            tail = f.read(end - cut).decode('utf-8', errors='replace').strip()
+            record = engine.parse_log_line(tail)
+            if record:
+                records.append(record)
+    
+    # Con mmap solo se decodifican las líneas válidas: se cuentan los registros
+    for i in range(0, len(records), batch_size):
+        batch = records[i:i + batch_size]
+        yield batch, len(batch), end
+
+def _backfill_range(path: str, start: int, end: Optional[int]) -> Dict:
+    """⚙️ Parsear y puntuar un rango de un log (se ejecuta en un worker)
+    
+    Devuelve los eventos sin decisión de bloqueo y la posición alcanzada
+    (en los .gz, en bytes descomprimidos).
+    """
+    engine = _BACKFILL_ENGINE
+    batch_size = engine.config['optimization']['batch_size']
+    events = []
+    line_count = 0
+    position = start
+    
+    for records, lines, position in _read_backfill_records(engine, path, start, end, batch_size):
+        line_count += lines
+        for record in records:
+            record['timestamp'] = parse_apache_timestamp(record['timestamp_str'])
+        if records:
+            events.extend(engine.analyze_records_batch(records))
+    
+    return {'events': events, 'lines': line_count, 'end': position}
+
+# ═══════════════════════════════════════════════════════════
+# 🧵 PIPELINE DE ANÁLISIS FRAGMENTADO POR IP
+# ═══════════════════════════════════════════════════════════
+
+_PIPELINE_ENGINE: Optional[IvorySecurityEngine] = None
+
+def shard_for_ip(ip: str, shards: int) -> int:
+    """🔀 Fragmento estable de una IP (crc32, igual en todos los procesos)"""
+    return zlib.crc32(ip.encode('ascii', errors='replace')) % shards
+
+def _init_pipeline_worker(config_path: str):
+    """🧩 Motor propio de cada worker: su estado por IP no se comparte"""
+    global _PIPELINE_ENGINE
+    _PIPELINE_ENGINE = IvorySecurityEngine(config_path, worker_mode=True)
+    # Cada IP vive en un único worker: su inteligencia se guarda desde aquí, también al salir
+    Finalize(_PIPELINE_ENGINE, _PIPELINE_ENGINE.ip_intelligence.close, exitpriority=10)
+    if _PIPELINE_ENGINE.config['ai']['auto_learning'] and _PIPELINE_ENGINE.config['ai']['anomaly_detection']:
+        _PIPELINE_ENGINE.feature_outbox = []  # el reentrenamiento del principal no vuelve a extraerlas
+
+def _analyze_shard_batch(records: List[Dict]) -> Dict:
+    """⚙️ Analizar un lote de un fragmento y decidir el bloqueo (en el worker)
+    
+    Devuelve {'results': [(evento, bloquear)], 'features': matriz del lote o None,
+    'latency': {etapa: histograma vaciado con drain()}}.
+    """
+    engine = _PIPELINE_ENGINE
+    engine.refresh_worker_state()  # configuración cambiada desde el proceso principal
+    events = engine.analyze_records_batch(records)
+    results = [(event, engine.should_block_ip(event)) for event in events]
+    # El proceso principal aplica siempre estas decisiones: el bloqueo se cuenta aquí, donde vive la IP
+    engine.count_blocks([event for event, block in results if block])
+    
+    features = None
+    outbox = engine.feature_outbox
+    if outbox:
+        import numpy as np
+        features = outbox[0] if len(outbox) == 1 else np.concatenate(outbox)
+        outbox.clear()
+    # Latencias de analyze/geo/ml medidas aquí: el principal las suma a las suyas
+    latency = {stage: histogram.drain() for stage, histogram in engine.stage_latency.items() if histogram.count}
+    return {'results': results, 'features': features, 'latency': latency}
+
+class AnalysisPipeline:
+    """🧵 Reparto de registros entre N procesos según la IP
+    
+    Cada fragmento tiene su propio proceso (un pool de un único worker), así
+    que todas las peticiones de una IP llegan siempre al mismo motor y en
+    orden: ventanas de rate limiting, historial e inteligencia viven allí sin
+    locks. Los eventos y decisiones vuelven a la etapa de bloqueo del
+    proceso principal (.htaccess, base de datos, estadísticas), junto con las
+    latencias por etapa de los workers, que se suman a los histogramas de
+    latency.
+    """
+    
+    def __init__(self, config_path: str, workers: int, batch_size: int = 500,
+                 latency: Optional[Dict[str, LatencyHistogram]] = None):
+        self.batch_size = batch_size
+        self.latency = latency if latency is not None else {}
+        self.executors = [
+            ProcessPoolExecutor(max_workers=1, initializer=_init_pipeline_worker, initargs=(config_path,))
+            for _ in range(workers)
+        ]
+        self.records_per_shard = [0] * workers
+        self.batches = 0
+    
+    async def analyze(self, records: List[Dict]) -> Tuple[List[Tuple[SecurityEvent, bool]], Optional['np.ndarray']]:
+        """📤 Enviar cada registro a su fragmento y recoger (evento, bloquear) y las características"""
+        shards = [[] for _ in self.executors]
+        for record in records:
+            shards[shard_for_ip(record['ip'], len(shards))].append(record)
+        
+        loop = asyncio.get_running_loop()
+        futures = []
+        for index, shard in enumerate(shards):
+            self.records_per_shard[index] += len(shard)
+            for i in range(0, len(shard), self.batch_size):
+                futures.append(loop.run_in_executor(
+                    self.executors[index], _analyze_shard_batch, shard[i:i + self.batch_size]
+                ))
+        
+        self.batches += len(futures)
+        batches = await asyncio.gather(*futures)
+        for batch in batches:
+            for stage, snapshot in batch['latency'].items():
+                histogram = self.latency.get(stage)
+                if histogram is not None:
+                    histogram.merge(snapshot)
+        matrices = [batch['features'] for batch in batches if batch['features'] is not None]
+        features = None
+        if matrices:
+            import numpy as np
+            features = np.concatenate(matrices)
+        return [item for batch in batches for item in batch['results']], features
+    
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+    
+    def get_stats(self) -> Dict:
+        return {
+            'workers': len(self.executors),
+            'batches': self.batches,
+            'records_per_shard': list(self.records_per_shard)
+        }
+
+# ═══════════════════════════════════════════════════════════
+# 📡 ENDPOINT LOCAL DE MÉTRICAS Y CONTROL
+# ═══════════════════════════════════════════════════════════
+
+class MetricsServer:
+    """📡 HTTP mínimo sobre asyncio para observar y controlar un motor en marcha
+    
+    Corre en el mismo bucle de eventos que el monitoreo, así que lee el
+    estado en memoria sin locks y los comandos se ejecutan entre lotes.
+    
+        GET  /metrics          texto de Prometheus
+        GET  /metrics.json     el mismo estado en JSON
+        GET  /health           vivo / monitoreo activo
+        GET  /traces           trazas por etapa muestreadas
+        POST /control/reload   recargar la configuración
+        POST /control/flush    volcar .htaccess, eventos e inteligencia de IPs
+        POST /control/trace    ?enabled=1&sample_rate=0.01 (activar o ajustar el trazado)
+        POST /control/profile  ?seconds=30 (captura cProfile; responde al terminar)
+    
+    Los comandos exigen siempre la cabecera X-Ivory-Token (una cabecera no
+    simple: un navegador no puede enviarla sin preflight CORS).
+    """
+    REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+               409: 'Conflict', 500: 'Internal Server Error'}
+    
+    def __init__(self, engine: 'IvorySecurityEngine', host: str = '127.0.0.1', port: int = 9477,
+                 token: str = ''):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.token = token
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.requests = 0
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]  # puerto real si se pidió el 0
+    
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+    
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """🔌 Una petición por conexión (HTTP/1.1 con Connection: close)"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            
+            path, _, query = target.partition('?')
+            status, content_type, body = await self.route(method.upper(), path, headers,
+                                                          urllib.parse.parse_qs(query))
+        except (ValueError, asyncio.TimeoutError):
+            status, content_type, body = 400, 'text/plain', b'bad request\n'
+        except Exception as e:
+            self.engine.logger.error(f"❌ Error en el endpoint de métricas: {e}")
+            status, content_type, body = 500, 'application/json', json.dumps({'error': str(e)}).encode()
+        
+        self.requests += 1
+        writer.write((
+            f"HTTP/1.1 {status} {self.REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('latin-1') + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+    
+    async def route(self, method: str, path: str, headers: Dict,
+                    query: Optional[Dict[str, List[str]]] = None) -> Tuple[int, str, bytes]:
+        """🧭 Resolver la ruta: (estado, content-type, cuerpo)"""
+        if path == '/metrics' and method == 'GET':
+            return 200, 'text/plain; version=0.0.4', self.render_prometheus().encode('utf-8')
+        if path == '/metrics.json' and method == 'GET':
+            return 200, 'application/json', json.dumps(self.engine.get_live_metrics()).encode('utf-8')
+        if path == '/health' and method == 'GET':
+            return 200, 'application/json', json.dumps(
+                {'status': 'ok', 'monitoring_active': self.engine.monitoring_active}
+            ).encode('utf-8')
+        if path == '/traces' and method == 'GET':
+            return 200, 'application/json', json.dumps(
+                {'tracing': self.engine.tracer.get_stats(), 'traces': list(self.engine.tracer.traces)}
+            ).encode('utf-8')
+        
+        commands = {
+            '/control/reload': lambda query: self.reload(),
+            '/control/flush': lambda query: self.engine.flush_pending(),
+            '/control/trace': self.trace,
+            '/control/profile': self.profile
+        }
+        if path in commands:
+            if method != 'POST':
+                return 405, 'text/plain', b'use POST\n'
+            if not self.token or not hmac.compare_digest(headers.get('x-ivory-token', ''), self.token):
+                return 403, 'text/plain', b'forbidden\n'
+            self.engine.logger.info(f"📡 Comando recibido: {path}")
+            try:
+                result = await commands[path](query or {})
+            except RuntimeError as e:
+                return 409, 'application/json', json.dumps({'error': str(e)}).encode('utf-8')
+            return 200, 'application/json', json.dumps(result).encode('utf-8')
+        
+        return 404, 'text/plain', b'not found\n'
+    
+    async def reload(self) -> Dict:
+        self.engine.reload_config()
+        return {'reloaded': True, 'config_mtime': self.engine.config_mtime}
+    
+    async def trace(self, query: Dict[str, List[str]]) -> Dict:
+        tracer = self.engine.tracer
+        enabled = query.get('enabled', ['1'])[0] not in ('0', 'false', 'no')
+        sample_rate = float(query['sample_rate'][0]) if 'sample_rate' in query else None
+        tracer.configure(enabled, sample_rate)
+        return {'enabled': tracer.enabled, 'sample_rate': tracer.sample_rate}
+    
+    async def profile(self, query: Dict[str, List[str]]) -> Dict:
+        seconds = min(max(float(query.get('seconds', ['30'])[0]), 1.0), 600.0)
+        return await self.engine.capture_profile(seconds)
+    
+    def render_prometheus(self) -> str:
+        """📜 Formato de exposición de texto de Prometheus"""
+        engine = self.engine
+        live = engine.get_live_metrics()
+        lines = []
+        
+        def metric(name: str, kind: str, help_text: str, samples):
+            lines.append(f'# HELP ivory_{name} {help_text}')
+            lines.append(f'# TYPE ivory_{name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f'ivory_{name}{{{label_text}}} {value}' if label_text else f'ivory_{name} {value}')
+        
+        metric('up', 'gauge', 'Monitoreo activo', [({}, int(live['monitoring_active']))])
+        metric('uptime_seconds', 'gauge', 'Segundos desde el arranque del motor', [({}, live['uptime_seconds'])])
+        metric('lines_total', 'counter', 'Lineas de log procesadas', [({}, live['ingest']['lines'])])
+        metric('lines_per_second', 'gauge', 'Lineas por segundo de procesamiento efectivo',
+               [({}, live['ingest']['lines_per_second'])])
+        
+        def histograms(name: str, help_text: str, by_stage: Dict[str, LatencyHistogram]):
+            lines.append(f'# HELP ivory_{name} {help_text}')
+            lines.append(f'# TYPE ivory_{name} histogram')
+            for stage, histogram in by_stage.items():
+                for le, count in histogram.cumulative():
+                    lines.append(f'ivory_{name}_bucket{{stage="{stage}",le="{le}"}} {count}')
+                lines.append(f'ivory_{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'ivory_{name}_count{{stage="{stage}"}} {histogram.count}')
+        
+        histograms('stage_latency_seconds', 'Latencia por etapa', engine.stage_latency)
+        if engine.tracer.histograms:
+            histograms('trace_latency_seconds', 'Latencia por etapa del trazado fino',
+                       dict(sorted(engine.tracer.histograms.items())))
+        
+        metric('queue_depth', 'gauge', 'Elementos pendientes por cola',
+               [({'queue': name}, depth) for name, depth in live['queues'].items()])
+        metric('cache_hit_ratio', 'gauge', 'Aciertos de cache',
+               [({'cache': name}, stats['hit_ratio']) for name, stats in live['caches'].items() if stats])
+        
+        real_time = live['real_time']
+        metric('requests_total', 'counter', 'Peticiones analizadas', [({}, real_time['total_requests'])])
+        metric('threat_requests_total', 'counter', 'Peticiones de nivel HIGH o CRITICAL',
+               [({}, real_time['blocked_requests'])])
+        metric('unique_ips', 'gauge', 'IPs unicas (estimacion HyperLogLog)', [({}, real_time['unique_ips'])])
+        metric('blocked_ips', 'gauge', 'IPs bloqueadas en .htaccess', [({}, live['blocks']['blocked_ips'])])
+        metric('htaccess_rules', 'gauge', 'Reglas escritas en .htaccess', [({}, live['blocks']['rules'])])
+        metric('htaccess_flushes_total', 'counter', 'Escrituras de .htaccess', [({}, live['blocks']['flushes'])])
+        
+        return '\n'.join(lines) + '\n'
 
 # ═══════════════════════════════════════════════════════════
 # 🚀 FUNCIONES DE UTILIDAD
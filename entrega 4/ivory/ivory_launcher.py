@@ -13,6 +13,7 @@ import time
 import webbrowser
 from pathlib import Path
 import urllib.request
+import urllib.error
 import zipfile
 import shutil
 import tkinter as tk
@@ -394,7 +395,7 @@ class IvoryLauncher:
                     time.sleep(10)
             except KeyboardInterrupt:
                 print("\n⏹️ Monitoreo detenido por el usuario")
-                engine.stop_monitoring()
+                engine.close()
             
         except Exception as e:
             print(f"❌ Error en modo consola: {e}")
@@ -521,9 +522,13 @@ class IvoryLauncher:
         print("3. Verificar integridad del sistema")
         print("4. Actualizar bases de datos GeoIP")
         print("5. Reparar configuración")
-        print("6. Volver al menú principal")
+        print("6. Analizar logs históricos (backfill)")
+        print("7. Archivar eventos en Parquet")
+        print("8. Reporte histórico")
+        print("9. Perfilar el motor en marcha (cProfile)")
+        print("10. Volver al menú principal")
         
-        choice = input("\n🎯 Selecciona opción (1-6): ").strip()
+        choice = input("\n🎯 Selecciona opción (1-10): ").strip()
         
         if choice == '1':
             self.clean_old_logs()
@@ -535,6 +540,14 @@ class IvoryLauncher:
             self.update_geoip_databases()
         elif choice == '5':
             self.repair_config()
+        elif choice == '6':
+            self.run_backfill()
+        elif choice == '7':
+            self.export_archive()
+        elif choice == '8':
+            self.historical_report()
+        elif choice == '9':
+            self.profile_running_engine()
     
     def clean_old_logs(self):
         """🧹 Limpiar logs antiguos"""
@@ -581,6 +594,144 @@ class IvoryLauncher:
         installer.create_default_config()
         print("✅ Configuración reparada")
     
+    def run_backfill(self):
+        """🗂️ Analizar logs históricos en paralelo"""
+        config = self.load_config()
+        if not config:
+            return
+        
+        try:
+            sys.path.append(str(self.base_dir))
+            from ivory_core_engine import IvorySecurityEngine, find_rotated_logs
+            
+            log_path = input(f"📁 Log a analizar [{config['paths']['apache_log']}]: ").strip()
+            log_paths = find_rotated_logs(log_path or config['paths']['apache_log'])
+            if not log_paths:
+                print("❌ No se encontraron archivos de log")
+                return
+            
+            print("\n📚 Archivos encontrados:")
+            for path in log_paths:
+                print(f"  • {path}")
+            
+            workers = input(f"⚙️ Procesos (ENTER = {os.cpu_count()} núcleos): ").strip()
+            apply_blocks = input("🚫 ¿Bloquear en .htaccess las IPs detectadas? (s/n): ").strip().lower() == 's'
+            
+            engine = IvorySecurityEngine(str(self.config_file))
+            result = engine.backfill_logs(
+                log_paths,
+                workers=int(workers) if workers.isdigit() else None,
+                apply_blocks=apply_blocks
+            )
+            engine.close()
+            
+            print("\n" + "="*50)
+            print("🗂️ BACKFILL COMPLETADO")
+            print("="*50)
+            print(f"📄 Líneas analizadas: {result['lines']}")
+            print(f"⏱️ Tiempo: {result['seconds']}s ({result['lines_per_second']} líneas/s)")
+            print(f"🕐 Horas agregadas: {result['hours']}")
+            print(f"🚫 IPs a bloquear: {result['ips_to_block']}")
+            print("="*50)
+            
+        except Exception as e:
+            print(f"❌ Error en backfill: {e}")
+    
+    def export_archive(self):
+        """🧊 Archivar en Parquet los días cerrados de security_events"""
+        try:
+            sys.path.append(str(self.base_dir))
+            from ivory_core_engine import IvorySecurityEngine
+            
+            engine = IvorySecurityEngine(str(self.config_file))
+            exported = engine.export_columnar_archive()
+            engine.close()
+            
+            print(f"\n🧊 Días archivados: {len(exported)}")
+            for day, counts in exported.items():
+                print(f"  • {day}: {counts['events']} eventos")
+            print(f"📁 Directorio: {engine.config['paths']['archive_dir']}")
+            
+        except Exception as e:
+            print(f"❌ Error archivando eventos: {e}")
+    
+    def historical_report(self):
+        """🗓️ Reporte de un rango de días (usa el archivo Parquet cuando existe)"""
+        try:
+            sys.path.append(str(self.base_dir))
+            from ivory_core_engine import IvorySecurityEngine
+            
+            start_day = input("📅 Desde (AAAA-MM-DD): ").strip()
+            end_day = input("📅 Hasta (AAAA-MM-DD): ").strip()
+            
+            engine = IvorySecurityEngine(str(self.config_file))
+            report = engine.generate_historical_report(start_day, end_day)
+            engine.close()
+            
+            print("\n" + "="*50)
+            print("🗓️ REPORTE HISTÓRICO")
+            print("="*50)
+            print(f"🕐 Período: {report['period']}")
+            print(f"📈 Total eventos: {report['general_stats']['total_events']}")
+            print(f"🚫 Eventos bloqueados: {report['general_stats']['blocked_events']}")
+            print(f"🌐 IPs únicas: {report['general_stats']['unique_ips']}")
+            print(f"🧊 Días desde el archivo: {report['sources']['archive_days']}")
+            
+            if report['top_threat_countries']:
+                print("\n🌍 Top países amenazantes:")
+                for country in report['top_threat_countries'][:5]:
+                    print(f"  • {country['country']}: {country['count']} amenazas")
+            
+            print("="*50)
+            
+        except Exception as e:
+            print(f"❌ Error generando reporte: {e}")
+    
+    def profile_running_engine(self):
+        """🔬 Capturar un perfil cProfile del motor en marcha (vía su endpoint local)"""
+        config = self.load_config()
+        if not config:
+            return
+        
+        monitoring = config.get('monitoring', {})
+        host = monitoring.get('metrics_host', '127.0.0.1')
+        port = monitoring.get('metrics_port', 9477)
+        seconds = input("⏱️ Segundos de captura [30]: ").strip()
+        seconds = int(seconds) if seconds.isdigit() else 30
+        
+        # El motor genera el token en su primer arranque y lo guarda en la configuración
+        token = monitoring.get('control_token', '')
+        if not token:
+            print("❌ Sin token de control: arranca el monitoreo una vez para que se genere")
+            return
+        
+        request = urllib.request.Request(
+            f"http://{host}:{port}/control/profile?seconds={seconds}",
+            method='POST',
+            headers={'X-Ivory-Token': token}
+        )
+        
+        try:
+            print(f"🔬 Perfilando el motor durante {seconds}s...")
+            with urllib.request.urlopen(request, timeout=seconds + 30) as response:
+                result = json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 403:
+                print("❌ Token de control rechazado: revisa monitoring.control_token en la configuración")
+            else:
+                print(f"❌ El motor rechazó la captura ({e.code}): {e.read().decode('utf-8', 'replace')}")
+            return
+        except Exception as e:
+            print(f"❌ No se pudo perfilar el motor en {host}:{port}: {e}")
+            print("💡 El motor debe estar monitoreando con 'metrics_endpoint' activado")
+            return
+        
+        print("\n" + "="*50)
+        print("🔬 FUNCIONES CON MÁS TIEMPO ACUMULADO")
+        print("="*50)
+        print(result['summary'])
+        print(f"💾 Volcado completo: {result['file']}")
+    
     def show_help(self):
         """📚 Mostrar ayuda"""
         help_text = """
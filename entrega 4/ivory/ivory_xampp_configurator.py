@@ -451,7 +451,10 @@ Header always set Content-Security-Policy "default-src 'self'"
             },
             "optimization": {
                 "cache_geoip_lookups": True,
+                "geoip_cache_size": 10000,
                 "batch_process_logs": True,
+                "read_chunk_size": 1048576,
+                "batch_size": 500,
                 "compress_old_logs": True,
                 "auto_cleanup": True
             }